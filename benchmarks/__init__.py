@@ -0,0 +1,13 @@
+"""
+Benchmarks
+
+Repeatable timings of the hot paths of the service, written as JSON so
+that runs on different commits can be compared:
+
+  python -m benchmarks.run --output before.json
+  python -m benchmarks.run --output after.json
+  python -m benchmarks.compare before.json after.json
+
+They use the database named by BENCH_DATABASE (default: bench) of the
+storage backend that PROMOTION_BACKEND selects, and empty it first.
+"""
@@ -0,0 +1,70 @@
+"""
+Model benchmarks
+
+serialize(), deserialize(), from_document(), find_conflict() and apply() of
+the Promotion model.
+"""
+import json
+from service.models import Promotion
+from benchmarks.harness import benchmark
+from benchmarks.data import load, make_promotion, make_products
+
+
+@benchmark('models.serialize', number=10000)
+def serialize():
+    """ Serialize a promotion with 20 products """
+    promotion = make_promotion(0, products=20)
+    return promotion.serialize
+
+
+@benchmark('models.deserialize', number=10000)
+def deserialize():
+    """ Deserialize a CouchDB document with 20 products """
+    document = dict(make_promotion(0, products=20).serialize(),
+                    _id='0a1b2c3d', _rev='1-0a1b2c3d')
+    return lambda: Promotion().deserialize(document)
+
+
+@benchmark('models.from_document', number=10000)
+def from_document():
+    """ Build a promotion from a CouchDB document with 20 products """
+    document = dict(make_promotion(0, products=20).serialize(),
+                    _id='0a1b2c3d', _rev='1-0a1b2c3d')
+    return lambda: Promotion.from_document(document)
+
+
+@benchmark('models.read[promotions=1000]', number=5, memory=True)
+def read():
+    """ Build 1000 promotions from the JSON of their documents, like a list does """
+    payloads = [json.dumps(dict(make_promotion(index, products=20).serialize(),
+                                _id='{:032x}'.format(index), _rev='1-0a1b2c3d'))
+                for index in range(1000)]
+    return lambda: [Promotion.from_document(json.loads(payload)) for payload in payloads]
+
+
+def find_conflict_with(existing):
+    """ Check a new promotion for overlaps with `existing` ones with the same code """
+    def setup():
+        load([make_promotion(index) for index in range(existing)])
+        promotion = make_promotion(existing)
+        return promotion.find_conflict
+    return setup
+
+
+for count in (10, 100, 1000):
+    benchmark('models.find_conflict[existing={}]'.format(count),
+              number=20)(find_conflict_with(count))
+
+
+def apply_to(count):
+    """ Apply a promotion to a cart of `count` products, half of them eligible """
+    def setup():
+        promotion = make_promotion(0, products=count // 2)
+        products = make_products(count)
+        return lambda: promotion.apply([dict(product) for product in products])
+    return setup
+
+
+for count in (100, 10000):
+    benchmark('models.apply[products={}]'.format(count),
+              number=max(1, 100000 // count))(apply_to(count))
@@ -0,0 +1,86 @@
+"""
+Service benchmarks
+
+list, get, create and apply through the Flask test client, so the
+parsing, the marshalling and the database calls are all counted.
+"""
+import itertools
+import json
+from service import app
+from benchmarks.harness import benchmark
+from benchmarks.data import load, make_promotion, make_products
+
+
+def client():
+    """ Returns a test client of the service """
+    app.debug = False
+    return app.test_client()
+
+
+def checked(response, code):
+    """ Fails the benchmark when a request does not get the expected status """
+    if response.status_code != code:
+        raise AssertionError('{} {}'.format(response.status_code, response.get_data()))
+    return response
+
+
+def list_promotions(count, headers=None, url='/promotions'):
+    """ List `count` promotions """
+    def setup():
+        test_client = client()
+        load([make_promotion(index) for index in range(count)])
+        return lambda: checked(test_client.get(url, headers=headers), 200)
+    return setup
+
+
+for count in (100, 1000):
+    benchmark('service.list[promotions={}]'.format(count),
+              number=max(1, 1000 // count))(list_promotions(count))
+benchmark('service.list[promotions=1000,gzip]',
+          number=1)(list_promotions(1000, {'Accept-Encoding': 'gzip'}))
+benchmark('service.list[promotions=1000,fields=id,code]',
+          number=1)(list_promotions(1000, url='/promotions?fields=id,code'))
+
+
+@benchmark('service.get', number=200)
+def get_promotion():
+    """ Get one promotion """
+    test_client = client()
+    promotion = load([make_promotion(0)])[0]
+    url = '/promotions/{}'.format(promotion.id)
+    return lambda: checked(test_client.get(url), 200)
+
+
+@benchmark('service.create', number=50)
+def create_promotion():
+    """ Create promotions that overlap no other """
+    test_client = client()
+    load([])
+    indexes = itertools.count()
+
+    def create():
+        body = make_promotion(next(indexes)).serialize()
+        del body['id']
+        checked(test_client.post('/promotions', data=json.dumps(body),
+                                 content_type='application/json'), 201)
+    return create
+
+
+def apply_promotion(count):
+    """ Apply a promotion to a cart of `count` products """
+    def setup():
+        test_client = client()
+        promotion = make_promotion(0, products=count // 2)
+        promotion.start_date = 0
+        promotion.expiry_date = 2 ** 31
+        load([promotion])
+        url = '/promotions/{}/apply'.format(promotion.id)
+        body = json.dumps({'products': make_products(count)})
+        return lambda: checked(test_client.post(url, data=body,
+                                                content_type='application/json'), 200)
+    return setup
+
+
+for count in (1000, 10000):
+    benchmark('service.apply[products={}]'.format(count),
+              number=max(1, 10000 // count))(apply_promotion(count))
@@ -0,0 +1,56 @@
+"""
+Compares two benchmark results
+
+  python -m benchmarks.compare base.json head.json [--threshold 0.1]
+
+Exits with 1 when a benchmark got slower than the threshold allows.
+"""
+import argparse
+import json
+import sys
+
+
+def compare(base, head, threshold):
+    """
+    Returns a row for each benchmark present in both results, with the
+    ratio of the median times and whether it is a regression
+    """
+    base_results = {result['name']: result for result in base['results']}
+    rows = []
+    for result in head['results']:
+        before = base_results.get(result['name'])
+        if before is None:
+            continue
+        ratio = result['median'] / before['median'] if before['median'] else float('inf')
+        rows.append({
+            'name': result['name'],
+            'base': before['median'],
+            'head': result['median'],
+            'ratio': ratio,
+            'regression': ratio > 1.0 + threshold,
+        })
+    return rows
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description='Compare two benchmark results')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown allowed before failing, 0.1 for 10%%')
+    args = parser.parse_args(argv)
+    with open(args.base) as base_file, open(args.head) as head_file:
+        base, head = json.load(base_file), json.load(head_file)
+
+    print('{} -> {}'.format(base['meta'].get('commit'), head['meta'].get('commit')))
+    rows = compare(base, head, args.threshold)
+    for row in rows:
+        print('{:40} {:>12.1f} us {:>12.1f} us {:>7.2f}x{}'.format(
+            row['name'], row['base'] * 1e6, row['head'] * 1e6, row['ratio'],
+            '  REGRESSION' if row['regression'] else ''))
+    return 1 if any(row['regression'] for row in rows) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,34 @@
+"""
+Data
+
+Promotions and carts for the benchmarks.
+"""
+from service.models import Promotion
+
+CODE = 'BENCH'
+WINDOW = 100  # seconds between the starts of consecutive promotions
+
+
+def make_promotion(index, code=CODE, products=5):
+    """
+    Returns the index-th promotion of a code, which overlaps no other
+
+    Its products are the even product ids from p0.
+    """
+    start_date = 1000000 + index * WINDOW
+    return Promotion(code=code, percentage=80,
+                     products=['p{}'.format(2 * number) for number in range(products)],
+                     start_date=start_date, expiry_date=start_date + WINDOW // 2)
+
+
+def make_products(count):
+    """ Returns a cart of products p0, p1, ... with their prices """
+    return [{'product_id': 'p{}'.format(number), 'price': 10.0 + number % 90}
+            for number in range(count)]
+
+
+def load(promotions):
+    """ Empties the database and creates the promotions in bulk """
+    Promotion.remove_all()
+    Promotion.create_many(promotions)
+    return promotions
@@ -0,0 +1,78 @@
+"""
+Harness
+
+Registers the benchmarks and times them with timeit.
+"""
+import statistics
+import timeit
+import tracemalloc
+
+BENCHMARKS = []
+
+
+class Benchmark():
+    """
+    A named piece of code to time
+
+    `setup` prepares whatever the benchmark needs and returns the function
+    that is timed, which is called `number` times per measure. With
+    `memory` the bytes still allocated for what one call returns are
+    measured too.
+    """
+
+    def __init__(self, name, setup, number=1, repeat=5, memory=False):
+        self.name = name
+        self.setup = setup
+        self.number = number
+        self.repeat = repeat
+        self.memory = memory
+
+    def run(self, scale=1.0):
+        """
+        Times the benchmark and returns its result
+
+        Args:
+            scale (float): multiplies the number of calls and measures,
+                to trade precision for time
+        """
+        func = self.setup()
+        func()  # warm up
+        number = max(1, int(self.number * scale))
+        repeat = max(3, int(self.repeat * scale))
+        times = [total / number for total in
+                 timeit.repeat(func, number=number, repeat=repeat)]
+        median = statistics.median(times)
+        result = {
+            'name': self.name,
+            'number': number,
+            'repeat': repeat,
+            'min': min(times),
+            'median': median,
+            'mean': statistics.mean(times),
+            'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+            'ops_per_second': 1.0 / median if median else None,
+        }
+        if self.memory:
+            result['bytes'] = self.allocated(func)
+        return result
+
+    @staticmethod
+    def allocated(func):
+        """ Returns the bytes allocated by a call and held by its result """
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            kept = func()
+            after = tracemalloc.get_traced_memory()[0]
+        finally:
+            tracemalloc.stop()
+        del kept
+        return after - before
+
+
+def benchmark(name, number=1, repeat=5, memory=False):
+    """ Decorator that registers a setup function as a benchmark """
+    def decorator(setup):
+        BENCHMARKS.append(Benchmark(name, setup, number, repeat, memory))
+        return setup
+    return decorator
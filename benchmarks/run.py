@@ -0,0 +1,106 @@
+"""
+Runs the benchmarks and writes their results as JSON
+
+  python -m benchmarks.run [--filter models.] [--scale 0.2] [--output results.json]
+
+With --standin the CouchDB calls go to the in-process stand-in of
+tests/couchdb_standin.py, with --latency seconds added to each of them,
+so that no database server is needed.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+from service import app, storage
+from service.models import Promotion, STORAGE_BACKEND
+from benchmarks import bench_models, bench_service  # pylint: disable=unused-import
+from benchmarks.harness import BENCHMARKS
+from tests.couchdb_standin import CouchDBStandin
+
+BENCH_DATABASE = os.environ.get('BENCH_DATABASE', 'bench')
+
+
+def commit():
+    """ Returns the commit being benchmarked, or None outside of git """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names=None, scale=1.0, standin=None):
+    """ Runs the benchmarks whose name starts with one of `names` """
+    if standin is not None:
+        storage.CLOUDANT_HOST, storage.CLOUDANT_PORT = standin.host, standin.port
+    Promotion.init_db(BENCH_DATABASE)
+    results = []
+    for bench in BENCHMARKS:
+        if names and not any(bench.name.startswith(name) for name in names):
+            continue
+        result = bench.run(scale)
+        print('{:40} {:>12.1f} us  {:>10.1f} ops/s{}'.format(
+            result['name'], result['median'] * 1e6, result['ops_per_second'],
+            '  {:>10} bytes'.format(result['bytes']) if 'bytes' in result else ''))
+        results.append(result)
+    Promotion.remove_all()
+    return {
+        'meta': {
+            'commit': commit(),
+            'date': datetime.datetime.utcnow().isoformat() + 'Z',
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': STORAGE_BACKEND,
+            'scale': scale,
+            'standin': None if standin is None else {
+                'latency': standin.state.latency,
+                'error_rate': standin.state.error_rate,
+            },
+        },
+        'results': results,
+    }
+
+
+def main(argv=None):
+    """ Command line entry point """
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths of the service')
+    parser.add_argument('--filter', action='append', default=[],
+                        help='only run the benchmarks with this name prefix')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply the number of calls, below 1 for a quick run')
+    parser.add_argument('--output', help='JSON file to write, benchmarks/results/<commit>.json'
+                                         ' by default')
+    parser.add_argument('--standin', action='store_true',
+                        help='use an in-process CouchDB stand-in')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds the stand-in adds to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of the stand-in requests answered with 429')
+    args = parser.parse_args(argv)
+
+    # keep the request and model logs out of the timings
+    for logger in (app.logger, logging.getLogger('flask.app')):
+        logger.setLevel(logging.WARNING)
+    standin = None
+    if args.standin:
+        standin = CouchDBStandin(latency=args.latency, error_rate=args.error_rate).start()
+    try:
+        report = run(args.filter, args.scale, standin)
+    finally:
+        if standin is not None:
+            standin.stop()
+    output = args.output or os.path.join(os.path.dirname(__file__), 'results',
+                                         '{}.json'.format(report['meta']['commit'] or 'local'))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(report, results_file, indent=2)
+    print('Results written to {}'.format(output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
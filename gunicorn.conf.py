@@ -0,0 +1,38 @@
+"""
+Gunicorn configuration
+
+Runs the service with several worker processes, each serving requests
+from several threads. Every worker connects to the database on its own
+and warms up after it has been forked.
+
+  GUNICORN_WORKERS - worker processes (default: WEB_CONCURRENCY or 1)
+  GUNICORN_THREADS - request threads per worker (default: 1)
+  GUNICORN_TIMEOUT - seconds before a silent worker is restarted (default: 30)
+"""
+import os
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', '5000'))
+workers = int(os.environ.get('GUNICORN_WORKERS', os.environ.get('WEB_CONCURRENCY', '1')))
+threads = int(os.environ.get('GUNICORN_THREADS', '1'))
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '30'))
+errorlog = '-'
+preload_app = True
+
+
+def post_fork(server, worker):    # pylint: disable=unused-argument
+    """ Drops the state the worker inherited from the master process """
+    from service.models import Promotion
+    Promotion.after_fork()
+
+
+def post_worker_init(worker):    # pylint: disable=unused-argument
+    """
+    Starts warming the worker up as soon as it is forked
+
+    The warm-up connects to the database, declares its indexes and builds
+    the in-process indexes in the background, while /ready tells the load
+    balancer to wait for it.
+    """
+    from service import warmup
+    warmup.start()
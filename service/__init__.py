@@ -35,6 +35,14 @@ app.config['SECRET_KEY'] = SECRET_KEY
 # Import the routes After the Flask app is created
 from service import service, models
 from .models import Promotion
+from .compression import CompressionMiddleware
+from .profiling import ProfilerMiddleware
+
+# Compress the responses for the clients that accept it, and decompress the requests
+app.wsgi_app = CompressionMiddleware(app.wsgi_app)
+
+# Profile the single requests that ask for it with the X-Profile header
+app.wsgi_app = ProfilerMiddleware(app.wsgi_app)
 
 # Set up logging for production
 service.initialize_logging()
@@ -45,7 +53,7 @@ app.logger.info(70 * '*')
 
 @app.before_first_request
 def init_db(dbname="promotions"):
-    """ Initlaize the CouchDB """
-    Promotion.init_db(dbname)
+    """ Initlaize the CouchDB unless this process is already connected """
+    Promotion.ensure_db(dbname)
 
 app.logger.info('Service initialized!')
@@ -0,0 +1,178 @@
+"""
+Active
+
+The set of promotions active right now, kept precomputed and refreshed by
+a timer whenever a start or expiry date passes
+"""
+import logging
+import threading
+import time
+
+# refresh at least this often, in case the clock jumps
+MAX_REFRESH_DELAY = 3600.0
+
+
+class ActiveSet():
+    """
+    Tracks the promotions that have not expired yet and which are active
+
+    A promotion is active from its start_date to its expiry_date, both
+    included. Instead of checking every promotion on every request, the
+    active ids are computed once and a timer computes them again when the
+    next start_date is reached or the next expiry_date has passed. Expired
+    promotions are dropped, since they never become active again, so the
+    set can also answer for any time from `since` on.
+    """
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self):
+        self.documents = {}      # promotion_id -> document not expired at `since`
+        self.active = frozenset()
+        self.since = time.time()
+        self.next_refresh = None
+        self.built_at = time.monotonic()
+        self.lock = threading.RLock()
+        self._timer = None
+        self._stopped = False
+
+    def __len__(self):
+        return len(self.active)
+
+    def age(self):
+        """ Returns how many seconds ago the set was built """
+        return time.monotonic() - self.built_at
+
+    def load(self, documents):
+        """ Adds documents in bulk and computes the active set """
+        with self.lock:
+            for document in documents:
+                if _has_window(document):
+                    self.documents[_id(document)] = document
+            self.refresh()
+        return self
+
+    def apply(self, document):
+        """
+        Applies a promotion document (or a tombstone) to the set
+
+        Args:
+            document (dict): A promotion document with its _id
+        """
+        promotion_id = _id(document)
+        with self.lock:
+            known = promotion_id in self.documents
+            self.documents.pop(promotion_id, None)
+            if not document.get('_deleted') and _has_window(document) and \
+                    int(document['expiry_date']) >= self.since:
+                self.documents[promotion_id] = document
+            elif not known:
+                return
+            now = time.time()
+            active = set(self.active)
+            active.discard(promotion_id)
+            if promotion_id in self.documents and _is_active(document, now):
+                active.add(promotion_id)
+            self.active = frozenset(active)
+            if promotion_id in self.documents:
+                boundary = _next_boundary(document, now)
+                if self.next_refresh is None or boundary < self.next_refresh:
+                    self._schedule(boundary, now)
+
+    def refresh(self):
+        """ Computes the active set again and schedules the next refresh """
+        with self.lock:
+            now = time.time()
+            active = set()
+            boundary = None
+            for promotion_id, document in list(self.documents.items()):
+                if int(document['expiry_date']) < now:
+                    del self.documents[promotion_id]
+                    continue
+                if _is_active(document, now):
+                    active.add(promotion_id)
+                next_boundary = _next_boundary(document, now)
+                if boundary is None or next_boundary < boundary:
+                    boundary = next_boundary
+            self.active = frozenset(active)
+            self.since = now
+            self._schedule(boundary, now)
+
+    def _schedule(self, boundary, now):
+        """ Starts a timer that refreshes the set at the given time """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._stopped:
+            return
+        delay = MAX_REFRESH_DELAY if boundary is None else \
+            min(max(boundary - now, 0.0), MAX_REFRESH_DELAY)
+        self.next_refresh = now + delay
+        self._timer = threading.Timer(delay, self._refresh_on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_on_timer(self):
+        """ Timer callback """
+        try:
+            self.refresh()
+        except Exception as error:   # pylint: disable=broad-except
+            self.logger.warning('Active promotions refresh failed: %s', error)
+
+    def stop(self):
+        """ Cancels the refresh timer """
+        with self.lock:
+            self._stopped = True
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+    def clear(self):
+        """ Removes every promotion """
+        with self.lock:
+            self.documents.clear()
+            self.refresh()
+
+    def current(self):
+        """ Returns the documents of the promotions active now, ordered by id """
+        with self.lock:
+            return [self.documents[promotion_id] for promotion_id in sorted(self.active)]
+
+    def at(self, timestamp):
+        """
+        Returns the documents of the promotions active at a time, ordered by id,
+        or None when the time is before `since` and expired ones are missing
+        """
+        with self.lock:
+            if timestamp < self.since:
+                return None
+            return [document for promotion_id, document in sorted(self.documents.items())
+                    if _is_active(document, timestamp)]
+
+
+def _id(document):
+    """ Returns the id of a document or of a serialized promotion """
+    return document.get('_id') or document.get('id')
+
+
+def _has_window(document):
+    """ True when a document has numeric dates """
+    try:
+        int(document['start_date'])
+        int(document['expiry_date'])
+        return True
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+def _is_active(document, timestamp):
+    """ True when the promotion is active at the given time """
+    return int(document['start_date']) <= timestamp <= int(document['expiry_date'])
+
+
+def _next_boundary(document, now):
+    """ Returns when the promotion next becomes active or inactive """
+    start_date = int(document['start_date'])
+    if start_date > now:
+        return start_date
+    # expiry_date is included, so the promotion ends right after it
+    return int(document['expiry_date']) + 0.001
@@ -0,0 +1,313 @@
+"""
+Async Models
+
+An asyncio variant of the Promotion model layer. It talks to CouchDB with
+aiohttp, so one process can wait on thousands of requests at once instead
+of tying up a thread for each of them. Promotions are the same objects as
+in service.models, only the database calls differ. It only speaks to
+CouchDB, whatever PROMOTION_BACKEND says.
+"""
+import asyncio
+import json
+import logging
+import os
+from collections import defaultdict
+from contextlib import AsyncExitStack
+import aiohttp
+from service.metrics import DB_RETRIES_429
+from service.models import (BULK_CHUNK_SIZE, CONFLICT_MESSAGE, OVERLAP_LIMIT, PAGE_SIZE,
+                            PRODUCT_INDEX_TTL, DatabaseConnectionError, DataValidationError,
+                            Promotion)
+from service.pricing import ProductIndex
+from service.storage import (ADMIN_PARTY, DB_CONNECT_TIMEOUT, DB_READ_TIMEOUT,
+                             INDEX_DESIGN_DOC, INDEXES, CloudantStorage)
+
+ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', '100'))
+RETRIES_429 = 10
+INITIAL_BACKOFF = 0.1
+
+
+def check_status(status, data, action):
+    """ Raises a DatabaseConnectionError unless CouchDB answered with a 2xx status """
+    if not 200 <= status < 300:
+        raise DatabaseConnectionError('CouchDB answered {} {}: {}'.format(
+            status, action, data.get('reason', data.get('error'))))
+
+
+class AsyncPromotionStore():
+    """
+    Reads and writes Promotions without blocking the event loop
+
+    Call open() from the event loop before using it and close() when done.
+    """
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self, dbname='promotions'):
+        self.dbname = dbname
+        self.url = None
+        self.session = None
+        self.code_locks = defaultdict(asyncio.Lock)
+        self.product_index = None
+        self.index_load = None      # task loading the product index
+        self.index_writes = None    # documents written while it loads
+
+    ######################################################################
+    #  C O N N E C T I O N
+    ######################################################################
+    async def open(self):
+        """ Connects to CouchDB, creating the database and its indexes if needed """
+        opts = CloudantStorage.connection_options()
+        self.url = '{}/{}'.format(opts['url'].rstrip('/'), self.dbname)
+        auth = None if ADMIN_PARTY else aiohttp.BasicAuth(opts['username'], opts['password'])
+        self.session = aiohttp.ClientSession(
+            auth=auth,
+            connector=aiohttp.TCPConnector(limit=ASYNC_POOL_SIZE),
+            timeout=aiohttp.ClientTimeout(sock_connect=DB_CONNECT_TIMEOUT,
+                                          sock_read=DB_READ_TIMEOUT))
+        try:
+            status, _ = await self._request('GET', '')
+            if status == 404:
+                status, _ = await self._request('PUT', '')
+            if status not in (200, 201, 202, 412):
+                raise DatabaseConnectionError(
+                    'Database [{}] could not be obtained'.format(self.dbname))
+            await self.create_indexes()
+        except aiohttp.ClientError:
+            await self.close()
+            raise DatabaseConnectionError('Cloudant service could not be reached')
+        return self
+
+    async def close(self):
+        """ Closes the connections """
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def create_indexes(self):
+        """ Declares the Mango indexes used by the finders if they are missing """
+        status, data = await self._request('GET', '_index')
+        check_status(status, data, 'reading the indexes')
+        existing = {index['name'] for index in data.get('indexes', [])}
+        for name, index_fields in INDEXES.items():
+            if name not in existing:
+                status, data = await self._request('POST', '_index', json={
+                    'ddoc': INDEX_DESIGN_DOC, 'name': name, 'type': 'json',
+                    'index': {'fields': index_fields}})
+                check_status(status, data, 'creating an index')
+
+    async def _request(self, method, path, **kwargs):
+        """
+        Sends a request to the database and returns its status and JSON body
+
+        Requests answered with 429 Too Many Requests are sent again after a
+        doubling backoff, like the Replay429Adapter of the sync client.
+        """
+        url = '/'.join((self.url, path)) if path else self.url
+        backoff = INITIAL_BACKOFF
+        for _ in range(RETRIES_429):
+            async with self.session.request(method, url, **kwargs) as resp:
+                if resp.status != 429:
+                    data = await resp.json(content_type=None)
+                    if resp.status >= 500:
+                        resp.raise_for_status()
+                    return resp.status, data or {}
+            DB_RETRIES_429.inc()
+            await asyncio.sleep(backoff)
+            backoff *= 2
+        raise DatabaseConnectionError('CouchDB is still throttling after {} retries'
+                                      .format(RETRIES_429))
+
+    ######################################################################
+    #  F I N D E R S
+    ######################################################################
+    async def find(self, promotion_id):
+        """ Finds a Promotion by its id """
+        status, document = await self._request('GET', promotion_id)
+        if status == 404:
+            return None
+        check_status(status, document, 'reading a promotion')
+        return Promotion.from_document(document)
+
+    async def find_by(self, **kwargs):
+        """ Finds Promotions using a Mango selector, reading them a page at a time """
+        query = {'selector': kwargs, 'limit': PAGE_SIZE}
+        use_index = Promotion.index_for(kwargs)
+        if use_index:
+            query['use_index'] = use_index
+        promotions = []
+        while True:
+            status, data = await self._request('POST', '_find', json=query)
+            if status == 400:
+                raise DataValidationError(data.get('reason', 'Invalid query'))
+            check_status(status, data, 'finding promotions')
+            docs = data.get('docs', [])
+            promotions.extend(Promotion.from_document(doc) for doc in docs)
+            if len(docs) < PAGE_SIZE or not data.get('bookmark'):
+                return promotions
+            query['bookmark'] = data['bookmark']
+
+    async def find_by_code(self, code):
+        """ Finds the Promotions having a code """
+        return await self.find_by(code=code)
+
+    async def find_overlapping(self, code, start_date, expiry_date):
+        """
+        Finds the Promotions with a code active within a date range
+
+        Like Promotion.find_overlapping() it reads the first windows ending
+        after start_date only, and checks their start_date here.
+        """
+        selector = {'code': code, 'expiry_date': {'$gte': start_date}}
+        query = {'selector': selector, 'limit': OVERLAP_LIMIT,
+                 'sort': [{'code': 'asc'}, {'expiry_date': 'asc'}],
+                 'use_index': Promotion.index_for(selector)}
+        status, data = await self._request('POST', '_find', json=query)
+        check_status(status, data, 'finding overlaps')
+        promotions = [Promotion.from_document(doc) for doc in data.get('docs', [])]
+        return [promotion for promotion in promotions if promotion.start_date <= expiry_date]
+
+    async def all(self):
+        """ Returns all Promotions, reading _all_docs a page at a time """
+        promotions = []
+        params = {'include_docs': 'true', 'limit': str(PAGE_SIZE + 1)}
+        while True:
+            status, data = await self._request('GET', '_all_docs', params=params)
+            check_status(status, data, 'listing promotions')
+            rows = data.get('rows', [])
+            for row in rows[:PAGE_SIZE]:
+                if not row['id'].startswith('_design/'):
+                    promotions.append(Promotion.from_document(row['doc']))
+            if len(rows) <= PAGE_SIZE:
+                return promotions
+            params['startkey'] = json.dumps(rows[PAGE_SIZE]['id'])
+
+    ######################################################################
+    #  W R I T E S
+    ######################################################################
+    async def create(self, promotion):
+        """
+        Creates a Promotion
+
+        Like Promotion.create() the overlap check runs after the write,
+        which is rolled back if it overlaps another promotion.
+        """
+        async with self.code_locks[promotion.code]:
+            promotion.validate_fields()
+
+            status, data = await self._request('POST', '', json=promotion.serialize())
+            if status not in (201, 202):
+                raise DataValidationError(data.get('reason', 'Promotion was not created'))
+            promotion.id = data['id']
+            promotion.rev = data['rev']
+            self._index(dict(promotion.serialize(), _id=promotion.id))
+
+            conflict = await self._find_conflict(promotion)
+            if conflict is not None:
+                await self._roll_back_create(promotion)
+                raise DataValidationError(CONFLICT_MESSAGE.format(conflict))
+        return promotion
+
+    async def create_many(self, promotions, chunk_size=None):
+        """ Creates many Promotions with _bulk_docs, see Promotion.create_many() """
+        chunk_size = chunk_size or BULK_CHUNK_SIZE
+        results, valid = Promotion.validate_batch(promotions)
+        codes = sorted({promotion.code for _, promotion in valid})
+        async with AsyncExitStack() as stack:
+            for code in codes:
+                await stack.enter_async_context(self.code_locks[code])
+            existing = await self.find_by(code={'$in': codes}) if codes else []
+            accepted = Promotion.accept_batch(valid, existing, results)
+
+            for start in range(0, len(accepted), chunk_size):
+                chunk = accepted[start:start + chunk_size]
+                status, rows = await self._request(
+                    'POST', '_bulk_docs', json={'docs': [p.serialize() for _, p in chunk]})
+                if status not in (201, 202):
+                    for index, _ in chunk:
+                        results[index] = {'id': None, 'ok': False,
+                                          'error': rows.get('reason', 'Bulk create failed')}
+                    continue
+                Promotion.record_bulk_rows(chunk, rows, results)
+                for _, promotion in chunk:
+                    if promotion.id:
+                        self._index(dict(promotion.serialize(), _id=promotion.id))
+
+            for index, promotion in accepted:
+                conflict = await self._find_conflict(promotion) if promotion.id else None
+                if conflict is not None:
+                    await self._roll_back_create(promotion)
+                    results[index] = {'id': None, 'ok': False,
+                                      'error': CONFLICT_MESSAGE.format(conflict)}
+        return results
+
+    async def _find_conflict(self, promotion):
+        """ Returns the id of a saved promotion that overlaps a written one, or None """
+        for other in await self.find_overlapping(
+                promotion.code, promotion.start_date, promotion.expiry_date):
+            if other.id != promotion.id:
+                return other.id
+        return None
+
+    async def _roll_back_create(self, promotion):
+        """ Deletes the document a Promotion was just created as """
+        status, _ = await self._request('DELETE', promotion.id, params={'rev': promotion.rev})
+        if 200 <= status < 300:
+            self._index({'_id': promotion.id, '_deleted': True})
+        promotion.id = None
+        promotion.rev = None
+
+    ######################################################################
+    #  P R I C I N G
+    ######################################################################
+    def _index(self, document):
+        """ Applies a write of this store to its product index """
+        if self.index_writes is not None:
+            self.index_writes.append(document)
+        if self.product_index is not None:
+            self.product_index.apply(document)
+
+    async def pricing_index(self):
+        """
+        Returns the product index
+
+        Concurrent requests share the load of the index. Once it is older
+        than PRODUCT_INDEX_TTL it is loaded again in the background while
+        requests keep using it.
+        """
+        index = self.product_index
+        if index is None:
+            return await asyncio.shield(self._load_index())
+        if index.age() > PRODUCT_INDEX_TTL:
+            self._load_index()
+        return index
+
+    def _load_index(self):
+        """ Returns the task loading the product index, started unless it is running """
+        if self.index_load is None:
+            self.index_load = asyncio.ensure_future(self._read_index())
+            self.index_load.add_done_callback(self._index_loaded)
+        return self.index_load
+
+    async def _read_index(self):
+        """ Reads a new product index and swaps it in, with the writes made meanwhile """
+        self.index_writes = []
+        try:
+            index = ProductIndex()
+            for promotion in await self.all():
+                index.apply(dict(promotion.serialize(), _id=promotion.id))
+            for document in self.index_writes:
+                index.apply(document)
+            self.product_index = index
+            return index
+        finally:
+            self.index_writes = None
+            self.index_load = None
+
+    def _index_loaded(self, task):
+        """ Logs the failure of a load that nobody may be waiting for """
+        if not task.cancelled() and task.exception() is not None:
+            self.logger.warning('Loading the product index failed: %s', task.exception())
+
+    async def best_prices(self, lines):
+        """ Applies the best active promotion to each line of a cart """
+        return (await self.pricing_index()).price(lines)
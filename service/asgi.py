@@ -0,0 +1,189 @@
+"""
+Promotion Service on ASGI
+
+The read and apply endpoints of the service, served from an event loop by
+an ASGI server on top of the async model layer:
+
+  uvicorn service.asgi:app
+  gunicorn -k uvicorn.workers.UvicornWorker service.asgi:app
+
+Paths:
+------
+GET /promotions - Returns a list all of the Promotions
+GET /promotions?promotion-code={code} - Returns the Promotions having a code
+GET /promotions/{promotion_id} - Returns the Promotion with a given id number
+POST /promotions/{promotion_id}/apply - applies a Promotion to a list of products
+POST /promotions/apply - applies the best active Promotion to each product of a cart
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from urllib.parse import parse_qs
+import aiohttp
+from service.aio import AsyncPromotionStore
+from service.models import DatabaseConnectionError, DataValidationError, cart_lines
+
+logger = logging.getLogger('flask.app')
+
+DATABASE_NAME = os.environ.get('PROMOTION_DATABASE', 'promotions')
+store = AsyncPromotionStore(DATABASE_NAME)
+
+PROMOTION_PATH = re.compile(r'^/promotions/(?P<promotion_id>[^/]+)$')
+APPLY_PATH = re.compile(r'^/promotions/(?P<promotion_id>[^/]+)/apply$')
+
+
+class HTTPError(Exception):
+    """ Ends a request with an error status and message """
+
+    def __init__(self, status, message):
+        super(HTTPError, self).__init__(message)
+        self.status = status
+
+
+######################################################################
+# ENDPOINTS
+######################################################################
+async def list_promotions(request):
+    """ Returns all Promotions or the ones having the promotion-code """
+    code = request['query'].get('promotion-code')
+    if code:
+        promotions = await store.find_by_code(code)
+    else:
+        promotions = await store.all()
+    return 200, [promotion.serialize() for promotion in promotions]
+
+
+async def get_promotion(request, promotion_id):
+    """ Returns the Promotion with the given id """
+    promotion = await store.find(promotion_id)
+    if not promotion:
+        raise HTTPError(404, "404 Not Found: Promotion with id '{}' was not found."
+                        .format(promotion_id))
+    return 200, promotion.serialize()
+
+
+async def apply_promotion(request, promotion_id):
+    """ Applies a Promotion on a given set of products together with their prices """
+    data = await read_json(request)
+    promotion = await store.find(promotion_id)
+    if not promotion:
+        raise HTTPError(404, 'Promotion with id "{}" was not found.'.format(promotion_id))
+    if not promotion.is_active():
+        raise HTTPError(409, 'Promotion with id "{}" is not active.'.format(promotion_id))
+    products = data.get('products') if isinstance(data, dict) else None
+    if products is None:
+        raise DataValidationError('Missing products key in request data')
+    if not isinstance(products, list):
+        raise DataValidationError('The given products in request data \
+                should be a list of serialized product objects')
+    promotion.apply(products)
+    return 200, {'products': [{'product_id': product['product_id'], 'price': product['price']}
+                              for product in products]}
+
+
+async def apply_best_promotions(request):
+    """ Applies the best active Promotion to each product of a cart """
+    lines = cart_lines(await read_json(request))
+    return 200, {'products': await store.best_prices(lines)}
+
+
+######################################################################
+# ASGI APPLICATION
+######################################################################
+async def app(scope, receive, send):
+    """ The ASGI application """
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    request = {
+        'method': scope['method'],
+        'path': scope['path'],
+        'query': {key: values[0] for key, values in
+                  parse_qs(scope.get('query_string', b'').decode('latin-1')).items()},
+        'headers': {key.decode('latin-1').lower(): value.decode('latin-1')
+                    for key, value in scope.get('headers', [])},
+        'receive': receive,
+    }
+    started = time.monotonic()
+    try:
+        status, body = await dispatch(request)
+    except HTTPError as error:
+        status, body = error.status, {'message': str(error)}
+    except DataValidationError as error:
+        status, body = 400, {'status_code': 400, 'error': 'Bad Request',
+                             'message': str(error)}
+    except (DatabaseConnectionError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+        message = str(error) or 'CouchDB did not answer: {}'.format(type(error).__name__)
+        logger.critical(message)
+        status, body = 503, {'status_code': 503, 'error': 'Service Unavailable',
+                             'message': message}
+    logger.debug('%s %s %d in %.3fs', request['method'], request['path'], status,
+                 time.monotonic() - started)
+
+    payload = json.dumps(body).encode('utf8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'application/json'),
+                            (b'content-length', str(len(payload)).encode('ascii'))]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def dispatch(request):
+    """ Routes a request to its endpoint """
+    method, path = request['method'], request['path'].rstrip('/') or '/'
+    if path == '/promotions':
+        if method == 'GET':
+            return await list_promotions(request)
+    elif path == '/promotions/apply':
+        if method == 'POST':
+            return await apply_best_promotions(request)
+    elif APPLY_PATH.match(path):
+        if method == 'POST':
+            return await apply_promotion(request, APPLY_PATH.match(path).group('promotion_id'))
+    elif PROMOTION_PATH.match(path):
+        if method == 'GET':
+            return await get_promotion(request, PROMOTION_PATH.match(path).group('promotion_id'))
+    else:
+        raise HTTPError(404, 'The requested URL was not found on the server.')
+    raise HTTPError(405, 'The method is not allowed for the requested URL.')
+
+
+async def lifespan(receive, send):
+    """ Opens the store when the server starts and closes it when it stops """
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            try:
+                await store.open()
+            except DatabaseConnectionError as error:
+                await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                return
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await store.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+######################################################################
+#  U T I L I T Y   F U N C T I O N S
+######################################################################
+async def read_json(request):
+    """ Reads the JSON body of a request """
+    if request['headers'].get('content-type') != 'application/json':
+        raise HTTPError(415, 'Content-Type must be application/json')
+    body = b''
+    while True:
+        message = await request['receive']()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    try:
+        return json.loads(body.decode('utf8'))
+    except ValueError:
+        raise DataValidationError('The request body is not valid JSON')
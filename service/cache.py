@@ -0,0 +1,89 @@
+"""
+Cache
+
+A small in-process cache used by the models to avoid fetching the same
+documents from CouchDB over and over again
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache():
+    """
+    A thread safe, bounded LRU cache whose entries go stale after a TTL
+
+    Stale entries are not thrown away right away: the caller can get them
+    with get_stale() and revalidate them (for example against the document
+    _rev) before calling touch() to make them fresh again.
+    """
+
+    def __init__(self, size=1024, ttl=5.0):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()   # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the fresh value cached for a key or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def get_stale(self, key):
+        """ Returns the value cached for a key even if its TTL has passed """
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[1] if entry else None
+
+    def put(self, key, value):
+        """ Caches a value, evicting the least recently used entries """
+        if self.size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def touch(self, key):
+        """ Makes a revalidated entry fresh again """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries[key] = (time.monotonic() + self.ttl, entry[1])
+                self._entries.move_to_end(key)
+                self.revalidations += 1
+
+    def invalidate(self, key):
+        """ Removes the entry for a key """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes all entries """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the counters of the cache """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidations': self.revalidations,
+                'evictions': self.evictions,
+            }
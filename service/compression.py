@@ -0,0 +1,260 @@
+"""
+Compression
+
+Compresses the JSON responses for the clients that accept it, and
+decompresses the request bodies that are sent compressed.
+
+The encoding is chosen from Accept-Encoding: brotli when the `brotli`
+module is installed, otherwise gzip. Responses of a known length are
+compressed whole, and only from COMPRESS_MIN_SIZE bytes. Streamed responses,
+like the NDJSON list, are compressed as they stream and flushed every
+COMPRESS_FLUSH_SIZE bytes, so the client gets the promotions while
+the later ones are read.
+
+A compressed response is a different representation than the identity
+one, so its strong ETag gets the coding appended, like "rev-gzip".
+Conditional requests accept these tags with etag_variants().
+
+Request bodies sent with Content-Encoding gzip or deflate, like large carts
+posted to the apply endpoints, are decompressed before they reach the
+service, up to COMPRESS_MAX_BODY bytes.
+"""
+import io
+import json
+import os
+import zlib
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:  # brotli is optional
+    brotli = None
+
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+COMPRESS_FLUSH_SIZE = int(os.environ.get('COMPRESS_FLUSH_SIZE', '16384'))
+COMPRESS_MAX_BODY = int(os.environ.get('COMPRESS_MAX_BODY', str(64 * 1024 * 1024)))
+
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+# every coding a response may have been compressed with, brotli installed or not
+RESPONSE_CODINGS = ('br', 'gzip')
+
+# wbits of zlib for each content coding of a request body
+REQUEST_ENCODINGS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+class GzipCompressor():
+    """ Streams gzip """
+
+    def __init__(self):
+        self.compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        """ Compresses a chunk, which may stay buffered """
+        return self.compressor.compress(data)
+
+    def flush(self):
+        """ Returns everything compressed so far """
+        return self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self.compressor.flush(zlib.Z_FINISH)
+
+
+class BrotliCompressor():
+    """ Streams brotli """
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=min(COMPRESS_LEVEL, 11))
+
+    def compress(self, data):
+        """ Compresses a chunk, which may stay buffered """
+        return self.compressor.process(data)
+
+    def flush(self):
+        """ Returns everything compressed so far """
+        return self.compressor.flush()
+
+    def finish(self):
+        """ Returns the end of the stream """
+        return self.compressor.finish()
+
+
+# the codings offered to the clients, the preferred one first
+COMPRESSORS = {'gzip': GzipCompressor}
+if brotli is not None:
+    COMPRESSORS = {'br': BrotliCompressor, 'gzip': GzipCompressor}
+
+
+def coded_etag(etag, coding):
+    """ Returns the ETag header of a response compressed with a coding """
+    if etag.startswith('"') and etag.endswith('"'):
+        return '{}-{}"'.format(etag[:-1], coding)
+    return etag  # weak tags may be shared by the codings
+
+
+def etag_variants(etag):
+    """ Returns an entity tag and the tags of its compressed representations """
+    return [etag] + ['{}-{}'.format(etag, coding) for coding in RESPONSE_CODINGS]
+
+
+class RequestBodyError(Exception):
+    """ Used when a compressed request body cannot be decompressed """
+
+    def __init__(self, status, message):
+        super(RequestBodyError, self).__init__(message)
+        self.status = status
+
+
+class CompressionMiddleware():
+    """ WSGI middleware that compresses responses and decompresses requests """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if environ.get('HTTP_CONTENT_ENCODING'):
+            try:
+                self.decompress_body(environ)
+            except RequestBodyError as error:
+                return self.error(start_response, error)
+
+        coding = self.negotiate(environ)
+        if coding is None:
+            return self.app(environ, start_response)
+
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return lambda data: response.setdefault('written', []).append(data)
+
+        result = self.app(environ, capture)
+        headers = Headers(response['headers'])
+        if not self.compressible(response['status'], headers):
+            start_response(response['status'], response['headers'])
+            return self.prepend(response.get('written'), result)
+
+        headers.add('Vary', 'Accept-Encoding')
+        length = headers.get('Content-Length', type=int)
+        if length is not None and length < COMPRESS_MIN_SIZE:
+            start_response(response['status'], headers.to_wsgi_list())
+            return self.prepend(response.get('written'), result)
+
+        headers['Content-Encoding'] = coding
+        if 'ETag' in headers:
+            headers['ETag'] = coded_etag(headers['ETag'], coding)
+        compressor = COMPRESSORS[coding]()
+        if length is None:
+            start_response(response['status'], headers.to_wsgi_list())
+            return self.stream(compressor, self.prepend(response.get('written'), result))
+
+        try:
+            body = b''.join(response.get('written', []) + list(result))
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        body = compressor.compress(body) + compressor.finish()
+        headers['Content-Length'] = str(len(body))
+        start_response(response['status'], headers.to_wsgi_list())
+        return [body]
+
+    @staticmethod
+    def negotiate(environ):
+        """ Returns the content coding to use for the response, or None """
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return None
+        accepted = environ.get('HTTP_ACCEPT_ENCODING')
+        if not accepted:
+            return None
+        return parse_accept_header(accepted).best_match(list(COMPRESSORS))
+
+    @staticmethod
+    def compressible(status, headers):
+        """ True for a response with a body of a textual type that is not encoded yet """
+        if status[:3] in ('204', '304') or 'Content-Encoding' in headers:
+            return False
+        return headers.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES)
+
+    @staticmethod
+    def prepend(written, result):
+        """ Returns the body with what was passed to write() in front of it """
+        if not written:
+            return result
+        return CompressionMiddleware.chain(written, result)
+
+    @staticmethod
+    def chain(written, result):
+        """ Yields what was written, then the body, and closes the body """
+        try:
+            for chunk in written:
+                yield chunk
+            for chunk in result:
+                yield chunk
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    @staticmethod
+    def stream(compressor, result):
+        """ Compresses a streamed body, flushing every COMPRESS_FLUSH_SIZE bytes """
+        pending = 0
+        try:
+            for chunk in result:
+                data = compressor.compress(chunk)
+                pending += len(chunk)
+                if pending >= COMPRESS_FLUSH_SIZE:
+                    data += compressor.flush()
+                    pending = 0
+                if data:
+                    yield data
+            yield compressor.finish()
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+    @staticmethod
+    def decompress_body(environ):
+        """ Replaces a compressed request body by its decompressed content """
+        coding = environ['HTTP_CONTENT_ENCODING'].strip().lower()
+        if coding == 'identity':
+            return
+        if coding not in REQUEST_ENCODINGS:
+            raise RequestBodyError('415 Unsupported Media Type',
+                                   'Content-Encoding {} is not supported'.format(coding))
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            raise RequestBodyError('400 Bad Request', 'Invalid Content-Length')
+        decompressor = zlib.decompressobj(REQUEST_ENCODINGS[coding])
+        try:
+            body = decompressor.decompress(environ['wsgi.input'].read(length),
+                                           COMPRESS_MAX_BODY + 1)
+        except zlib.error:
+            body = None
+        if body is None or (not decompressor.eof and len(body) <= COMPRESS_MAX_BODY):
+            raise RequestBodyError('400 Bad Request',
+                                   'The request body is not valid {}'.format(coding))
+        if len(body) > COMPRESS_MAX_BODY:
+            raise RequestBodyError('413 Request Entity Too Large',
+                                   'The decompressed request body is too large')
+        environ['wsgi.input'] = io.BytesIO(body)
+        environ['CONTENT_LENGTH'] = str(len(body))
+        del environ['HTTP_CONTENT_ENCODING']
+
+    @staticmethod
+    def error(start_response, error):
+        """ Answers a request whose body could not be decompressed """
+        body = json.dumps({'status_code': int(error.status[:3]), 'error': error.status[4:],
+                           'message': str(error)}).encode('utf8')
+        start_response(error.status, [('Content-Type', 'application/json'),
+                                      ('Content-Length', str(len(body)))])
+        return [body]
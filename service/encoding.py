@@ -0,0 +1,87 @@
+"""
+Encoding
+
+Serializers compiled from the flask-restplus models, and the JSON
+representation of the responses.
+
+flask-restplus marshals a response by asking every field object of the
+model for its value, one item and one field at a time, which costs more
+than reading the promotions when thousands of them are listed. A compiled
+serializer resolves the fields of a model once, into one conversion per
+field, and builds the same JSON shape: the keys of the model in order,
+None for a missing value and the same type conversions.
+"""
+import json
+from flask import current_app, make_response
+from flask_restplus import fields
+
+# compact and without the circular reference check: responses are trees
+ENCODER = json.JSONEncoder(separators=(',', ':'), check_circular=False)
+
+
+def _convert(kind):
+    """ Returns a conversion that leaves None and values of the right type alone """
+    def convert(value):
+        if value is None or value.__class__ is kind:
+            return value
+        return kind(value)
+    return convert
+
+
+def compile_field(field):
+    """ Returns a function that converts a value like the field formats it """
+    if isinstance(field, type):
+        field = field()
+    if isinstance(field, fields.Nested):
+        serialize = compile_model(field.nested)
+        empty = None if field.allow_null else serialize({})
+        return lambda value: empty if value is None else serialize(value)
+    if isinstance(field, fields.List):
+        item = compile_field(field.container)
+        return lambda value: None if value is None else [item(each) for each in value]
+    if isinstance(field, fields.String):
+        return _convert(str)
+    if isinstance(field, fields.Integer):
+        return _convert(int)
+    if isinstance(field, fields.Float):
+        return _convert(float)
+    if isinstance(field, fields.Boolean):
+        return _convert(bool)
+    return lambda value: None if value is None else field.format(value)
+
+
+def compile_model(model, names=None):
+    """
+    Returns a function that serializes one dict or object with a model
+
+    Only plain models are compiled: the fields may not use `attribute`,
+    `default` or a mask, which the service does not need. With `names`
+    only those fields of the model are serialized.
+    """
+    converters = []
+    for name, field in model.items():
+        if names is not None and name not in names:
+            continue
+        if isinstance(field, type):
+            field = field()
+        if field.attribute is not None or field.default is not None or field.mask:
+            raise ValueError('Field {} of model {} cannot be compiled'.format(name, model.name))
+        converters.append((name, compile_field(field)))
+
+    def serialize(item):
+        if isinstance(item, dict):
+            get = item.get
+            return {name: convert(get(name)) for name, convert in converters}
+        return {name: convert(getattr(item, name, None)) for name, convert in converters}
+    return serialize
+
+
+def output_json(data, code, headers=None):
+    """ Makes a response with a compact JSON body, indented in debug mode """
+    if current_app.debug:
+        dumped = json.dumps(data, indent=4)
+    else:
+        dumped = ENCODER.encode(data)
+    response = make_response(dumped + '\n', code)
+    response.headers.extend(headers or {})
+    return response
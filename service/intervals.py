@@ -0,0 +1,118 @@
+"""
+Intervals
+
+Per-code indexes of promotion date windows used to detect overlapping
+promotions without scanning every promotion having the same code
+"""
+import threading
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+
+
+class IntervalIndex():
+    """
+    The [start_date, expiry_date] windows of the promotions of one code
+
+    Windows are kept in a list sorted by start date. An overlap query
+    bisects for the last window starting before the end of the range and
+    walks back only as far as the longest window could reach, which is
+    O(log n) for the non-overlapping windows a code normally has.
+    """
+
+    def __init__(self):
+        self.windows = []   # sorted (start_date, expiry_date, promotion_id)
+        self.ids = {}       # promotion_id -> (start_date, expiry_date, promotion_id)
+        self.max_span = 0   # longest window ever added
+
+    def __len__(self):
+        return len(self.windows)
+
+    def add(self, promotion_id, start_date, expiry_date):
+        """ Adds (or moves) the window of a promotion """
+        self.remove(promotion_id)
+        window = (start_date, expiry_date, promotion_id)
+        insort(self.windows, window)
+        self.ids[promotion_id] = window
+        self.max_span = max(self.max_span, expiry_date - start_date)
+
+    def remove(self, promotion_id):
+        """ Removes the window of a promotion """
+        window = self.ids.pop(promotion_id, None)
+        if window is not None:
+            position = bisect_left(self.windows, window)
+            del self.windows[position]
+
+    def overlapping(self, start_date, expiry_date, exclude=None):
+        """
+        Returns the id of a promotion overlapping [start_date, expiry_date]
+
+        Args:
+            exclude (str): The id of a promotion to ignore (the one being updated)
+        """
+        position = bisect_right(self.windows, (expiry_date, float('inf'), '')) - 1
+        while position >= 0:
+            start, expiry, promotion_id = self.windows[position]
+            if start + self.max_span < start_date:
+                break
+            if expiry >= start_date and promotion_id != exclude:
+                return promotion_id
+            position -= 1
+        return None
+
+
+class CodeIntervals():
+    """ Thread safe interval indexes of all promotion codes """
+
+    def __init__(self):
+        self.indexes = defaultdict(IntervalIndex)
+        self.lock = threading.Lock()
+
+    def apply(self, old, new):
+        """
+        Moves a promotion from its old document to its new one
+
+        Args:
+            old (dict): The document before the change or None
+            new (dict): The document after the change or None when deleted
+        """
+        with self.lock:
+            if old is not None:
+                self.indexes[old.get('code')].remove(old['_id'])
+            if new is not None and _has_window(new):
+                self.indexes[new['code']].add(new['_id'], int(new['start_date']),
+                                              int(new['expiry_date']))
+
+    def overlapping(self, code, start_date, expiry_date, exclude=None):
+        """ Returns the id of a promotion with this code overlapping the range """
+        with self.lock:
+            index = self.indexes.get(code)
+            if index is None:
+                return None
+            return index.overlapping(start_date, expiry_date, exclude)
+
+    def clear(self):
+        """ Removes every window """
+        with self.lock:
+            self.indexes.clear()
+
+
+def _has_window(document):
+    """ True when a document has a code and numeric dates """
+    try:
+        return document.get('code') is not None and \
+            int(document['start_date']) <= int(document['expiry_date'])
+    except (KeyError, TypeError, ValueError):
+        return False
+
+
+class CodeLocks():
+    """ One lock per promotion code, for writers validating the same code """
+
+    def __init__(self):
+        self.locks = defaultdict(threading.Lock)
+        self.lock = threading.Lock()
+
+    def __call__(self, code):
+        """ Returns the lock of a code """
+        with self.lock:
+            return self.locks[code]
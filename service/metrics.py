@@ -0,0 +1,211 @@
+"""
+Metrics
+
+Counters, gauges and histograms rendered in the Prometheus text format.
+
+Recording a value takes a lock and, for a histogram, a bisect on its
+buckets, so the instrumentation can stay on in production. The values
+belong to the process: with several gunicorn workers each one reports its
+own, so the scraper should reach every worker or sum what it gets.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a cache hit to a slow bulk write
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Metric():
+    """ A metric with a value for each combination of its labels """
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def samples(self):
+        """ Yields the name, the labels and the value of every sample """
+        raise NotImplementedError
+
+    def render(self):
+        """ Returns the metric in the Prometheus text format """
+        lines = ['# HELP {} {}'.format(self.name, self.documentation),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, labels, value in self.samples():
+            lines.append('{}{} {}'.format(name, _labels(labels), _value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """ A value that only goes up """
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        """ Adds to the value of the labels """
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        """ Returns the value of the labels """
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for labels, value in values:
+            yield self.name, zip(self.labels, labels), value
+
+
+class Gauge(Counter):
+    """ A value that goes up and down """
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        """ Takes from the value of the labels """
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """ Counts the observed values in cumulative buckets, with their sum """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        """ Records a value for the labels """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """ Observes how long the block takes """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels):
+        """ Returns how many values were observed for the labels """
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def samples(self):
+        with self.lock:
+            values = sorted((labels, list(counts)) for labels, counts in self.values.items())
+        for labels, counts in values:
+            pairs = list(zip(self.labels, labels))
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                yield self.name + '_bucket', pairs + [('le', bound)], total
+            yield self.name + '_count', pairs, total
+            yield self.name + '_sum', pairs, counts[-1]
+
+
+class Registry():
+    """ The metrics of the process """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        """ Adds a metric and returns it """
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """ Returns every metric in the Prometheus text format """
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
+
+
+def _labels(pairs):
+    """ Formats the labels of a sample """
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, _escape(_value(value)))
+                          for name, value in pairs) + '}'
+
+
+def _escape(value):
+    """ Escapes a label value """
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _value(value):
+    """ Formats a number like Prometheus does """
+    if isinstance(value, str):
+        return value
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return repr(value)
+    return str(value)
+
+
+######################################################################
+#  M E T R I C S   O F   T H E   S E R V I C E
+######################################################################
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'promotion_http_request_duration_seconds',
+    'Time spent answering HTTP requests, by endpoint and method',
+    ('endpoint', 'method')))
+HTTP_REQUESTS = REGISTRY.register(Counter(
+    'promotion_http_requests_total',
+    'HTTP requests answered, by endpoint, method and status',
+    ('endpoint', 'method', 'status')))
+HTTP_IN_FLIGHT = REGISTRY.register(Gauge(
+    'promotion_http_requests_in_flight',
+    'HTTP requests being answered'))
+DB_CALL_SECONDS = REGISTRY.register(Histogram(
+    'promotion_db_call_duration_seconds',
+    'Time spent in database calls, by backend and operation',
+    ('backend', 'operation')))
+DB_ERRORS = REGISTRY.register(Counter(
+    'promotion_db_errors_total',
+    'Database calls that raised an error, by backend and operation',
+    ('backend', 'operation')))
+DB_RETRIES_429 = REGISTRY.register(Counter(
+    'promotion_db_429_retries_total',
+    'Database requests replayed after a 429 Too Many Requests'))
+
+
+def db_call(operation):
+    """
+    Decorator that times the calls of a storage method
+
+    The backend label is the name of the storage the method is called on.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(storage, *args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(storage, *args, **kwargs)
+            except Exception:
+                DB_ERRORS.inc(storage.name, operation)
+                raise
+            finally:
+                DB_CALL_SECONDS.observe(time.perf_counter() - started, storage.name, operation)
+        return wrapper
+    return decorator
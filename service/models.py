@@ -22,47 +22,117 @@ All models should be defined here
 """
 
 import os
-import sys
 import time
-import json
 import logging
-from cloudant.client import Cloudant
-from cloudant.query import Query
-from requests import HTTPError, ConnectionError
-from cloudant.adapters import Replay429Adapter
+import threading
+from collections import defaultdict
+from contextlib import ExitStack, contextmanager
+from requests import HTTPError
+from service import storage as backends
+from service.active import ActiveSet
+from service.cache import LRUCache
+from service.intervals import CodeLocks
+from service.pricing import ProductIndex
+from service.replica import Replica
+from service.sqlite import SQLiteStorage
+from service.storage import INDEX_DESIGN_DOC, CloudantStorage, \
+    DatabaseConnectionError, DataConflictError, InvalidBookmarkError
 
 # get configruation from enviuronment (12-factor)
-ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
-CLOUDANT_HOST = os.environ.get('CLOUDANT_HOST', 'localhost')
-CLOUDANT_USERNAME = os.environ.get('CLOUDANT_USERNAME', 'admin')
-CLOUDANT_PASSWORD = os.environ.get('CLOUDANT_PASSWORD', 'pass')
+STORAGE_BACKEND = os.environ.get('PROMOTION_BACKEND', 'cloudant').lower()
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', '500'))
+PAGE_SIZE = int(os.environ.get('PAGE_SIZE', '200'))
+CACHE_SIZE = int(os.environ.get('PROMOTION_CACHE_SIZE', '1024'))
+CACHE_TTL = float(os.environ.get('PROMOTION_CACHE_TTL', '5'))
+REPLICA_ENABLED = os.environ.get('PROMOTION_REPLICA', 'False').lower() == 'true'
+REPLICA_MAX_LAG = float(os.environ.get('PROMOTION_REPLICA_MAX_LAG', '30'))
+REPLICA_POLL_TIMEOUT = float(os.environ.get('PROMOTION_REPLICA_POLL_TIMEOUT', '25'))
+PRODUCT_INDEX_TTL = float(os.environ.get('PRODUCT_INDEX_TTL', '30'))
+ACTIVE_SET_TTL = float(os.environ.get('ACTIVE_SET_TTL', '30'))
+RESET_STRATEGY = os.environ.get('RESET_STRATEGY', 'bulk').lower()
 
+# the promotion being written and the first other one that could overlap it
+OVERLAP_LIMIT = 2
 
-class DatabaseConnectionError(Exception):
-    """ Custom Exception when database connection fails """
+# the fields of a Promotion, in the order they are serialized
+FIELDS = ('id', 'code', 'percentage', 'products', 'start_date', 'expiry_date')
+
+CONFLICT_MESSAGE = 'This new/updated promotion conflicts with promotion({})'
+BATCH_CONFLICT_MESSAGE = 'This new promotion conflicts with promotion {} of the batch'
+
+# the storage backends that PROMOTION_BACKEND can name
+BACKENDS = {
+    CloudantStorage.name: CloudantStorage,
+    SQLiteStorage.name: SQLiteStorage,
+}
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+def cart_lines(data):
+    """
+    Returns the lines of a posted cart as dicts with a product_id and a price
+
+    Args:
+        data (dict): The posted cart, with a list of products
+    """
+    products = data.get('products') if isinstance(data, dict) else None
+    if not isinstance(products, list):
+        raise DataValidationError('The cart should have a list of products')
+    lines = []
+    for product in products:
+        try:
+            lines.append({'product_id': product['product_id'],
+                          'price': float(product['price'])})
+        except (KeyError, TypeError):
+            raise DataValidationError('Each product needs a product_id and a price')
+        except ValueError:
+            raise DataValidationError(
+                'The given product prices cannot convert to a float number')
+    return lines
+
+
+@contextmanager
+def untimed(_):
+    """ Runs a stage of init_db that nobody is timing """
+    yield
+
+
 class Promotion():
     """
     Class that represents a Promotion
 
-    This version uses a NoSQL database CouchDB for persistence
-    which is hidden from us by using Cloudant library
+    The documents are kept by the storage backend named by
+    PROMOTION_BACKEND: CouchDB through the Cloudant library, or SQLite
+
+    Its fields live in slots and its products in a tuple, since whole
+    lists of promotions are built for every list response and kept in
+    the in-process indexes.
     """
+    __slots__ = ('id', 'rev', 'code', 'products', 'percentage', 'expiry_date',
+                 'start_date')
     logger = logging.getLogger('flask.app')
-    client = None   # cloudant.client.Cloudant
-    database = None  # cloudant.database.CloudantDatabase
+    storage = None  # service.storage.Storage of this process
+    cache = LRUCache(CACHE_SIZE, CACHE_TTL)  # documents read by find()
+    replica = None  # service.replica.Replica when PROMOTION_REPLICA is on
+    code_locks = CodeLocks()  # serializes validate-and-write per code
+    product_index = None  # service.pricing.ProductIndex used without a replica
+    product_index_lock = threading.Lock()
+    index_builds = []  # (name, documents written meanwhile) of the indexes being built
+    index_builds_lock = threading.Lock()
+    active_promotions = None  # service.active.ActiveSet used without a replica
+    active_promotions_lock = threading.Lock()
+    init_lock = threading.RLock()  # serializes init_db
 
     def __init__(self, code=None, products=None,
                  percentage=None, expiry_date=None, start_date=None):
         """ Constructor """
         self.id = None
+        self.rev = None     # the _rev of the document it was read from
         self.code = code
-        self.products = products
+        self.products = None if products is None else tuple(products)
         self.percentage = percentage
         self.expiry_date = expiry_date
         self.start_date = start_date
@@ -71,29 +141,79 @@ class Promotion():
         """
         Creates a new Promotion in the database
         """
-        self.validate()
+        with self.code_locks(self.code):
+            self.validate()
 
-        try:
-            document = self.database.create_document(self.serialize())
-        except HTTPError as err:
-            Promotion.logger.warning('Create failed: %s', err)
-            return
+            document = self.serialize()
+            try:
+                self.id, self.rev = self.storage.create(document)
+            except HTTPError as err:
+                Promotion.logger.warning('Create failed: %s', err)
+                return
+
+            document = dict(document, _id=self.id, _rev=self.rev)
+            self.replicate(document)
 
-        if document.exists():
-            self.id = document['_id']
+            conflict = self.find_conflict()
+            if conflict is not None:
+                self._roll_back_create()
+                raise DataValidationError(CONFLICT_MESSAGE.format(conflict))
+
+    def _roll_back_create(self):
+        """ Deletes the document this Promotion was just created as """
+        self._delete(self.rev)
+        self.id = None
+        self.rev = None
 
     def update(self):
-        """ Updates a Promotion in the database """
-        self.validate()
+        """
+        Updates a Promotion in the database
 
-        if self.id:
-            try:
-                document = self.database[self.id]
-            except KeyError:
-                document = None
-            if document:
-                document.update(self.serialize())
-                document.save()
+        The document is written directly with the _rev this Promotion was
+        read with, so a DataConflictError is raised if it was changed since.
+        Without a _rev the current revision is replaced. An update that
+        overlaps another promotion is rolled back to the document it
+        replaced.
+        """
+        with self.code_locks(self.code):
+            self.validate()
+
+            if self.id:
+                if self.rev is None:
+                    previous = Promotion.find_document(self.id, fresh=True)
+                else:
+                    previous = Promotion.find_document(self.id)
+                    if previous is not None and previous['_rev'] != self.rev:
+                        # the copy read is not the revision this update replaces
+                        previous = Promotion.find_document(self.id, fresh=True)
+                if previous is None:
+                    return
+                rev = self.rev or previous['_rev']
+                document = dict(previous, **self.serialize())
+                document['_rev'] = rev
+                self._put(document)
+
+                conflict = self.find_conflict()
+                if conflict is not None:
+                    self._restore(previous)
+                    raise DataValidationError(CONFLICT_MESSAGE.format(conflict))
+
+    def _put(self, document):
+        """ Writes a document with its _rev and keeps the new one """
+        document = dict(document, _id=self.id)
+        document['_rev'] = self.storage.put(document)
+        self.rev = document['_rev']
+        self.cache.put(self.id, document)
+        self.replicate(document)
+
+    def _restore(self, previous):
+        """ Writes back the document that a rolled back update replaced """
+        try:
+            self._put(dict(previous, _rev=self.rev))
+        except DataConflictError:
+            # written again since, so the rolled back revision is not current anymore
+            Promotion.logger.warning('Promotion %s changed before its update was rolled back',
+                                     self.id)
 
     def save(self):
         """ Saves a Promotion in the database """
@@ -105,15 +225,44 @@ class Promotion():
     def delete(self):
         """ Deletes a Promotion from the database """
         if self.id:
-            try:
-                document = self.database[self.id]
-            except KeyError:
-                document = None
-            if document:
-                document.delete()
+            rev = self.rev
+            if rev is None:
+                document = Promotion.find_document(self.id)
+                rev = document['_rev'] if document else None
+            if rev is not None and self._delete(rev) is None:
+                # it was changed since it was read, delete the latest revision
+                document = Promotion.find_document(self.id, fresh=True)
+                if document is not None:
+                    self._delete(document['_rev'])
+            self.cache.invalidate(self.id)
+
+    def _delete(self, rev):
+        """ Deletes a revision of the document and returns the _rev of the tombstone """
+        deleted_rev = self.storage.delete(self.id, rev)
+        if deleted_rev is not None:
+            self.replicate({'_id': self.id, '_rev': deleted_rev, '_deleted': True})
+        return deleted_rev
 
     def validate(self):
-        """ object fields validation """
+        """
+        object fields validation
+
+        Overlaps are checked against the interval index of the replica when
+        it is current, which costs no round trip. Either way the writes run
+        find_conflict() after they are made, which also sees the writes of
+        the other processes.
+        """
+        self.validate_fields()
+
+        replica = Promotion.current_replica()
+        if replica is not None:
+            conflict = replica.intervals.overlapping(
+                self.code, self.start_date, self.expiry_date, exclude=self.id)
+            if conflict is not None:
+                raise DataValidationError(CONFLICT_MESSAGE.format(conflict))
+
+    def validate_fields(self):
+        """ Validates the fields of this promotion without touching the database """
         if self.code is None or self.code == '':
             raise DataValidationError('code attribute is not set')
         if self.products is None:
@@ -130,22 +279,58 @@ class Promotion():
             raise DataValidationError(
                 'Percentage should be in the range of 0 to 100')
 
-        # Check if this promotion conflicts with any existing promotions
-        promotions = Promotion.find_by_code(self.code)
+    def check_conflicts(self, promotions):
+        """
+        Checks that this promotion does not conflict with the given promotions
+
+        Args:
+            promotions (list): Promotions having the same code as this one
+        """
+        promotion = self.conflicting(promotions)
+        if promotion is not None:
+            raise DataValidationError(CONFLICT_MESSAGE.format(promotion.id))
+
+    def conflicting(self, promotions):
+        """
+        Returns the first of the given promotions that overlaps this one, or None
+
+        Args:
+            promotions (list): Promotions having the same code as this one
+        """
         for promotion in promotions:
             if self.id is not None and self.id == promotion.id:
                 continue
 
-            if (promotion.start_date <= self.start_date and self.start_date <= promotion.expiry_date) or \
-                (promotion.start_date <= self.expiry_date and self.expiry_date <= promotion.expiry_date):
-                raise DataValidationError('This new/updated promotion conflicts with promotion({})'.format(promotion.id))
+            if promotion.start_date <= self.expiry_date and \
+                    self.start_date <= promotion.expiry_date:
+                return promotion
+        return None
+
+    def find_conflict(self):
+        """
+        Returns the id of a saved promotion that overlaps this one, or None
+
+        Writers run this after their write, so that it also sees the
+        promotions other processes are saving at the same time, and roll
+        their write back when it finds one. The interval index of a current
+        replica answers it, otherwise a bounded indexed query does.
+        """
+        replica = Promotion.current_replica()
+        if replica is not None:
+            return replica.intervals.overlapping(
+                self.code, self.start_date, self.expiry_date, exclude=self.id)
+        for promotion in Promotion.find_overlapping(self.code, self.start_date,
+                                                    self.expiry_date):
+            if promotion.id != self.id:
+                return promotion.id
+        return None
 
     def serialize(self):
         """ Serializes a Promotion into a dictionary """
         return {
             "id": self.id,
             "code": self.code,
-            "products": self.products,
+            "products": None if self.products is None else list(self.products),
             "percentage": self.percentage,
             "expiry_date": self.expiry_date,
             "start_date": self.start_date,
@@ -163,155 +348,699 @@ class Promotion():
             self.percentage = int(data['percentage'])
             self.expiry_date = int(data['expiry_date'])
             self.start_date = int(data['start_date'])
-            self.products = data['products']
+            products = data['products']
         except KeyError as error:
             raise DataValidationError(
                 'Invalid promotion: missing ' + error.args[0])
         except ValueError as error:
             raise DataValidationError(
                 'Invalid promotion value: ' + error.args[0])
+        if products is not None and not isinstance(products, (list, tuple)):
+            raise DataValidationError('Invalid promotion: products should be a list')
+        self.products = None if products is None else tuple(products)
 
         # if there is no id and the data has one, assign it
         if not self.id and '_id' in data:
             self.id = data['_id']
+        if '_rev' in data:
+            self.rev = data['_rev']
 
         return self
-    
-    def is_active(self):
+
+    @classmethod
+    def from_document(cls, document):
+        """
+        Returns the Promotion stored in a database document
+
+        The document was validated by deserialize() before it was written,
+        so its fields are copied as they are, without the checks and
+        conversions of deserialize().
+
+        Args:
+            document (dict): A document with its _id and _rev
+        """
+        promotion = cls.__new__(cls)
+        get = document.get
+        products = get('products')
+        promotion.id = get('_id')
+        promotion.rev = get('_rev')
+        promotion.code = get('code')
+        promotion.products = None if products is None else tuple(products)
+        promotion.percentage = get('percentage')
+        promotion.expiry_date = get('expiry_date')
+        promotion.start_date = get('start_date')
+        return promotion
+
+    def apply(self, products):
+        """
+        Applies this promotion to a list of products with their prices
+
+        The price of each eligible product is updated in place, the other
+        products keep their price.
+
+        Args:
+            products (list): dicts with a product_id and a price
+        Returns:
+            The ids of the products that are not eligible
+        """
+        eligible_ids = set(self.products)
+        non_eligible_ids = []
+        for product in products:
+            product_id = product['product_id']
+            try:
+                new_price = float(product['price'])
+            except ValueError:
+                raise DataValidationError(
+                    'The given product prices cannot convert to a float number')
+            if product_id in eligible_ids:
+                new_price = new_price * (self.percentage / 100.0)
+            else:
+                non_eligible_ids.append(product_id)
+            product['price'] = new_price
+        return non_eligible_ids
+
+    def is_active(self, at=None):
         """
         A promotion is active if the current timestamp is in its range [start_date, expiry_date]
+
+        Args:
+            at (int): The timestamp to check instead of the current one
         """
-        now_ts = time.time()
+        now_ts = time.time() if at is None else at
         return self.start_date <= now_ts and now_ts <= self.expiry_date
 
 ######################################################################
 #  S T A T I C   D A T A B S E   M E T H O D S
 ######################################################################
+    @classmethod
+    def current_replica(cls):
+        """ Returns the replica if it can answer queries, otherwise None """
+        replica = cls.replica
+        if replica is not None and replica.is_current():
+            return replica
+        return None
+
+    @classmethod
+    def replicate(cls, document):
+        """ Applies a local write to the replica and the product index """
+        if cls.replica is not None:
+            cls.replica.apply(document)
+        if cls.index_builds:
+            with cls.index_builds_lock:
+                for _, written in cls.index_builds:
+                    written.append(document)
+        if cls.product_index is not None:
+            cls.product_index.apply(document)
+        if cls.active_promotions is not None:
+            cls.active_promotions.apply(document)
+
+    @classmethod
+    def build_index(cls, name, load, build=None):
+        """
+        Loads an in-process index and swaps it in for the current one
+
+        The writes this process makes while the index loads are applied to
+        it before the swap, so none of them is lost. The index is dropped
+        if the current one was replaced in the meantime (by a reset).
+
+        Args:
+            name (str): The class attribute holding the index
+            load (function): Returns a new index read from the database
+            build (tuple): The entry of index_builds, registered by the caller
+        Returns:
+            The index in place afterwards
+        """
+        current = getattr(cls, name)
+        if build is None:
+            build = (name, [])
+            with cls.index_builds_lock:
+                cls.index_builds.append(build)
+        try:
+            index = load()
+        except Exception:
+            with cls.index_builds_lock:
+                cls.index_builds.remove(build)
+            raise
+        with cls.index_builds_lock:
+            cls.index_builds.remove(build)
+            if getattr(cls, name) is not current:
+                if hasattr(index, 'stop'):
+                    index.stop()
+                return getattr(cls, name)
+            for document in build[1]:
+                index.apply(document)
+            setattr(cls, name, index)
+        if hasattr(current, 'stop'):
+            current.stop()
+        return index
+
+    @classmethod
+    def refresh_index(cls, name, load):
+        """
+        Loads an in-process index again on a background thread
+
+        Requests keep using the current index until the new one is swapped
+        in. Returns the thread, or None when the index is already loading.
+        """
+        with cls.index_builds_lock:
+            if any(building == name for building, _ in cls.index_builds):
+                return None
+            build = (name, [])
+            cls.index_builds.append(build)
+
+        def run():
+            try:
+                cls.build_index(name, load, build)
+            except Exception as error:   # pylint: disable=broad-except
+                cls.logger.warning('Loading the %s failed: %s', name, error)
+        thread = threading.Thread(target=run, name='promotion-' + name, daemon=True)
+        thread.start()
+        return thread
+
+    @classmethod
+    def load_product_index(cls):
+        """ Returns a product index of all the promotions """
+        index = ProductIndex()
+        for promotion in cls.iterate():
+            index.apply(dict(promotion.serialize(), _id=promotion.id))
+        return index
+
+    @classmethod
+    def pricing_index(cls):
+        """
+        Returns the product index used to price carts
+
+        The replica keeps its own index current from the _changes feed.
+        Without it, an index is built from all the promotions and kept
+        current with the writes of this process. Once it is older than
+        PRODUCT_INDEX_TTL it is loaded again on a background thread, to
+        pick up the writes of other processes, while requests keep using it.
+        """
+        replica = cls.current_replica()
+        if replica is not None:
+            return replica.products
+        index = cls.product_index
+        if index is None:
+            with cls.product_index_lock:
+                index = cls.product_index
+                if index is None:
+                    index = cls.build_index('product_index', cls.load_product_index)
+        elif index.age() > PRODUCT_INDEX_TTL:
+            cls.refresh_index('product_index', cls.load_product_index)
+        return index
+
+    @classmethod
+    def load_active_set(cls):
+        """ Returns a set of the promotions that have not expired yet """
+        promotions = cls.find_by(expiry_date={'$gte': int(time.time())},
+                                 start_date={'$exists': True})
+        return ActiveSet().load([dict(promotion.serialize(), _id=promotion.id)
+                                 for promotion in promotions])
+
+    @classmethod
+    def active_set(cls):
+        """
+        Returns the set of active promotions
+
+        The replica keeps its own set current from the _changes feed.
+        Without it, the set is loaded with the promotions that have not
+        expired yet (an indexed query on the dates), kept current with the
+        writes of this process and by its timer as dates pass. Once it is
+        older than ACTIVE_SET_TTL it is loaded again on a background thread,
+        to pick up the writes of other processes, while requests keep
+        using it.
+        """
+        replica = cls.current_replica()
+        if replica is not None:
+            return replica.active
+        active = cls.active_promotions
+        if active is None:
+            with cls.active_promotions_lock:
+                active = cls.active_promotions
+                if active is None:
+                    active = cls.build_index('active_promotions', cls.load_active_set)
+        elif active.age() > ACTIVE_SET_TTL:
+            cls.refresh_index('active_promotions', cls.load_active_set)
+        return active
+
+    @classmethod
+    def stop_active_set(cls):
+        """ Drops the process-local set of active promotions """
+        if cls.active_promotions is not None:
+            cls.active_promotions.stop()
+            cls.active_promotions = None
+
+    @classmethod
+    def best_prices(cls, lines):
+        """
+        Applies the best active promotion to each line of a cart
+
+        Args:
+            lines (list): dicts with a product_id and a float price
+        """
+        return cls.pricing_index().price(lines)
+
+    @classmethod
+    def start_replica(cls):
+        """ Starts following the _changes feed into a new replica """
+        if cls.replica is not None:
+            cls.replica.stop()
+        cls.replica = Replica(cls.storage.database,
+                              poll_timeout=REPLICA_POLL_TIMEOUT,
+                              max_lag=REPLICA_MAX_LAG).start()
+
     @classmethod
     def connect(cls):
         """ Connect to the server """
-        cls.client.connect()
+        cls.storage.connect()
 
     @classmethod
     def disconnect(cls):
         """ Disconnect from the server """
-        cls.client.disconnect()
+        cls.storage.close()
 
     @classmethod
-    def remove_all(cls):
-        """ Removes all documents from the database (use for testing)  """
-        for document in cls.database:
-            document.delete()
+    def remove_all(cls, strategy=None):
+        """
+        Removes all documents from the database (use for testing)
+
+        With the 'bulk' strategy the documents are deleted a chunk at a
+        time. With the 'recreate' strategy the database is dropped and
+        created again with its indexes, which takes the same time however
+        many documents there are.
+
+        Args:
+            strategy (str): 'bulk' or 'recreate', RESET_STRATEGY by default
+        Returns:
+            A dict with the number of documents removed and the seconds it took
+        """
+        strategy = strategy or RESET_STRATEGY
+        if strategy not in ('bulk', 'recreate'):
+            raise DataValidationError('Unknown reset strategy: {}'.format(strategy))
+        started = time.monotonic()
+        removed = cls.storage.remove_all(strategy, BULK_CHUNK_SIZE)
+        if cls.replica is not None:
+            cls.replica.reset()
+
+        # forget the documents held by the client and the in-process indexes
+        cls.storage.forget()
+        cls.cache.clear()
+        cls.product_index = None
+        cls.stop_active_set()
+        seconds = time.monotonic() - started
+        Promotion.logger.info('Removed %d promotions in %.3fs (%s)', removed, seconds, strategy)
+        return {'removed': removed, 'seconds': seconds, 'strategy': strategy}
 
     @classmethod
-    def all(cls):
-        """ Query that returns all Promotions """
-        results = []
-        for doc in cls.database:
-            promotion = Promotion().deserialize(doc)
-            promotion.id = doc['_id']
-            results.append(promotion)
+    def create_many(cls, promotions, chunk_size=None):
+        """
+        Creates many Promotions using one bulk write per chunk
+
+        The whole batch is validated in memory: each promotion is checked
+        against the existing promotions with the same code (fetched with a
+        single query) and against the promotions before it in the batch.
+        A result is returned for every promotion, in order, so that a bad
+        record does not fail the whole batch.
+
+        The locks of the codes of the batch are held meanwhile, and like
+        create() every written promotion is checked for overlaps once
+        more afterwards, so that one saved at the same time by another
+        process rolls it back.
+
+        Args:
+            promotions (list): Promotion objects that are not saved yet
+            chunk_size (int): Number of documents sent per bulk write
+        """
+        chunk_size = chunk_size or BULK_CHUNK_SIZE
+        results, valid = cls.validate_batch(promotions)
+
+        codes = sorted({promotion.code for _, promotion in valid})
+        with ExitStack() as stack:
+            for code in codes:
+                stack.enter_context(cls.code_locks(code))
+
+            # Check for conflicts with existing promotions and within the batch
+            existing = cls.find_by(code={'$in': codes}) if codes else []
+            accepted = cls.accept_batch(valid, existing, results)
+
+            for start in range(0, len(accepted), chunk_size):
+                chunk = accepted[start:start + chunk_size]
+                try:
+                    rows = cls.storage.bulk_docs([p.serialize() for _, p in chunk])
+                except HTTPError as err:
+                    Promotion.logger.warning('Bulk create failed: %s', err)
+                    for index, _ in chunk:
+                        results[index] = {'id': None, 'ok': False, 'error': str(err)}
+                    continue
+                cls.record_bulk_rows(chunk, rows, results)
+
+            for index, promotion in accepted:
+                conflict = promotion.find_conflict() if promotion.id else None
+                if conflict is not None:
+                    promotion._roll_back_create()
+                    results[index] = {'id': None, 'ok': False,
+                                      'error': CONFLICT_MESSAGE.format(conflict)}
         return results
 
+    @staticmethod
+    def validate_batch(promotions):
+        """
+        Validates the fields of a batch of Promotions
+
+        Returns the list of results, with the failures filled in, and the
+        (index, promotion) pairs of the valid Promotions.
+        """
+        results = [None] * len(promotions)
+        valid = []
+        for index, promotion in enumerate(promotions):
+            try:
+                promotion.validate_fields()
+            except DataValidationError as error:
+                results[index] = {'id': None, 'ok': False, 'error': str(error)}
+                continue
+            valid.append((index, promotion))
+        return results, valid
+
+    @staticmethod
+    def accept_batch(valid, existing, results):
+        """
+        Checks valid Promotions for conflicts with the existing ones and
+        with the ones before them in the batch
+
+        Returns the (index, promotion) pairs that can be written. A
+        conflict with a promotion of the batch names its index.
+        """
+        by_code = defaultdict(list)
+        for promotion in existing:
+            by_code[promotion.code].append(promotion)
+        positions = {}  # id() of the accepted promotions -> index in the batch
+        accepted = []
+        for index, promotion in valid:
+            other = promotion.conflicting(by_code[promotion.code])
+            if other is not None:
+                if id(other) in positions:
+                    message = BATCH_CONFLICT_MESSAGE.format(positions[id(other)])
+                else:
+                    message = CONFLICT_MESSAGE.format(other.id)
+                results[index] = {'id': None, 'ok': False, 'error': message}
+                continue
+            by_code[promotion.code].append(promotion)
+            positions[id(promotion)] = index
+            accepted.append((index, promotion))
+        return accepted
+
+    @classmethod
+    def record_bulk_rows(cls, chunk, rows, results):
+        """ Records the bulk write rows of a chunk in the results """
+        for (index, promotion), row in zip(chunk, rows):
+            if 'error' in row:
+                results[index] = {'id': None, 'ok': False,
+                                  'error': row.get('reason') or row['error']}
+            else:
+                promotion.id = row['id']
+                promotion.rev = row['rev']
+                cls.replicate(dict(promotion.serialize(), _id=row['id'], _rev=row['rev']))
+                results[index] = {'id': row['id'], 'ok': True, 'error': None}
+
+    @staticmethod
+    def document_fields(fields):
+        """
+        Returns the document fields to read for some Promotion fields
+
+        The _id and _rev are always read. None stands for every field.
+
+        Args:
+            fields (list): Names from FIELDS, or None
+        """
+        if fields is None:
+            return None
+        return ['_id', '_rev'] + [name for name in fields if name != 'id']
+
+    @classmethod
+    def all(cls, fields=None):
+        """
+        Query that returns all Promotions
+
+        Args:
+            fields (list): The only fields to read, the others are None
+        """
+        replica = cls.current_replica()
+        if replica is not None:
+            return [Promotion.from_document(doc) for doc in replica.all()]
+        return list(cls.iterate(fields=fields))
+
+    @classmethod
+    def iterate(cls, chunk_size=None, fields=None, **kwargs):
+        """
+        Generator that yields Promotions, reading them one page at a time
+
+        Only one page of Promotions is held in memory at any time, so it
+        can walk the whole database however large it grows.
+
+        Args:
+            chunk_size (int): Number of Promotions read per request
+            fields (list): The only fields to read, the others are None
+        """
+        chunk_size = chunk_size or PAGE_SIZE
+        promotions, next_key = cls.page(chunk_size, fields=fields, **kwargs)
+        while True:
+            for promotion in promotions:
+                yield promotion
+            if next_key is None:
+                return
+            promotions, next_key = cls.page(chunk_size, next_key, fields=fields, **kwargs)
+
+    @classmethod
+    def page(cls, limit, start_key=None, fields=None, **kwargs):
+        """
+        Query that returns one page of Promotions and the key of the next page
+
+        Without a selector the page is read in id order, starting at the
+        document id `start_key`. With a selector the page comes from a
+        Mango query and `start_key` is its bookmark.
+        The returned key is None when there are no more pages.
+
+        Args:
+            limit (int): The maximum number of Promotions in the page
+            start_key (str): The key returned with the previous page
+            fields (list): The only fields to read, the others are None
+        """
+        document_fields = cls.document_fields(fields)
+        if kwargs:
+            try:
+                documents, bookmark = cls.storage.find(kwargs, limit, start_key,
+                                                       fields=document_fields)
+            except InvalidBookmarkError:
+                raise DataValidationError('Invalid page key: {}'.format(start_key))
+            return [Promotion.from_document(doc) for doc in documents], bookmark
+
+        # Read one extra promotion to find where the next page starts
+        promotions = [Promotion.from_document(doc) for doc in
+                      cls.storage.all_docs(limit + 1, start_key, fields=document_fields)]
+        next_key = None
+        if len(promotions) > limit:
+            next_key = promotions.pop().id
+        return promotions, next_key
+
 ######################################################################
 #  F I N D E R   M E T H O D S
 ######################################################################
+    @staticmethod
+    def index_for(selector):
+        """
+        Returns the use_index hint for the best index covering a selector
+
+        A JSON index can only serve a query that references all of its
+        fields, so the covering index with the most fields wins.
+        """
+        best = backends.index_for(selector)
+        if best is None:
+            return None
+        return '_design/{}/{}'.format(INDEX_DESIGN_DOC, best)
+
     @classmethod
-    def find_by(cls, **kwargs):
-        """ Find records using selector """
-        query = Query(cls.database, selector=kwargs)
-        results = []
-        for doc in query.result:
-            pet = Promotion()
-            pet.deserialize(doc)
-            results.append(pet)
-        return results
+    def find_by(cls, fields=None, **kwargs):
+        """
+        Find records using selector
+
+        Args:
+            fields (list): The only fields to read, the others are None
+        """
+        documents = cls.storage.find(kwargs, fields=cls.document_fields(fields))
+        return [Promotion.from_document(doc) for doc in documents]
 
     @classmethod
-    def find(cls, promotion_id):
+    def find(cls, promotion_id, fresh=False):
         """ Query that finds Promotions by their id """
-        try:
-            document = cls.database[promotion_id]
-        except KeyError:
+        document = cls.find_document(promotion_id, fresh)
+        if document is None:
             return None
-        if '_rev' in document:
-            return Promotion().deserialize(document)
-        return None
+        return Promotion.from_document(document)
 
     @classmethod
-    def find_by_code(cls, code):
-        """ Query that finds Promotions by their code """
-        return cls.find_by(code=code)
+    def find_document(cls, promotion_id, fresh=False):
+        """
+        Returns the document of a Promotion, with its _rev, or None
+
+        When the replica is current the document is read from it without
+        any network round trip. Otherwise documents are read through the
+        in-process cache. Once an entry is
+        older than its TTL it is revalidated against the database using its
+        _rev, so an unchanged document is not downloaded again.
+
+        Args:
+            fresh (bool): always revalidate against the database
+        """
+        replica = cls.current_replica()
+        if replica is not None and not fresh:
+            return replica.get(promotion_id)
+        document = None if fresh else cls.cache.get(promotion_id)
+        if document is None:
+            document = cls._fetch_document(promotion_id,
+                                           cls.cache.get_stale(promotion_id))
+        return document
+
+    @classmethod
+    def _fetch_document(cls, promotion_id, cached=None):
+        """ Fetches a document from the database and caches it """
+        document = cls.storage.get(promotion_id, cached)
+        if document is None:
+            cls.cache.invalidate(promotion_id)
+        elif cached is not None and document is cached:
+            cls.cache.touch(promotion_id)
+        else:
+            cls.cache.put(promotion_id, document)
+        return document
+
+    @classmethod
+    def update_seq(cls):
+        """ Returns the update sequence of the database, which changes on every write """
+        return cls.storage.update_seq()
+
+    @classmethod
+    def find_by_code(cls, code, fields=None):
+        """ Query that finds Promotions by their code, reading only `fields` when given """
+        replica = cls.current_replica()
+        if replica is not None:
+            return [Promotion.from_document(doc) for doc in replica.find_by_code(code)]
+        return cls.find_by(fields=fields, code=code)
+
+    @classmethod
+    def find_active(cls, at=None, code=None):
+        """
+        Query that finds the Promotions active now or at a given time
+
+        Args:
+            at (int): The timestamp, the current time when None
+            code (str): Only return the Promotions having this code
+        """
+        active = cls.active_set()
+        if at is None:
+            documents = active.current()
+        else:
+            documents = active.at(at)
+        if documents is None:
+            # the set only knows promotions that had not expired when it was built
+            selector = {'start_date': {'$lte': at}, 'expiry_date': {'$gte': at}}
+            if code is not None:
+                selector['code'] = code
+            return cls.find_by(**selector)
+        return [Promotion.from_document(document) for document in documents
+                if code is None or document.get('code') == code]
+
+    @classmethod
+    def find_by_product(cls, product_id):
+        """ Query that finds the Promotions of a product """
+        return cls.find_by(products={'$elemMatch': {'$eq': product_id}})
+
+    @classmethod
+    def find_overlapping(cls, code, start_date, expiry_date, limit=OVERLAP_LIMIT):
+        """
+        Query that finds Promotions with a code active within a date range
+
+        The windows of a code do not overlap, so in expiry_date order the
+        ones ending after start_date also start in that order: only the
+        first `limit` of them are read, through the (code, expiry_date)
+        index, and the start_date is checked here.
+        """
+        selector = {'code': code, 'expiry_date': {'$gte': start_date}}
+        documents, _ = cls.storage.find(selector, limit=limit, sort=['code', 'expiry_date'])
+        promotions = [Promotion.from_document(doc) for doc in documents]
+        return [promotion for promotion in promotions if promotion.start_date <= expiry_date]
 
 ############################################################
-#  C L O U D A N T   D A T A B A S E   C O N N E C T I O N
+#  D A T A B A S E   C O N N E C T I O N
 ############################################################
     @staticmethod
-    def init_db(dbname='promotions'):
-        """
-        Initialized Coundant database connection
-        """
-        opts = {}
-        vcap_services = {}
-        # Try and get VCAP from the environment or a file if developing
-        if 'VCAP_SERVICES' in os.environ:
-            Promotion.logger.info('Running in Bluemix mode.')
-            vcap_services = json.loads(os.environ['VCAP_SERVICES'])
-        # if VCAP_SERVICES isn't found, maybe we are running on Kubernetes?
-        elif 'BINDING_CLOUDANT' in os.environ:
-            Promotion.logger.info('Found Kubernetes Bindings')
-            creds = json.loads(os.environ['BINDING_CLOUDANT'])
-            vcap_services = {"cloudantNoSQLDB": [{"credentials": creds}]}
-        else:
-            Promotion.logger.info(
-                'VCAP_SERVICES and BINDING_CLOUDANT undefined.')
-            creds = {
-                "username": CLOUDANT_USERNAME,
-                "password": CLOUDANT_PASSWORD,
-                "host": CLOUDANT_HOST,
-                "port": 5984,
-                "url": "http://"+CLOUDANT_HOST+":5984/"
-            }
-            vcap_services = {"cloudantNoSQLDB": [{"credentials": creds}]}
-
-        # Look for Cloudant in VCAP_SERVICES
-        for service in vcap_services:
-            if service.startswith('cloudantNoSQLDB'):
-                cloudant_service = vcap_services[service][0]
-                opts['username'] = cloudant_service['credentials']['username']
-                opts['password'] = cloudant_service['credentials']['password']
-                opts['host'] = cloudant_service['credentials']['host']
-                opts['port'] = cloudant_service['credentials']['port']
-                opts['url'] = cloudant_service['credentials']['url']
-
-        if any(k not in opts for k in ('host', 'username', 'password', 'port', 'url')):
-            raise DatabaseConnectionError('Error - Failed to retrieve options. '
-                                          'Check that app is bound to a Cloudant service.')
-
-        Promotion.logger.info('Cloudant Endpoint: %s', opts['url'])
-        try:
-            if ADMIN_PARTY:
-                Promotion.logger.info('Running in Admin Party Mode...')
-            Promotion.client = Cloudant(opts['username'],
-                                        opts['password'],
-                                        url=opts['url'],
-                                        connect=True,
-                                        auto_renew=True,
-                                        admin_party=ADMIN_PARTY,
-                                        adapter=Replay429Adapter(
-                                            retries=10, initialBackoff=0.1)
-                                        )
-        except ConnectionError:
-            raise DatabaseConnectionError(
-                'Cloudant service could not be reached')
+    def init_db(dbname='promotions', stage=untimed):
+        """
+        Initializes the database connection of this process
 
-        # Create database if it doesn't exist
-        try:
-            Promotion.database = Promotion.client[dbname]
-        except KeyError:
-            # Create a database using an initialized client
-            Promotion.database = Promotion.client.create_database(dbname)
-        # check for success
-        if not Promotion.database.exists():
+        Threads serving requests may read Promotion.storage while this
+        runs: the new storage is only published once it is ready, and
+        concurrent initializations are serialized.
+
+        Args:
+            stage (function): returns a context manager for each stage,
+                'connect' and 'indexes', to time them
+        """
+        with Promotion.init_lock:
+            Promotion._init_db(dbname, stage=stage)
+
+    @classmethod
+    def ensure_db(cls, dbname='promotions', stage=untimed):
+        """ Initializes the database connection unless this process has one """
+        if cls.storage is None:
+            with cls.init_lock:
+                if cls.storage is None:
+                    cls._init_db(dbname, stage=stage)
+
+    @classmethod
+    def after_fork(cls):
+        """
+        Forgets the connection and the state inherited from the parent process
+
+        Sockets must not be shared with the parent, the threads of the
+        replica and of the active set did not survive the fork and locks
+        may have been copied while held, so the child starts over.
+        """
+        cls.init_lock = threading.RLock()
+        cls.product_index_lock = threading.Lock()
+        cls.active_promotions_lock = threading.Lock()
+        cls.index_builds = []
+        cls.index_builds_lock = threading.Lock()
+        cls.code_locks = CodeLocks()
+        cls.cache = LRUCache(CACHE_SIZE, CACHE_TTL)
+        cls.storage = None
+        cls.replica = None
+        cls.product_index = None
+        cls.active_promotions = None
+
+    @staticmethod
+    def _init_db(dbname, stage=untimed):
+        """
+        Opens the database of the storage backend named by PROMOTION_BACKEND
+        """
+        if STORAGE_BACKEND not in BACKENDS:
             raise DatabaseConnectionError(
-                'Database [{}] could not be obtained'.format(dbname))
+                'Unknown storage backend: {}'.format(STORAGE_BACKEND))
+        with stage('connect'):
+            storage = BACKENDS[STORAGE_BACKEND]().open(dbname)
+        with stage('indexes'):
+            storage.create_indexes()
+
+        Promotion.storage = storage
+        Promotion.cache.clear()
+        Promotion.product_index = None
+        Promotion.stop_active_set()
+        if REPLICA_ENABLED:
+            if storage.name == CloudantStorage.name:
+                Promotion.start_replica()
+            else:
+                Promotion.logger.warning('The replica follows the _changes feed of CouchDB, '
+                                         'it is not started with %s', storage.name)
+
+
+# every process gets its own connection, also when forked by a server
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=Promotion.after_fork)
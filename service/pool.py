@@ -0,0 +1,112 @@
+"""
+Pool
+
+The transport adapter used by the Cloudant client, with a configurable
+connection pool that keeps count of how it is used
+"""
+import socket
+import threading
+from cloudant.adapters import Replay429Adapter
+from requests.packages.urllib3.connection import HTTPConnection
+from requests.packages.urllib3.util.retry import Retry
+from service.metrics import DB_RETRIES_429
+
+
+class CountingRetry(Retry):
+    """ The retry policy of Replay429Adapter, counting the 429 responses it replays """
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        """ Counts a replayed 429 before backing off """
+        if response is not None and response.status == 429:
+            DB_RETRIES_429.inc()
+        return super(CountingRetry, self).increment(method, url, response, error,
+                                                    _pool, _stacktrace)
+
+
+class PooledAdapter(Replay429Adapter):
+    """
+    Replays 429 responses like Replay429Adapter and sizes the connection pool
+
+    Every thread of the process shares this adapter through the Cloudant
+    client. With `pool_block` a thread waits for a free connection instead
+    of opening one that is thrown away afterwards, and `keepalive` turns on
+    TCP keep-alive probes so idle connections are not silently dropped.
+    The counters tell how busy the pool is, to size workers and threads,
+    and the 429 responses that are replayed are counted in the metrics.
+    """
+
+    def __init__(self, retries=3, initialBackoff=0.25, pool_maxsize=10,
+                 pool_block=False, keepalive=None):
+        self.keepalive = keepalive
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.max_in_use = 0
+        self.waits = 0
+        self.requests = 0
+        super(PooledAdapter, self).__init__(retries=retries, initialBackoff=initialBackoff)
+        retry = self.max_retries
+        self.max_retries = CountingRetry(total=retry.total, connect=retry.connect,
+                                         read=retry.read,
+                                         method_whitelist=retry.method_whitelist,
+                                         status_forcelist=retry.status_forcelist,
+                                         backoff_factor=retry.backoff_factor)
+        self._pool_connections = pool_maxsize
+        self._pool_maxsize = pool_maxsize
+        self._pool_block = pool_block
+        self.init_poolmanager(pool_maxsize, pool_maxsize, block=pool_block)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        """ Creates the pool manager with the keep-alive socket options """
+        if self.keepalive:
+            options = list(HTTPConnection.default_socket_options)
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in (('TCP_KEEPIDLE', self.keepalive),
+                                ('TCP_KEEPINTVL', max(1, self.keepalive // 3)),
+                                ('TCP_KEEPCNT', 3)):
+                if hasattr(socket, name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+            pool_kwargs['socket_options'] = options
+        super(PooledAdapter, self).init_poolmanager(connections, maxsize, block=block,
+                                                    **pool_kwargs)
+
+    def send(self, request, **kwargs):   # pylint: disable=arguments-differ
+        """ Sends a request, counting the connections in use """
+        with self.lock:
+            if self.in_use >= self._pool_maxsize:
+                self.waits += 1
+            self.in_use += 1
+            self.requests += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+        try:
+            return super(PooledAdapter, self).send(request, **kwargs)
+        finally:
+            with self.lock:
+                self.in_use -= 1
+
+    def idle(self):
+        """ Returns the number of open connections waiting in the pools """
+        count = 0
+        pools = self.poolmanager.pools
+        for key in pools.keys():
+            try:
+                queue = pools[key].pool
+            except KeyError:
+                continue
+            if queue is not None:
+                count += sum(1 for conn in list(queue.queue) if conn is not None)
+        return count
+
+    def stats(self):
+        """ Returns the size of the pool and how it is used """
+        with self.lock:
+            stats = {
+                'size': self._pool_maxsize,
+                'block': self._pool_block,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'waits': self.waits,
+                'requests': self.requests,
+            }
+        stats['idle'] = self.idle()
+        return stats
@@ -0,0 +1,115 @@
+"""
+Pricing
+
+An inverted index from product ids to the promotions that discount them,
+used to find the best promotion for every line of a cart
+"""
+import threading
+import time
+from bisect import insort
+from collections import defaultdict
+
+
+class ProductIndex():
+    """
+    Maps every product id to the promotions covering it
+
+    The promotions of a product are kept sorted by percentage, so the best
+    price for a line is the first of them that is active at the time of
+    the purchase. Documents are applied one at a time as they change, so
+    the index never has to be rebuilt from scratch to stay current.
+    """
+
+    def __init__(self):
+        self.products = defaultdict(list)  # product_id -> sorted entries
+        self.entries = {}                  # promotion_id -> (entry, product ids)
+        self.built_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def age(self):
+        """ Returns how many seconds ago the index was built """
+        return time.monotonic() - self.built_at
+
+    def apply(self, document):
+        """
+        Applies a promotion document (or a tombstone) to the index
+
+        Args:
+            document (dict): A promotion document with its _id
+        """
+        promotion_id = document.get('_id') or document.get('id')
+        with self.lock:
+            self._remove(promotion_id)
+            if document.get('_deleted') or not _is_promotion(document):
+                return
+            entry = (int(document['percentage']), int(document['start_date']),
+                     int(document['expiry_date']), promotion_id)
+            product_ids = frozenset(str(product_id) for product_id in document['products'])
+            for product_id in product_ids:
+                insort(self.products[product_id], entry)
+            self.entries[promotion_id] = (entry, product_ids)
+
+    def _remove(self, promotion_id):
+        """ Removes a promotion from the lists of its products """
+        previous = self.entries.pop(promotion_id, None)
+        if previous is None:
+            return
+        entry, product_ids = previous
+        for product_id in product_ids:
+            entries = self.products[product_id]
+            entries.remove(entry)
+            if not entries:
+                del self.products[product_id]
+
+    def clear(self):
+        """ Removes every promotion """
+        with self.lock:
+            self.products.clear()
+            self.entries.clear()
+            self.built_at = time.monotonic()
+
+    def best(self, product_id, now=None):
+        """
+        Returns (percentage, promotion_id) of the best active promotion
+        for a product, or None when no active promotion covers it
+        """
+        now = time.time() if now is None else now
+        for percentage, start_date, expiry_date, promotion_id in \
+                self.products.get(product_id, ()):
+            if start_date <= now <= expiry_date:
+                return percentage, promotion_id
+        return None
+
+    def price(self, lines, now=None):
+        """
+        Applies the best active promotion to every line of a cart
+
+        Args:
+            lines (list): dicts with a product_id and a float price
+        Returns:
+            The same lines with their new price and the promotion_id applied
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            for line in lines:
+                best = self.best(str(line['product_id']), now)
+                if best is None:
+                    line['promotion_id'] = None
+                else:
+                    line['price'] = line['price'] * (best[0] / 100.0)
+                    line['promotion_id'] = best[1]
+        return lines
+
+
+def _is_promotion(document):
+    """ True when a document has everything needed to price products """
+    try:
+        int(document['percentage'])
+        int(document['start_date'])
+        int(document['expiry_date'])
+        return isinstance(document['products'], list)
+    except (KeyError, TypeError, ValueError):
+        return False
@@ -0,0 +1,99 @@
+"""
+Profiling
+
+Runs a single request under cProfile when it asks for it with the
+X-Profile header or the `profile` query parameter, set to PROFILE_SECRET.
+
+The profile covers the whole request, from the routing to the marshalling
+of the response, with every call made to the database on the way. With
+PROFILE_DIR the profile is stored there, for `python -m pstats`, and named
+in the X-Profile-File header of the normal response. Without it the
+response is replaced by the report of the slowest calls.
+
+Requests that do not ask for it are not touched, and when PROFILE_SECRET
+is not set nobody can ask for it.
+"""
+import cProfile
+import hmac
+import io
+import logging
+import os
+import pstats
+import time
+import uuid
+from urllib.parse import parse_qs
+
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET')
+PROFILE_DIR = os.environ.get('PROFILE_DIR')
+PROFILE_LIMIT = int(os.environ.get('PROFILE_LIMIT', '40'))
+
+
+class ProfilerMiddleware():
+    """ WSGI middleware that profiles the requests asking for it """
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not PROFILE_SECRET or not self.asks_for_profile(environ):
+            return self.app(environ, start_response)
+
+        response = {}
+
+        def capture(status, headers, exc_info=None):
+            response['status'] = status
+            response['headers'] = headers
+            return lambda data: response.setdefault('written', []).append(data)
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            result = self.app(environ, capture)
+            try:
+                chunks = list(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        finally:
+            profiler.disable()
+        seconds = time.perf_counter() - started
+        body = response.get('written', []) + chunks
+        self.logger.info('Profiled %s %s in %.3fs', environ.get('REQUEST_METHOD'),
+                         environ.get('PATH_INFO'), seconds)
+
+        if PROFILE_DIR:
+            name = '{}-{}.prof'.format(time.strftime('%Y%m%d-%H%M%S'), uuid.uuid4().hex[:8])
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            profiler.dump_stats(os.path.join(PROFILE_DIR, name))
+            start_response(response['status'],
+                           response['headers'] + [('X-Profile-File', name)])
+            return body
+
+        report = self.report(profiler, environ, response['status'], seconds)
+        start_response('200 OK', [('Content-Type', 'text/plain; charset=utf-8'),
+                                  ('Content-Length', str(len(report))),
+                                  ('X-Profile-Status', response['status'])])
+        return [report]
+
+    @staticmethod
+    def asks_for_profile(environ):
+        """ True when the request carries the profiling secret """
+        secret = environ.get('HTTP_X_PROFILE')
+        if secret is None:
+            query = environ.get('QUERY_STRING', '')
+            if 'profile=' not in query:
+                return False
+            secret = parse_qs(query).get('profile', [''])[0]
+        return hmac.compare_digest(secret.encode('utf8'), PROFILE_SECRET.encode('utf8'))
+
+    @staticmethod
+    def report(profiler, environ, status, seconds):
+        """ Returns the slowest calls of a profile, by cumulative time """
+        stream = io.StringIO()
+        stream.write('{} {} -> {} in {:.3f}s\n\n'.format(
+            environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), status, seconds))
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LIMIT)
+        return stream.getvalue().encode('utf8')
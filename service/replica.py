@@ -0,0 +1,244 @@
+"""
+Replica
+
+An in-memory copy of the promotions database that a background thread
+keeps current by following the CouchDB _changes feed
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from service.active import ActiveSet
+from service.intervals import CodeIntervals
+from service.pricing import ProductIndex
+
+# seconds a long-poll may take past its timeout before it counts as hung
+POLL_MARGIN = 5.0
+
+
+def revision_number(rev):
+    """ Returns the generation number of a CouchDB _rev """
+    try:
+        return int(rev.split('-', 1)[0])
+    except (AttributeError, ValueError):
+        return 0
+
+
+class Replica():
+    """
+    Keeps every document of a database in memory
+
+    The replica bootstraps by reading the _changes feed from the start in
+    batches, then long-polls it with since= checkpoints. Until the first
+    full pass is done (and whenever it falls too far behind) is_current()
+    is False and callers should query CouchDB directly.
+    """
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self, database, batch_size=1000, poll_timeout=30.0, max_lag=30.0):
+        self.database = database
+        self.batch_size = batch_size
+        self.poll_timeout = poll_timeout
+        self.max_lag = max_lag
+        self.documents = {}             # id -> document
+        self.tombstones = {}            # id -> _rev of deleted documents
+        self.by_code = defaultdict(set)  # code -> ids
+        self.intervals = CodeIntervals()  # code -> date windows
+        self.products = ProductIndex()    # product id -> promotions
+        self.active = ActiveSet()         # promotions active now
+        self.seq = None                 # since= checkpoint
+        self.applied = 0                # documents applied, local writes included
+        self.pending = None             # changes left behind the checkpoint
+        self.synced_at = None           # when the replica was last caught up
+        self.errors = 0
+        self.waiting = False            # long-polling while caught up
+        self.lock = threading.RLock()
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    ######################################################################
+    #  R E A D S
+    ######################################################################
+    def is_current(self):
+        """ True when the replica is bootstrapped and not lagging behind """
+        lag = self.lag()
+        return self._ready.is_set() and lag is not None and lag <= self.max_lag
+
+    def lag(self):
+        """
+        Returns how many seconds the replica may be behind CouchDB
+
+        While a long-poll started from a caught-up checkpoint is waiting,
+        any change is delivered as soon as it happens, so the lag is 0,
+        until the long-poll outlasts its timeout by POLL_MARGIN: then it
+        is hung and the replica is as old as its last sync.
+        """
+        if self.synced_at is None:
+            return None
+        elapsed = time.monotonic() - self.synced_at
+        if self.waiting and elapsed <= self.poll_timeout + POLL_MARGIN:
+            return 0.0
+        return elapsed
+
+    def get(self, doc_id):
+        """ Returns the document with the given id or None """
+        return self.documents.get(doc_id)
+
+    def find_by_code(self, code):
+        """ Returns the documents having the given code """
+        with self.lock:
+            return [self.documents[doc_id] for doc_id in sorted(self.by_code.get(code, ()))]
+
+    def all(self):
+        """ Returns all documents ordered by id """
+        with self.lock:
+            return [self.documents[doc_id] for doc_id in sorted(self.documents)]
+
+    def version(self):
+        """
+        Returns a value that changes whenever the documents of the replica do
+
+        Local writes are applied before the feed delivers them, so the
+        checkpoint alone does not change with them.
+        """
+        with self.lock:
+            return '{}+{}'.format(self.seq, self.applied)
+
+    def status(self):
+        """ Returns the replication state and lag """
+        lag = self.lag()
+        return {
+            'ready': self._ready.is_set(),
+            'current': self.is_current(),
+            'documents': len(self.documents),
+            'seq': self.seq,
+            'pending': self.pending,
+            'lag_seconds': None if lag is None else round(lag, 3),
+            'errors': self.errors,
+        }
+
+    ######################################################################
+    #  W R I T E S
+    ######################################################################
+    def apply(self, document):
+        """
+        Applies a document (or a tombstone) to the replica
+
+        Writes made by this process are applied right away so they can be
+        read back; an older revision arriving later from the feed is ignored.
+        """
+        doc_id = document['_id']
+        if doc_id.startswith('_design/'):
+            return
+        with self.lock:
+            current = self.documents.get(doc_id)
+            known = current.get('_rev') if current else self.tombstones.get(doc_id)
+            if revision_number(document.get('_rev')) < revision_number(known):
+                return
+            self.applied += 1
+            if current is not None:
+                self.by_code[current.get('code')].discard(doc_id)
+            if document.get('_deleted'):
+                self.documents.pop(doc_id, None)
+                self.tombstones[doc_id] = document.get('_rev')
+                self.intervals.apply(current, None)
+                self.products.apply(document)
+                self.active.apply(document)
+            else:
+                self.tombstones.pop(doc_id, None)
+                self.documents[doc_id] = document
+                self.by_code[document.get('code')].add(doc_id)
+                self.intervals.apply(current, document)
+                self.products.apply(document)
+                self.active.apply(document)
+
+    def reset(self):
+        """ Forgets everything and bootstraps again """
+        with self.lock:
+            self.documents.clear()
+            self.tombstones.clear()
+            self.by_code.clear()
+            self.intervals.clear()
+            self.products.clear()
+            self.active.clear()
+            self.seq = None
+            self.pending = None
+            self.synced_at = None
+            self._ready.clear()
+
+    ######################################################################
+    #  R E P L I C A T I O N
+    ######################################################################
+    def start(self):
+        """ Starts following the _changes feed on a daemon thread """
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='promotion-replica',
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the replication thread """
+        self._stop.set()
+        self.active.stop()
+
+    def wait_until_ready(self, timeout=None):
+        """ Blocks until the replica has bootstrapped """
+        return self._ready.wait(timeout)
+
+    def _run(self):
+        """ Replication loop """
+        backoff = 0.5
+        while not self._stop.is_set():
+            try:
+                self.sync(longpoll=self._ready.is_set())
+                backoff = 0.5
+            except Exception as error:   # pylint: disable=broad-except
+                self.errors += 1
+                self.logger.warning('Replica sync failed: %s', error)
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 30.0)
+
+    def sync(self, longpoll=False):
+        """
+        Reads one batch of the _changes feed and applies it
+
+        Args:
+            longpoll (bool): wait for changes when the replica is caught up
+        """
+        params = {'include_docs': 'true', 'limit': self.batch_size}
+        if self.seq is not None:
+            params['since'] = self.seq
+        if longpoll:
+            params['feed'] = 'longpoll'
+            params['timeout'] = int(self.poll_timeout * 1000)
+        url = '/'.join((self.database.database_url, '_changes'))
+        self.waiting = longpoll and not self.pending
+        try:
+            resp = self.database.r_session.get(url, params=params)
+            if self.waiting and resp.ok:
+                self.synced_at = time.monotonic()
+        finally:
+            self.waiting = False
+        if resp.status_code in (400, 404):
+            # the database was recreated or the checkpoint is not valid anymore
+            self.logger.warning('Replica checkpoint rejected, bootstrapping again')
+            self.reset()
+        resp.raise_for_status()
+        data = resp.json()
+        results = data.get('results', [])
+        for change in results:
+            document = change.get('doc') or {'_id': change['id']}
+            if change.get('deleted'):
+                document = {'_id': change['id'], '_deleted': True,
+                            '_rev': change['changes'][0]['rev']}
+            self.apply(document)
+        self.seq = data.get('last_seq', self.seq)
+        self.pending = data.get('pending', int(len(results) >= self.batch_size))
+        if not self.pending:
+            self.synced_at = time.monotonic()
+            if not self._ready.is_set():
+                self.logger.info('Replica ready with %d documents', len(self.documents))
+                self._ready.set()
+        return data
@@ -23,21 +23,40 @@ Promotion Service with Swagger
 Paths:
 ------
 GET / - Displays a UI for Selenium testing
+GET /ready - Tells whether the process has warmed up, with each warm-up stage
+GET /metrics - Returns the request and database metrics in the Prometheus text format
 GET /promotions - Returns a list all of the Promotions
+GET /promotions?limit={limit}&cursor={cursor} - Returns a page of Promotions
+GET /promotions (Accept: application/x-ndjson) - Streams all Promotions as NDJSON
+GET /promotions?active=true - Returns the Promotions active now
+GET /promotions?at={timestamp} - Returns the Promotions active at a given time
+GET /promotions?fields={field,...} - Returns only some fields of the Promotions
 GET /promotions/{promotion_id} - Returns the Promotion with a given id number
 POST /promotions - creates a new Promotion record in the database
+POST /promotions/bulk - creates many Promotion records in the database
 PUT /promotions/{promotion_id} - updates a Promotion record in the database
 DELETE /promotions/{promotion_id} - deletes a Promotion record in the database
+POST /promotions/apply - applies the best active Promotion to each product of a cart
 """
 
+import base64
+import binascii
+import hashlib
+import json
 import logging
 import sys
+import time
+from functools import wraps
 
-from flask import abort, jsonify, make_response, request, url_for
+from flask import Response, abort, g, jsonify, make_response, request, url_for
 
 from flask_api import status  # HTTP Status Codes
-from flask_restplus import Api, Resource, fields, reqparse, inputs
-from service.models import DataValidationError, DatabaseConnectionError, Promotion
+from flask_restplus import Api, Resource, fields, reqparse, inputs, marshalling
+from flask_restplus.utils import merge, unpack
+from service.models import DataValidationError, DatabaseConnectionError, \
+    Promotion, cart_lines, FIELDS
+from service.storage import DataConflictError
+from service import compression, encoding, metrics, warmup
 
 # Import Flask application
 from . import app
@@ -105,10 +124,68 @@ product_list_model = api.model('Product List', {
                             description='A list of products.'),
 })
 
+priced_product_model = api.model('Priced Product', {
+    'product_id': fields.String(required=True,
+                          description='The unique id of the Product.'),
+    'price': fields.Float(required=True,
+                          description='The price of the Product.'),
+    'promotion_id': fields.String(readOnly=True,
+                                  description='The id of the Promotion applied, if any.'),
+})
+
+priced_product_list_model = api.model('Priced Product List', {
+    'products': fields.List(fields.Nested(priced_product_model), required=True,
+                            description='A list of products with their best price.'),
+})
+
+bulk_result_model = api.model('Bulk Result', {
+    'index': fields.Integer(readOnly=True,
+                            description='The position of the Promotion in the posted list.'),
+    'id': fields.String(readOnly=True,
+                        description='The id of the created Promotion.'),
+    'ok': fields.Boolean(readOnly=True,
+                         description='Whether the Promotion was created.'),
+    'error': fields.String(readOnly=True,
+                           description='Why the Promotion was not created.'),
+})
+
+DEFAULT_PAGE_LIMIT = 100
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
 # query string arguments
 promotion_args = reqparse.RequestParser()
 promotion_args.add_argument('promotion-code', type=str, required=False,
                             help='List Promotions by code', location='args')
+promotion_args.add_argument('limit', type=inputs.int_range(1, 1000), required=False,
+                            help='Maximum number of Promotions in a page', location='args')
+promotion_args.add_argument('cursor', type=str, required=False,
+                            help='Cursor of the page to list, from the next link', location='args')
+promotion_args.add_argument('active', type=inputs.boolean, required=False,
+                            help='List only the Promotions active now', location='args')
+promotion_args.add_argument('at', type=int, required=False,
+                            help='List only the Promotions active at this timestamp',
+                            location='args')
+promotion_args.add_argument('fields', type=str, required=False,
+                            help='Comma separated fields of the Promotions to return, '
+                                 'among ' + ','.join(FIELDS),
+                            location='args')
+
+
+def requested_fields(value):
+    """
+    Returns the fields named by the fields query argument, or None for all of them
+
+    The names are returned once each and in the order of FIELDS, which is
+    the order they are serialized in, so that each projection has one key.
+    """
+    if value is None:
+        return None
+    names = {name.strip() for name in value.split(',') if name.strip()}
+    unknown = sorted(names.difference(FIELDS))
+    if unknown or not names:
+        raise DataValidationError('Invalid fields: {}, the fields are {}'.format(
+            ','.join(unknown) or value, ','.join(FIELDS)))
+    return tuple(name for name in FIELDS if name in names)
 
 ######################################################################
 # GET HEALTH CHECK
@@ -119,6 +196,223 @@ def healthcheck():
     return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
 
 
+######################################################################
+# GET READINESS
+######################################################################
+@app.route('/ready')
+def readiness():
+    """
+    Tells whether this process has warmed up and can take traffic
+
+    Answers 503 until every warm-up stage is done, with the state and the
+    duration of each stage. The first call starts the warm-up if the
+    server did not.
+    """
+    report = warmup.start().status()
+    code = status.HTTP_200_OK if report['ready'] else status.HTTP_503_SERVICE_UNAVAILABLE
+    return make_response(jsonify(report), code)
+
+
+######################################################################
+# COMPILED MARSHALLING
+######################################################################
+api.representation('application/json')(encoding.output_json)
+
+
+def marshal_compiled(model, as_list=False, code=status.HTTP_200_OK, description=None,
+                     projection=None):
+    """
+    Decorator that marshals the response with a model, like api.marshal_with
+
+    The response is documented the same way, so the Swagger does not
+    change, but it is built by the serializer compiled from the model
+    instead of the flask-restplus fields. Requests with a field mask in the
+    X-Fields header are marshalled by flask-restplus, which applies it.
+    With `projection`, the query argument of that name lists the only
+    fields to return.
+    """
+    serializers = {None: encoding.compile_model(model)}
+
+    def decorator(func):
+        func.__apidoc__ = merge(getattr(func, '__apidoc__', {}), {
+            'responses': {code: (description, [model]) if as_list else (description, model)},
+            '__mask__': True,
+        })
+        masked = marshalling.marshal_with(model, ordered=api.ordered)(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if request.headers.get(app.config['RESTPLUS_MASK_HEADER']):
+                return masked(*args, **kwargs)
+            data, result_code, headers = unpack(func(*args, **kwargs))
+            names = requested_fields(request.args.get(projection)) if projection else None
+            serialize = serializers.get(names)
+            if serialize is None:
+                serialize = serializers[names] = encoding.compile_model(model, names)
+            if isinstance(data, (list, tuple)):
+                data = [serialize(item) for item in data]
+            else:
+                data = serialize(data)
+            return data, result_code, headers
+        return wrapper
+    return decorator
+
+
+######################################################################
+# NDJSON STREAMING
+######################################################################
+def ndjson_stream(stream):
+    """
+    Decorator that serves a list endpoint as newline delimited JSON
+
+    When the client prefers application/x-ndjson the response is streamed
+    from the `stream` generator, one serialized item per line, instead of
+    calling the decorated endpoint and marshalling the whole list.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            mimetype = request.accept_mimetypes.best_match(
+                ['application/json', NDJSON_MIMETYPE])
+            if mimetype != NDJSON_MIMETYPE:
+                return func(*args, **kwargs)
+            lines = (encoding.ENCODER.encode(item) + '\n' for item in stream(*args, **kwargs))
+            return Response(lines, mimetype=NDJSON_MIMETYPE)
+        return wrapper
+    return decorator
+
+
+def stream_promotions(_):
+    """ Generator of serialized promotions for the list endpoint """
+    args = promotion_args.parse_args()
+    code = args['promotion-code']
+    fields = requested_fields(args['fields'])
+    app.logger.info('Request to stream Promotions')
+    if args['active'] or args['at'] is not None:
+        promotions = Promotion.find_active(args['at'], code)
+    elif code:
+        promotions = Promotion.iterate(fields=fields, code=code)
+    else:
+        promotions = Promotion.iterate(fields=fields)
+    serialize = encoding.compile_model(promotion_model, fields)
+    return (serialize(promotion) for promotion in promotions)
+
+
+######################################################################
+# CONDITIONAL REQUESTS
+######################################################################
+def conditional(etag_for):
+    """
+    Decorator that answers GET requests with an ETag
+
+    The `etag_for` function is called with the arguments of the endpoint
+    and returns the entity tag of the current representation (or None).
+    When it, or the tag of one of its compressed representations, matches
+    If-None-Match a 304 with that tag is returned right away, without
+    calling the endpoint, otherwise the ETag is added to its response.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            etag = etag_for(*args, **kwargs)
+            if etag is None:
+                return func(*args, **kwargs)
+            for tag in compression.etag_variants(etag):
+                if request.if_none_match.contains_weak(tag):
+                    response = Response(status=status.HTTP_304_NOT_MODIFIED)
+                    response.set_etag(tag)
+                    return response
+            result = func(*args, **kwargs)
+            if isinstance(result, Response):
+                result.set_etag(etag)
+                return result
+            if not isinstance(result, tuple):
+                result = (result,)
+            data, code, headers = (result + (None, None))[:3]
+            headers = dict(headers or {})
+            headers['ETag'] = '"{}"'.format(etag)
+            return data, code or status.HTTP_200_OK, headers
+        return wrapper
+    return decorator
+
+
+def if_match(etag):
+    """ True when If-Match names the entity tag or one of its compressed representations """
+    return any(request.if_match.contains(tag) for tag in compression.etag_variants(etag))
+
+
+def promotion_etag(_, promotion_id):
+    """ The ETag of a Promotion is the _rev of its document """
+    document = Promotion.find_document(promotion_id)
+    return document['_rev'] if document else None
+
+
+def collection_etag(_):
+    """
+    The ETag of a list of Promotions is derived from the database update_seq
+
+    A current replica gives its own version instead, without a round trip.
+    The ETag also depends on the query and the media type asked for. The
+    promotions active now change with time alone, so they get no ETag.
+    """
+    args = promotion_args.parse_args()
+    if args['active']:
+        return None
+    replica = Promotion.current_replica()
+    version = replica.version() if replica is not None else Promotion.update_seq()
+    key = '|'.join((str(version),
+                    request.query_string.decode('utf8'),
+                    str(request.accept_mimetypes)))
+    return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+
+######################################################################
+# GET SERVICE STATISTICS
+######################################################################
+@app.route('/stats')
+def service_stats():
+    """ Returns the counters of the in-process caches, the replica lag and the pool """
+    replica = Promotion.replica.status() if Promotion.replica else None
+    pool = Promotion.storage.stats() if Promotion.storage else None
+    return make_response(jsonify(cache=Promotion.cache.stats(), replica=replica, pool=pool),
+                         status.HTTP_200_OK)
+
+
+######################################################################
+# METRICS
+######################################################################
+@app.before_request
+def start_request_timer():
+    """ Counts the request in flight and notes when it started """
+    g.request_started = time.perf_counter()
+    metrics.HTTP_IN_FLIGHT.inc()
+
+
+@app.after_request
+def record_request(response):
+    """ Records how long the request took, by endpoint, and its status """
+    started = g.get('request_started')
+    if started is not None:
+        endpoint = request.endpoint or 'none'
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started,
+                                             endpoint, request.method)
+        metrics.HTTP_REQUESTS.inc(endpoint, request.method, str(response.status_code))
+    return response
+
+
+@app.teardown_request
+def end_request(_):
+    """ The request is not in flight anymore """
+    if g.get('request_started') is not None:
+        metrics.HTTP_IN_FLIGHT.dec()
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """ Returns the metrics of this process in the Prometheus text format """
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+
 #####################################################################
 # PATH: /promotions
 #####################################################################
@@ -130,7 +424,10 @@ class PromotionCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_promotions')
     @api.expect(promotion_args, validate=True)
-    @api.marshal_list_with(promotion_model)
+    @api.response(304, 'Promotions not modified')
+    @conditional(collection_etag)
+    @ndjson_stream(stream_promotions)
+    @marshal_compiled(promotion_model, as_list=True, projection='fields')
     def get(self):
         """
         List promotions.
@@ -141,19 +438,58 @@ class PromotionCollection(Resource):
         While no promotion is found, no matter a code is provided or not, rather
         than raising a NotFound, we return an empty list to indicate that nothing
         is found.
+        With active=true only the promotions active now are returned, and
+        with at={timestamp} only the promotions active at that time.
+        If a limit is provided, only one page of promotions is returned and
+        the next page is linked from the `Link` header with rel="next".
+        Clients that accept application/x-ndjson get every promotion streamed,
+        one JSON object per line.
+        With fields={field,...} only those fields of the promotions are read
+        from the database and returned.
+        The response has an ETag that changes whenever the database does, so
+        clients can poll with If-None-Match and get a 304 while nothing changed.
         """
         app.logger.info('Request to list Promotions...')
         args = promotion_args.parse_args()
         code = args['promotion-code']
+        fields = requested_fields(args['fields'])
+        if args['active'] or args['at'] is not None:
+            app.logger.info('Request for active promotion list')
+            promotions = Promotion.find_active(args['at'], code)
+            return promotions, status.HTTP_200_OK
+        if args['limit'] or args['cursor']:
+            return self.get_page(code, args['limit'] or DEFAULT_PAGE_LIMIT, args['cursor'],
+                                 args['fields'])
+
         promotions = []
         if code:
             app.logger.info('Request for promotion list with code %s', code)
-            promotions = Promotion.find_by_code(code)
+            promotions = Promotion.find_by_code(code, fields)
         else:
             app.logger.info('Request for promotion list')
-            promotions = Promotion.all()
-        results = [p.serialize() for p in promotions]
-        return results, status.HTTP_200_OK
+            promotions = Promotion.all(fields)
+        return promotions, status.HTTP_200_OK
+
+    @staticmethod
+    def get_page(code, limit, cursor, fields=None):
+        """ Returns one page of promotions with a link to the next one """
+        app.logger.info('Request for promotion page of %d', limit)
+        start_key = decode_cursor(cursor) if cursor else None
+        if code:
+            promotions, next_key = Promotion.page(limit, start_key, requested_fields(fields),
+                                                  code=code)
+        else:
+            promotions, next_key = Promotion.page(limit, start_key, requested_fields(fields))
+        headers = {}
+        if next_key is not None:
+            params = {'limit': limit, 'cursor': encode_cursor(next_key)}
+            if code:
+                params['promotion-code'] = code
+            if fields:
+                params['fields'] = fields
+            next_url = api.url_for(PromotionCollection, _external=True, **params)
+            headers['Link'] = '<{}>; rel="next"'.format(next_url)
+        return promotions, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PROMOTION
@@ -162,7 +498,7 @@ class PromotionCollection(Resource):
     @api.expect(create_model)
     @api.response(400, 'The posted data was not valid')
     @api.response(201, 'Promotion created successfully')
-    @api.marshal_with(promotion_model, code=201)
+    @marshal_compiled(promotion_model, code=201)
     def post(self):
         """
         Add a promotion
@@ -182,6 +518,54 @@ class PromotionCollection(Resource):
         return message, status.HTTP_201_CREATED, {'Location': location_url}
 
 
+######################################################################
+#  PATH: /promotions/bulk
+######################################################################
+@api.route('/promotions/bulk')
+class PromotionBulkResource(Resource):
+    """ Handles creating many Promotions in one request """
+    @api.doc('create_many_promotions')
+    @api.expect([create_model])
+    @api.response(400, 'The posted data was not a list')
+    @api.response(201, 'All Promotions created successfully')
+    @api.response(207, 'Some Promotions could not be created')
+    @marshal_compiled(bulk_result_model, as_list=True, code=201)
+    def post(self):
+        """
+        Add many promotions
+
+        This endpoint validates the whole list and writes it in bulk.
+        It returns one result per posted promotion, in order, so that one
+        bad promotion does not fail the others.
+        """
+        app.logger.info('Request to create Promotions in bulk')
+        check_content_type('application/json')
+        data = request.get_json()
+        if not isinstance(data, list):
+            raise DataValidationError('Bulk create expects a list of promotions')
+
+        results = [None] * len(data)
+        promotions, positions = [], []
+        for index, item in enumerate(data):
+            try:
+                if not isinstance(item, dict):
+                    raise DataValidationError('Invalid promotion: not an object')
+                promotions.append(Promotion().deserialize(item))
+                positions.append(index)
+            except DataValidationError as error:
+                results[index] = {'id': None, 'ok': False, 'error': str(error)}
+        for index, result in zip(positions, Promotion.create_many(promotions)):
+            results[index] = result
+        for index, result in enumerate(results):
+            result['index'] = index
+
+        created = sum(1 for result in results if result['ok'])
+        app.logger.info('Created %d of %d Promotions in bulk', created, len(results))
+        if created == len(results):
+            return results, status.HTTP_201_CREATED
+        return results, status.HTTP_207_MULTI_STATUS
+
+
 ######################################################################
 #  PATH: /promotions/{promotion_id}
 ######################################################################
@@ -201,12 +585,16 @@ class PromotionResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('read_a_promotion')
     @api.response(404, 'Promotion not found')
-    @api.marshal_with(promotion_model)
+    @api.response(304, 'Promotion not modified')
+    @conditional(promotion_etag)
+    @marshal_compiled(promotion_model)
     def get(self, promotion_id):
         """
         Retrieve a single Promotion
 
         This endpoint will return a Promotion based on it's id
+        The ETag of the response is the revision of the Promotion, so a
+        request with a matching If-None-Match gets a 304 without a body.
         """
         app.logger.info(
             "Request to Retrieve a promotion with id [%s]", promotion_id)
@@ -225,27 +613,48 @@ class PromotionResource(Resource):
     @api.doc('update_a_promotion')
     @api.response(404, 'Promotion not found')
     @api.response(400, 'The posted Promotion data was not valid')
+    @api.response(412, 'The Promotion was changed since the If-Match revision')
     @api.expect(promotion_model)
-    @api.marshal_with(promotion_model)
+    @marshal_compiled(promotion_model)
     def put(self, promotion_id):
         """
         Update a Promotion
 
         This endpoint will update a Promotion based the body that is posted
+        When an If-Match header is sent, the Promotion is only updated if its
+        ETag still matches, otherwise a 412 is returned.
         """
         app.logger.info(
             'Request to update promotion with promotion id {}'.format(promotion_id))
         check_content_type('application/json')
         promotion = Promotion.find(promotion_id)
+        if promotion and request.if_match and not if_match(promotion.rev):
+            # the cached revision may be older than the one the client has
+            promotion = Promotion.find(promotion_id, fresh=True)
         if not promotion:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Promotion with id '{}' was not found.".format(promotion_id))
-        promotion.deserialize(request.get_json())
+        if request.if_match and not if_match(promotion.rev):
+            raise DataConflictError(
+                "Promotion with id '{}' was changed by someone else".format(promotion_id))
+        data = request.get_json()
+        promotion.deserialize(data)
         promotion.id = promotion_id
-        promotion.save()
+        try:
+            promotion.save()
+        except DataConflictError:
+            if request.if_match:
+                raise
+            # without a precondition the last writer wins
+            promotion = Promotion.find(promotion_id, fresh=True)
+            if not promotion:
+                api.abort(status.HTTP_404_NOT_FOUND,
+                          "Promotion with id '{}' was not found.".format(promotion_id))
+            promotion.deserialize(data)
+            promotion.save()
         app.logger.info(
             'Promotion with id {} successfully updated'.format(promotion_id))
-        return promotion.serialize(), status.HTTP_200_OK
+        return promotion.serialize(), status.HTTP_200_OK, {'ETag': '"{}"'.format(promotion.rev)}
 
     # ------------------------------------------------------------------
     # DELETE A PROMOTION
@@ -277,7 +686,7 @@ class ApplyResource(Resource):
     @api.response(404, 'Promotion not found')
     @api.response(400, 'The posted action data was not valid')
     @api.expect(product_list_model)
-    @api.marshal_with(product_list_model)
+    @marshal_compiled(product_list_model)
     def post(self, promotion_id):
         """
         Apply a promotion on a given set of products together with their prices
@@ -310,29 +719,36 @@ class ApplyResource(Resource):
                 should be a list of serialized product objects')
 
         # Apply promotion on products
-        products_with_new_prices = []
-        eligible_ids = promotion.products
-        non_eligible_ids = []
-        print(eligible_ids)
-        for product in products:
-            product_id = product['product_id']
-            try:
-                new_price = float(product['price'])
-            except ValueError:
-                raise DataValidationError(
-                    'The given product prices cannot convert to a float number')
-            if product_id in eligible_ids:
-                new_price = new_price * (promotion.percentage / 100.0)
-            else:
-                non_eligible_ids.append(product_id)
-            product['price'] = new_price
-            products_with_new_prices.append(product)
-
+        non_eligible_ids = promotion.apply(products)
         if len(non_eligible_ids) > 0:
             app.logger.info('The following products are not \
                 eligible to the given promotion: %s', non_eligible_ids)
 
-        return {"products": products_with_new_prices}, status.HTTP_200_OK
+        return {"products": products}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /promotions/apply
+######################################################################
+@api.route('/promotions/apply')
+class BestPriceResource(Resource):
+    """ Applies the best Promotions to a cart """
+    @api.doc('apply_best_promotions')
+    @api.response(400, 'The posted cart was not valid')
+    @api.expect(product_list_model)
+    @marshal_compiled(priced_product_list_model)
+    def post(self):
+        """
+        Apply the best active promotion to each product of a cart
+
+        Each product gets the lowest price offered by the promotions active
+        now that include it, and the id of that promotion.
+        Products that no active promotion includes keep their price.
+        """
+        check_content_type('application/json')
+        lines = cart_lines(request.get_json())
+        app.logger.info('Apply the best promotions to %d products', len(lines))
+        return {'products': Promotion.best_prices(lines)}, status.HTTP_200_OK
 
 
 ######################################################################
@@ -368,6 +784,24 @@ def request_validation_error(error):
     }, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(DataConflictError)
+def data_conflict_error(error):
+    """ Handles writes of Promotions that were changed since they were read """
+    message = str(error)
+    app.logger.warning(message)
+    if request.if_match:
+        return {
+            'status_code': status.HTTP_412_PRECONDITION_FAILED,
+            'error': 'Precondition Failed',
+            'message': message
+        }, status.HTTP_412_PRECONDITION_FAILED
+    return {
+        'status_code': status.HTTP_409_CONFLICT,
+        'error': 'Conflict',
+        'message': message
+    }, status.HTTP_409_CONFLICT
+
+
 @api.errorhandler(DatabaseConnectionError)
 def database_connection_error(error):
     """ Handles Database Errors from connection attempts """
@@ -392,6 +826,22 @@ def check_content_type(content_type):
     abort(415, 'Content-Type must be {}'.format(content_type))
 
 
+def encode_cursor(key):
+    """ Encodes a page key into an opaque cursor """
+    return base64.urlsafe_b64encode(json.dumps(key).encode('utf8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decodes an opaque cursor back into a page key """
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf8'))
+    except (binascii.Error, UnicodeError, ValueError):
+        raise DataValidationError('Invalid cursor: {}'.format(cursor))
+    if not isinstance(key, str):
+        raise DataValidationError('Invalid cursor: {}'.format(cursor))
+    return key
+
+
 def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
     if not app.debug:
@@ -422,5 +872,8 @@ def initialize_logging(log_level=logging.INFO):
 @app.route('/promotions/reset', methods=['DELETE'])
 def promotions_reset():
     """ Removes all promotions from the database """
-    Promotion.remove_all()
-    return make_response('', status.HTTP_204_NO_CONTENT)
+    result = Promotion.remove_all()
+    return make_response('', status.HTTP_204_NO_CONTENT, {
+        'X-Removed-Count': str(result['removed']),
+        'X-Reset-Duration': '{:.3f}'.format(result['seconds']),
+    })
@@ -0,0 +1,377 @@
+"""
+SQLite
+
+Stores the promotion documents in a local SQLite database, for edge and
+single-node deployments that do not run CouchDB.
+
+Every document is kept whole as JSON, next to indexed columns for the
+fields the finders select on, and a join table lists the products of each
+promotion so that a product lookup does not scan the documents.
+"""
+import json
+import logging
+import os
+import sqlite3
+import threading
+import uuid
+from service.metrics import db_call
+from service.storage import Storage, DatabaseConnectionError, InvalidBookmarkError, conflict
+
+SQLITE_DIR = os.environ.get('SQLITE_DIR', '.')
+SQLITE_TIMEOUT = float(os.environ.get('SQLITE_TIMEOUT', '30'))
+
+# the fields with a column of their own, the others are only in the JSON body
+COLUMNS = ('code', 'percentage', 'start_date', 'expiry_date')
+
+TABLES = (
+    'CREATE TABLE IF NOT EXISTS promotions ('
+    ' id TEXT PRIMARY KEY, rev TEXT NOT NULL,'
+    ' code TEXT, percentage INTEGER, start_date INTEGER, expiry_date INTEGER,'
+    ' body TEXT NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS promotion_products ('
+    ' product_id TEXT NOT NULL,'
+    ' promotion_id TEXT NOT NULL REFERENCES promotions (id) ON DELETE CASCADE,'
+    ' PRIMARY KEY (product_id, promotion_id)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS update_seq (id INTEGER PRIMARY KEY CHECK (id = 0),'
+    ' seq INTEGER NOT NULL)',
+    'INSERT OR IGNORE INTO update_seq (id, seq) VALUES (0, 0)',
+)
+
+INDEXES = (
+    'CREATE INDEX IF NOT EXISTS code_dates_idx'
+    ' ON promotions (code, start_date, expiry_date)',
+    'CREATE INDEX IF NOT EXISTS code_expiry_idx ON promotions (code, expiry_date)',
+    'CREATE INDEX IF NOT EXISTS dates_idx ON promotions (expiry_date, start_date)',
+    'CREATE INDEX IF NOT EXISTS promotion_products_idx ON promotion_products (promotion_id)',
+)
+
+OPERATORS = {'$eq': '=', '$ne': '!=', '$lt': '<', '$lte': '<=', '$gt': '>', '$gte': '>='}
+
+
+class SQLiteStorage(Storage):
+    """
+    Stores the documents in a SQLite database file
+
+    Each thread gets its own connection to the file. Writes run in
+    immediate transactions, so that the writers of every process are
+    serialized by SQLite, and the WAL journal lets readers go on meanwhile.
+    """
+    name = 'sqlite'
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self, path=None):
+        self.path = path
+        self.local = threading.local()
+
+    def open(self, dbname):
+        """ Opens the database file, creating its tables if needed """
+        self.path = self.path or os.path.join(SQLITE_DIR, '{}.sqlite3'.format(dbname))
+        self.logger.info('SQLite database: %s', self.path)
+        try:
+            connection = self.connection()
+            connection.execute('PRAGMA journal_mode = WAL')
+            with connection:
+                for statement in TABLES:
+                    connection.execute(statement)
+        except sqlite3.Error as error:
+            raise DatabaseConnectionError(
+                'Database [{}] could not be obtained: {}'.format(dbname, error))
+        return self
+
+    def create_indexes(self):
+        """ Creates the indexes on the code, the dates and the products if missing """
+        connection = self.connection()
+        with connection:
+            for statement in INDEXES:
+                connection.execute(statement)
+
+    def connection(self):
+        """ Returns the connection of the current thread """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT,
+                                         isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA foreign_keys = ON')
+            self.local.connection = connection
+        return connection
+
+    def close(self):
+        """ Closes the connection of the current thread """
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+
+    def _write(self, func, *args):
+        """ Runs a function in an immediate transaction and counts the write """
+        connection = self.connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            result = func(connection, *args)
+            connection.execute('UPDATE update_seq SET seq = seq + 1 WHERE id = 0')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+        return result
+
+    ######################################################################
+    #  D O C U M E N T S
+    ######################################################################
+    @db_call('find')
+    def get(self, document_id, cached=None):
+        """ Reads a document """
+        row = self.connection().execute(
+            'SELECT id, rev, body FROM promotions WHERE id = ?', (document_id,)).fetchone()
+        if row is None:
+            return None
+        if cached is not None and cached.get('_rev') == row[1]:
+            return cached
+        return _document(row)
+
+    @db_call('create_document')
+    def create(self, document):
+        """ Inserts a document with a new id """
+        document_id = document.get('_id') or uuid.uuid4().hex
+        rev = _next_rev(None)
+        self._write(_insert, document_id, rev, document)
+        return document_id, rev
+
+    @db_call('save')
+    def put(self, document):
+        """ Replaces a document if its _rev is the current one """
+        document_id = document['_id']
+        rev = _next_rev(document.get('_rev'))
+        if not self._write(_update, document_id, document.get('_rev'), rev, document):
+            raise conflict(document_id)
+        return rev
+
+    @db_call('delete')
+    def delete(self, document_id, rev):
+        """ Deletes a document if rev is its current revision """
+        def delete_row(connection):
+            cursor = connection.execute('DELETE FROM promotions WHERE id = ? AND rev = ?',
+                                        (document_id, rev))
+            return cursor.rowcount
+        if not self._write(delete_row):
+            return None
+        return _next_rev(rev)
+
+    @db_call('_bulk_docs')
+    def bulk_docs(self, documents):
+        """ Inserts many documents in one transaction """
+        def insert_all(connection):
+            rows = []
+            for document in documents:
+                document_id = document.get('_id') or uuid.uuid4().hex
+                rev = _next_rev(None)
+                try:
+                    _insert(connection, document_id, rev, document)
+                except sqlite3.IntegrityError:
+                    rows.append({'id': document_id, 'error': 'conflict',
+                                 'reason': 'Document update conflict.'})
+                    continue
+                rows.append({'id': document_id, 'rev': rev})
+            return rows
+        return self._write(insert_all)
+
+    ######################################################################
+    #  Q U E R I E S
+    ######################################################################
+    @db_call('_find')
+    def find(self, selector, limit=None, bookmark=None, fields=None, sort=None):
+        """
+        Runs a Mango selector as SQL, ordered by id or by the `sort` columns
+
+        The bookmark of a page is the id of its last document, so a sorted
+        query is read in a single page.
+        """
+        if bookmark is not None and not isinstance(bookmark, str):
+            raise InvalidBookmarkError('Invalid bookmark: {}'.format(bookmark))
+        if sort is not None and (bookmark is not None or
+                                 not all(name in COLUMNS for name in sort)):
+            raise ValueError('Invalid sort: {}'.format(sort))
+        where, params = _where(selector)
+        if bookmark is not None:
+            where.append('id > ?')
+            params.append(bookmark)
+        columns, document = _reader(fields)
+        sql = 'SELECT {} FROM promotions'.format(columns)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + ', '.join(list(sort or []) + ['id'])
+        if limit is None:
+            return [document(row) for row in self.connection().execute(sql, params)]
+        sql += ' LIMIT ?'
+        params.append(limit)
+        docs = [document(row) for row in self.connection().execute(sql, params)]
+        return docs, (docs[-1]['_id'] if len(docs) == limit and sort is None else None)
+
+    @db_call('_all_docs')
+    def all_docs(self, limit, startkey=None, fields=None):
+        """ Reads the documents in id order """
+        columns, document = _reader(fields)
+        sql = 'SELECT {} FROM promotions'.format(columns)
+        params = []
+        if startkey is not None:
+            sql += ' WHERE id >= ?'
+            params.append(startkey)
+        sql += ' ORDER BY id LIMIT ?'
+        params.append(limit)
+        return [document(row) for row in self.connection().execute(sql, params)]
+
+    def explain(self, selector):
+        """ Returns the query plan SQLite picks for a selector """
+        where, params = _where(selector)
+        sql = 'EXPLAIN QUERY PLAN SELECT id, rev, body FROM promotions'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [row[-1] for row in self.connection().execute(sql, params)]
+
+    @db_call('metadata')
+    def update_seq(self):
+        """ Returns the number of writes made to the database """
+        return self.connection().execute(
+            'SELECT seq FROM update_seq WHERE id = 0').fetchone()[0]
+
+    @db_call('remove_all')
+    def remove_all(self, strategy, chunk_size):
+        """
+        With the 'bulk' strategy the rows are deleted, with the 'recreate'
+        strategy the tables are dropped and created again
+        """
+        def delete_rows(connection):
+            removed = connection.execute('SELECT COUNT(*) FROM promotions').fetchone()[0]
+            if strategy == 'recreate':
+                connection.execute('DROP TABLE promotion_products')
+                connection.execute('DROP TABLE promotions')
+                for statement in TABLES + INDEXES:
+                    connection.execute(statement)
+            else:
+                connection.execute('DELETE FROM promotions')
+            return removed
+        return self._write(delete_rows)
+
+
+def _document(row):
+    """ Returns the document of a row """
+    document = json.loads(row[2])
+    document['_id'] = row[0]
+    document['_rev'] = row[1]
+    return document
+
+
+def _reader(fields):
+    """
+    Returns the columns to select for a projection on `fields`, and the
+    function that makes a document of each row
+
+    A projection on indexed columns only is read without the JSON body.
+    """
+    if fields is None:
+        return 'id, rev, body', _document
+    names = [name for name in fields if name not in ('_id', '_rev')]
+    if all(name in COLUMNS for name in names):
+        def from_columns(row):
+            document = dict(zip(names, row[2:]))
+            document['_id'] = row[0]
+            document['_rev'] = row[1]
+            return document
+        return ', '.join(['id', 'rev'] + names), from_columns
+
+    wanted = set(fields)
+
+    def from_body(row):
+        return {key: value for key, value in _document(row).items() if key in wanted}
+    return 'id, rev, body', from_body
+
+
+def _next_rev(rev):
+    """ Returns the revision that follows rev, N-uuid like CouchDB """
+    number = int(rev.split('-', 1)[0]) if rev else 0
+    return '{}-{}'.format(number + 1, uuid.uuid4().hex)
+
+
+def _values(document):
+    """ Returns the JSON body and the indexed columns of a document """
+    body = {key: value for key, value in document.items() if key not in ('_id', '_rev')}
+    columns = [document.get(field) for field in COLUMNS]
+    return [json.dumps(body)] + columns
+
+
+def _products(connection, document_id, document):
+    """ Fills the join table with the products of a document """
+    products = document.get('products')
+    if isinstance(products, list):
+        connection.executemany(
+            'INSERT OR IGNORE INTO promotion_products (product_id, promotion_id) VALUES (?, ?)',
+            [(str(product_id), document_id) for product_id in products])
+
+
+def _insert(connection, document_id, rev, document):
+    """ Inserts a new document """
+    connection.execute(
+        'INSERT INTO promotions (id, rev, body, {}) VALUES (?, ?, ?, ?, ?, ?, ?)'
+        .format(', '.join(COLUMNS)),
+        [document_id, rev] + _values(document))
+    _products(connection, document_id, document)
+
+
+def _update(connection, document_id, old_rev, rev, document):
+    """ Replaces a document if old_rev is its current revision """
+    cursor = connection.execute(
+        'UPDATE promotions SET rev = ?, body = ?, {} WHERE id = ? AND rev = ?'
+        .format(', '.join('{} = ?'.format(field) for field in COLUMNS)),
+        [rev] + _values(document) + [document_id, old_rev])
+    if cursor.rowcount:
+        connection.execute('DELETE FROM promotion_products WHERE promotion_id = ?',
+                           (document_id,))
+        _products(connection, document_id, document)
+    return cursor.rowcount
+
+
+def _where(selector):
+    """ Translates a Mango selector into SQL conditions and their parameters """
+    where = []
+    params = []
+    for field, condition in selector.items():
+        if field == 'products':
+            if not isinstance(condition, dict) or list(condition) != ['$elemMatch']:
+                raise ValueError('products can only be selected with $elemMatch')
+            column, match = 'product_id', condition['$elemMatch']
+            conditions, match_params = _conditions(column, match)
+            where.append('EXISTS (SELECT 1 FROM promotion_products'
+                         ' WHERE promotion_id = promotions.id AND {})'
+                         .format(' AND '.join(conditions)))
+            params.extend(match_params)
+            continue
+        if field == '_id':
+            column = 'id'
+        elif field in COLUMNS:
+            column = field
+        else:
+            raise ValueError('Unsupported selector field: {}'.format(field))
+        conditions, field_params = _conditions(column, condition)
+        where.extend(conditions)
+        params.extend(field_params)
+    return where, params
+
+
+def _conditions(column, condition):
+    """ Translates the condition on one field """
+    if not isinstance(condition, dict):
+        condition = {'$eq': condition}
+    conditions = []
+    params = []
+    for operator, value in condition.items():
+        if operator in OPERATORS:
+            conditions.append('{} {} ?'.format(column, OPERATORS[operator]))
+            params.append(value)
+        elif operator == '$in':
+            conditions.append('{} IN ({})'.format(column, ', '.join('?' * len(value))))
+            params.extend(value)
+        elif operator == '$exists':
+            conditions.append('{} IS {}NULL'.format(column, 'NOT ' if value else ''))
+        else:
+            raise ValueError('Unsupported selector operator: {}'.format(operator))
+    return conditions, params
@@ -0,0 +1,475 @@
+"""
+Storage
+
+The interface between the Promotion model and the database that keeps its
+documents, and the Cloudant implementation of it.
+
+Backends store JSON documents with an `_id` and a `_rev` like CouchDB does.
+A revision is written `N-...` where N counts the writes of the document,
+and a write must name the revision it replaces, so the caches, the replica
+and the conditional requests work the same whichever backend is used.
+"""
+import json
+import logging
+import os
+from cloudant.client import Cloudant
+from cloudant.document import Document
+from cloudant.query import Query
+from requests import HTTPError, ConnectionError
+from service.metrics import db_call
+from service.pool import PooledAdapter
+
+# get configruation from enviuronment (12-factor)
+ADMIN_PARTY = os.environ.get('ADMIN_PARTY', 'False').lower() == 'true'
+CLOUDANT_HOST = os.environ.get('CLOUDANT_HOST', 'localhost')
+CLOUDANT_PORT = int(os.environ.get('CLOUDANT_PORT', '5984'))
+CLOUDANT_USERNAME = os.environ.get('CLOUDANT_USERNAME', 'admin')
+CLOUDANT_PASSWORD = os.environ.get('CLOUDANT_PASSWORD', 'pass')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+DB_POOL_BLOCK = os.environ.get('DB_POOL_BLOCK', 'True').lower() == 'true'
+DB_KEEPALIVE = int(os.environ.get('DB_KEEPALIVE', '60'))
+DB_CONNECT_TIMEOUT = float(os.environ.get('DB_CONNECT_TIMEOUT', '5'))
+DB_READ_TIMEOUT = float(os.environ.get('DB_READ_TIMEOUT', '60'))
+FIND_PAGE_SIZE = int(os.environ.get('FIND_PAGE_SIZE', '1000'))
+
+# Mango JSON indexes declared on the database when it is opened
+INDEX_DESIGN_DOC = 'promotions'
+INDEXES = {
+    'code-idx': ['code'],
+    'code-dates-idx': ['code', 'start_date', 'expiry_date'],
+    'code-expiry-idx': ['code', 'expiry_date'],
+    'dates-idx': ['expiry_date', 'start_date'],
+}
+
+
+class DatabaseConnectionError(Exception):
+    """ Custom Exception when database connection fails """
+
+
+class DataConflictError(Exception):
+    """ Used when a promotion was changed since it was read """
+
+
+class InvalidBookmarkError(ValueError):
+    """ Used when the bookmark of a page cannot be read by the database """
+
+
+def conflict(document_id):
+    """ Returns the error raised when a document was changed since it was read """
+    return DataConflictError(
+        'Promotion with id \'{}\' was changed by someone else'.format(document_id))
+
+
+def index_for(selector):
+    """
+    Returns the name of the best index covering a selector, or None
+
+    A JSON index can only serve a query that references all of its
+    fields, so the covering index with the most fields wins.
+    """
+    best = None
+    for name, index_fields in INDEXES.items():
+        if all(field in selector for field in index_fields):
+            if best is None or len(index_fields) > len(INDEXES[best]):
+                best = name
+    return best
+
+
+class Storage():
+    """
+    The operations the Promotion model needs from a database
+
+    Selectors are Mango selectors: a field is matched against a value or
+    against an operator among $eq, $ne, $lt, $lte, $gt, $gte, $in, $exists,
+    and a list field like `products` with $elemMatch.
+    """
+    name = None
+
+    def open(self, dbname):
+        """ Connects to the database, creating it if needed """
+        raise NotImplementedError
+
+    def create_indexes(self):
+        """ Declares the indexes used by the finders if they are missing """
+        raise NotImplementedError
+
+    def connect(self):
+        """ Connects again after close() """
+
+    def close(self):
+        """ Releases the connections """
+
+    def get(self, document_id, cached=None):
+        """
+        Returns a document, or None when there is no such document
+
+        Args:
+            cached (dict): a copy of the document read before, returned
+                as is while its _rev is still the current one
+        """
+        raise NotImplementedError
+
+    def create(self, document):
+        """ Creates a document and returns its _id and _rev """
+        raise NotImplementedError
+
+    def put(self, document):
+        """
+        Replaces the revision named by the _rev of a document and returns
+        the new _rev, or raises DataConflictError if it is not the current one
+        """
+        raise NotImplementedError
+
+    def delete(self, document_id, rev):
+        """
+        Deletes a revision of a document and returns the _rev of its
+        tombstone, or None if that revision is not the current one
+        """
+        raise NotImplementedError
+
+    def bulk_docs(self, documents):
+        """ Creates many documents and returns a row with an id and a rev or an error for each """
+        raise NotImplementedError
+
+    def find(self, selector, limit=None, bookmark=None, fields=None, sort=None):
+        """
+        Returns the documents matching a selector and a bookmark
+
+        Without a limit every document is returned. With a limit the
+        bookmark tells where the next page starts. An InvalidBookmarkError
+        is raised for a bookmark that the database cannot read, and a
+        ValueError for a selector it cannot run. With `fields` the
+        documents only hold those fields, like the Mango fields option.
+        With `sort`, a list of indexed fields, the documents are ordered
+        on those fields in ascending order instead of on their id.
+        """
+        raise NotImplementedError
+
+    def all_docs(self, limit, startkey=None, fields=None):
+        """
+        Returns up to `limit` documents ordered by id, from the id `startkey` on
+
+        With `fields` the documents only hold those fields.
+        """
+        raise NotImplementedError
+
+    def update_seq(self):
+        """ Returns a value that changes on every write """
+        raise NotImplementedError
+
+    def remove_all(self, strategy, chunk_size):
+        """
+        Removes every document and returns how many there were
+
+        Args:
+            strategy (str): 'bulk' deletes the documents, 'recreate' drops
+                the database and creates it again
+            chunk_size (int): Number of documents deleted per request
+        """
+        raise NotImplementedError
+
+    def forget(self, document_id=None):
+        """ Forgets the copies of a document, or of all documents, held by the client """
+
+    def stats(self):
+        """ Returns the counters of the connection pool, if there is one """
+        return None
+
+
+class CloudantStorage(Storage):
+    """
+    Stores the documents in CouchDB or Cloudant
+
+    All the threads of a process share one client and one pooled adapter.
+    """
+    name = 'cloudant'
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self):
+        self.adapter = None  # service.pool.PooledAdapter shared by all the requests
+        self.client = None   # cloudant.client.Cloudant
+        self.database = None  # cloudant.database.CloudantDatabase
+
+    @staticmethod
+    def connection_options():
+        """
+        Returns the credentials and url of the Cloudant service
+
+        They come from VCAP_SERVICES on Bluemix, BINDING_CLOUDANT on
+        Kubernetes or the CLOUDANT_* variables otherwise.
+        """
+        opts = {}
+        vcap_services = {}
+        # Try and get VCAP from the environment or a file if developing
+        if 'VCAP_SERVICES' in os.environ:
+            CloudantStorage.logger.info('Running in Bluemix mode.')
+            vcap_services = json.loads(os.environ['VCAP_SERVICES'])
+        # if VCAP_SERVICES isn't found, maybe we are running on Kubernetes?
+        elif 'BINDING_CLOUDANT' in os.environ:
+            CloudantStorage.logger.info('Found Kubernetes Bindings')
+            creds = json.loads(os.environ['BINDING_CLOUDANT'])
+            vcap_services = {"cloudantNoSQLDB": [{"credentials": creds}]}
+        else:
+            CloudantStorage.logger.info(
+                'VCAP_SERVICES and BINDING_CLOUDANT undefined.')
+            creds = {
+                "username": CLOUDANT_USERNAME,
+                "password": CLOUDANT_PASSWORD,
+                "host": CLOUDANT_HOST,
+                "port": CLOUDANT_PORT,
+                "url": "http://{}:{}/".format(CLOUDANT_HOST, CLOUDANT_PORT)
+            }
+            vcap_services = {"cloudantNoSQLDB": [{"credentials": creds}]}
+
+        # Look for Cloudant in VCAP_SERVICES
+        for service in vcap_services:
+            if service.startswith('cloudantNoSQLDB'):
+                cloudant_service = vcap_services[service][0]
+                opts['username'] = cloudant_service['credentials']['username']
+                opts['password'] = cloudant_service['credentials']['password']
+                opts['host'] = cloudant_service['credentials']['host']
+                opts['port'] = cloudant_service['credentials']['port']
+                opts['url'] = cloudant_service['credentials']['url']
+
+        if any(k not in opts for k in ('host', 'username', 'password', 'port', 'url')):
+            raise DatabaseConnectionError('Error - Failed to retrieve options. '
+                                          'Check that app is bound to a Cloudant service.')
+        return opts
+
+    def open(self, dbname):
+        """
+        Initialized Coundant database connection
+        """
+        opts = self.connection_options()
+        self.logger.info('Cloudant Endpoint: %s', opts['url'])
+        try:
+            if ADMIN_PARTY:
+                self.logger.info('Running in Admin Party Mode...')
+            adapter = PooledAdapter(retries=10, initialBackoff=0.1,
+                                    pool_maxsize=DB_POOL_SIZE,
+                                    pool_block=DB_POOL_BLOCK,
+                                    keepalive=DB_KEEPALIVE)
+            client = Cloudant(opts['username'],
+                              opts['password'],
+                              url=opts['url'],
+                              connect=True,
+                              auto_renew=True,
+                              admin_party=ADMIN_PARTY,
+                              adapter=adapter,
+                              timeout=(DB_CONNECT_TIMEOUT, DB_READ_TIMEOUT)
+                              )
+        except ConnectionError:
+            raise DatabaseConnectionError(
+                'Cloudant service could not be reached')
+
+        # Create database if it doesn't exist
+        try:
+            database = client[dbname]
+        except KeyError:
+            # Create a database using an initialized client
+            database = client.create_database(dbname)
+        # check for success
+        if not database.exists():
+            raise DatabaseConnectionError(
+                'Database [{}] could not be obtained'.format(dbname))
+
+        self.adapter = adapter
+        self.client = client
+        self.database = database
+        return self
+
+    def connect(self):
+        """ Connect to the server """
+        self.client.connect()
+
+    def close(self):
+        """ Disconnect from the server """
+        if self.client is not None:
+            self.client.disconnect()
+
+    def create_indexes(self):
+        """ Declares the Mango indexes used by the finders if they are missing """
+        existing = {index['name'] for index in
+                    self.database.get_query_indexes(raw_result=True)['indexes']}
+        for name, index_fields in INDEXES.items():
+            if name in existing:
+                continue
+            self.logger.info('Creating index %s on %s', name, index_fields)
+            self.database.create_query_index(design_document_id=INDEX_DESIGN_DOC,
+                                             index_name=name,
+                                             fields=index_fields)
+
+    def _url(self, document_id):
+        """ Returns the url of a document """
+        return Document(self.database, document_id).document_url
+
+    @db_call('find')
+    def get(self, document_id, cached=None):
+        """ Fetches a document, revalidating a cached copy with If-None-Match """
+        headers = {}
+        if cached is not None:
+            headers['If-None-Match'] = '"{}"'.format(cached['_rev'])
+        resp = self.database.r_session.get(self._url(document_id), headers=headers)
+        if resp.status_code == 304:
+            return cached
+        if resp.status_code == 404:
+            return None
+        resp.raise_for_status()
+        return resp.json()
+
+    @db_call('create_document')
+    def create(self, document):
+        """ Creates a document """
+        created = self.database.create_document(document)
+        self.database.pop(created['_id'], None)
+        return created['_id'], created['_rev']
+
+    @db_call('save')
+    def put(self, document):
+        """ Writes a document with its _rev """
+        resp = self.database.r_session.put(self._url(document['_id']), json=document)
+        if resp.status_code == 409:
+            raise conflict(document['_id'])
+        resp.raise_for_status()
+        self.database.pop(document['_id'], None)
+        return resp.json()['rev']
+
+    @db_call('delete')
+    def delete(self, document_id, rev):
+        """ Deletes a revision of a document """
+        resp = self.database.r_session.delete(self._url(document_id), params={'rev': rev})
+        self.database.pop(document_id, None)
+        if resp.status_code in (404, 409):
+            return None
+        resp.raise_for_status()
+        return resp.json()['rev']
+
+    @db_call('_bulk_docs')
+    def bulk_docs(self, documents):
+        """ Creates many documents with one _bulk_docs call """
+        return self.database.bulk_docs(documents)
+
+    def _query(self, selector, fields=None, sort=None):
+        """ Builds a Mango query with the best index hint for a selector """
+        options = {'selector': selector}
+        if fields is not None:
+            options['fields'] = list(fields)
+        if sort is not None:
+            options['sort'] = [{name: 'asc'} for name in sort]
+        index = index_for(selector)
+        if index:
+            options['use_index'] = '_design/{}/{}'.format(INDEX_DESIGN_DOC, index)
+        return Query(self.database, **options)
+
+    @db_call('_find')
+    def find(self, selector, limit=None, bookmark=None, fields=None, sort=None):
+        """
+        Runs a Mango query, projected on `fields` and sorted on `sort` by CouchDB
+
+        Without a limit the documents are read FIND_PAGE_SIZE at a time,
+        and a page that is not full is the last one, so a query matching
+        fewer documents takes a single request.
+        """
+        query = self._query(selector, fields, sort)
+        if limit is None:
+            documents = []
+            while True:
+                docs, bookmark = self._find_page(query, FIND_PAGE_SIZE, bookmark)
+                documents.extend(docs)
+                if bookmark is None:
+                    return documents
+        return self._find_page(query, limit, bookmark)
+
+    @staticmethod
+    def _find_page(query, limit, bookmark):
+        """ Reads one page of a Mango query and the bookmark of the next one """
+        options = {'limit': limit}
+        if bookmark is not None:
+            options['bookmark'] = bookmark
+        try:
+            result = query(**options)
+        except HTTPError as err:
+            if err.response is not None and err.response.status_code == 400:
+                error = err.response.json()
+                if error.get('error') == 'invalid_bookmark':
+                    raise InvalidBookmarkError('Invalid bookmark: {}'.format(bookmark))
+                raise ValueError('Invalid query: {}'.format(error.get('reason')))
+            raise
+        docs = result['docs']
+        return docs, (result.get('bookmark') if len(docs) == limit else None)
+
+    @db_call('_all_docs')
+    def all_docs(self, limit, startkey=None, fields=None):
+        """
+        Reads _all_docs, skipping over the design documents mixed into it
+
+        _all_docs cannot project the documents, so with `fields` they are
+        read by a Mango query on the primary index, which can and which
+        leaves the design documents out.
+        """
+        if fields is not None:
+            selector = {'_id': {'$gt': None} if startkey is None else {'$gte': startkey}}
+            query = Query(self.database, selector=selector, fields=list(fields),
+                          sort=[{'_id': 'asc'}])
+            return query(limit=limit)['docs']
+        documents = []
+        while len(documents) < limit:
+            options = {'include_docs': True, 'limit': limit - len(documents)}
+            if startkey is not None:
+                options['startkey'] = startkey
+            rows = self.database.all_docs(**options).get('rows', [])
+            for row in rows:
+                if not row['id'].startswith('_design/'):
+                    documents.append(row['doc'])
+            if len(rows) < options['limit']:
+                break
+            startkey = rows[-1]['id'] + '\u0000'
+        return documents
+
+    @db_call('metadata')
+    def update_seq(self):
+        """ Returns the update sequence of the database """
+        return self.database.metadata()['update_seq']
+
+    @db_call('remove_all')
+    def remove_all(self, strategy, chunk_size):
+        """
+        With the 'bulk' strategy the ids and revisions are read from
+        _all_docs and tombstones are written back with one _bulk_docs call
+        per chunk. With the 'recreate' strategy the database is dropped and
+        created again with its indexes, which takes the same time however
+        many documents there are.
+        """
+        if strategy == 'recreate':
+            removed = self.database.doc_count() - len(self.database.list_design_documents())
+            self.database.delete()
+            self.database.create()
+            self.create_indexes()
+            return removed
+
+        removed = 0
+        startkey = None
+        while True:
+            options = {'limit': chunk_size}
+            if startkey is not None:
+                options['startkey'] = startkey
+            rows = self.database.all_docs(**options).get('rows', [])
+            tombstones = [{'_id': row['id'], '_rev': row['value']['rev'], '_deleted': True}
+                          for row in rows if not row['id'].startswith('_design/')]
+            if tombstones:
+                removed += sum(1 for row in self.database.bulk_docs(tombstones)
+                               if 'error' not in row)
+            if len(rows) < chunk_size:
+                return removed
+            startkey = rows[-1]['id'] + '\u0000'
+
+    def forget(self, document_id=None):
+        """ Drops the documents cached by the cloudant library """
+        if document_id is None:
+            self.database.clear()
+        else:
+            self.database.pop(document_id, None)
+
+    def stats(self):
+        """ Returns the counters of the pooled adapter """
+        return self.adapter.stats() if self.adapter else None
@@ -0,0 +1,175 @@
+"""
+Warm Up
+
+The startup sequence of a process. It connects to the database, makes sure
+the indexes exist and fills the in-process indexes before traffic comes,
+so the first requests after a deploy do not pay for it. Its progress is
+what the readiness endpoint reports.
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from service.models import Promotion
+
+WARM_UP_RETRY_DELAY = float(os.environ.get('WARM_UP_RETRY_DELAY', '5'))
+REPLICA_READY_TIMEOUT = float(os.environ.get('REPLICA_READY_TIMEOUT', '60'))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+
+class WarmUp():
+    """
+    Runs the warm-up stages in order and records how each one went
+
+    A stage that fails is tried again after WARM_UP_RETRY_DELAY seconds,
+    so a process started before its database comes up becomes ready once
+    the database does.
+    """
+    logger = logging.getLogger('flask.app')
+
+    def __init__(self, dbname='promotions'):
+        self.dbname = dbname
+        self.stages = [{'name': name, 'status': PENDING, 'seconds': None, 'error': None}
+                       for name in ('connect', 'indexes', 'replica', 'pricing', 'active')]
+        self.started_at = None
+        self.seconds = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self._stopped = threading.Event()
+
+    def is_ready(self):
+        """ True once every stage is done or skipped """
+        with self.lock:
+            return all(stage['status'] in (DONE, SKIPPED) for stage in self.stages)
+
+    def status(self):
+        """ Returns whether the process is ready and the state of each stage """
+        with self.lock:
+            stages = [dict(stage) for stage in self.stages]
+            seconds = self.seconds
+            if seconds is None and self.started_at is not None:
+                seconds = time.monotonic() - self.started_at
+        return {
+            'ready': all(stage['status'] in (DONE, SKIPPED) for stage in stages),
+            'seconds': seconds,
+            'stages': stages,
+        }
+
+    def _stage(self, name):
+        """ Returns the record of a stage """
+        return next(stage for stage in self.stages if stage['name'] == name)
+
+    def _set(self, name, **values):
+        """ Updates the record of a stage """
+        with self.lock:
+            self._stage(name).update(values)
+
+    @contextmanager
+    def stage(self, name):
+        """ Times a stage and records whether it failed """
+        self._set(name, status=RUNNING, error=None)
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as error:
+            self._set(name, status=FAILED, error=str(error),
+                      seconds=time.monotonic() - started)
+            raise
+        self._set(name, status=DONE, seconds=time.monotonic() - started)
+
+    def skip(self, name):
+        """ Records a stage that had nothing to do """
+        self._set(name, status=SKIPPED, seconds=0.0)
+
+    ######################################################################
+    #  S T A G E S
+    ######################################################################
+    def connect(self):
+        """ Opens the database and declares its indexes """
+        Promotion.ensure_db(self.dbname, stage=self.stage)
+        # a request may have connected the process already
+        for name in ('connect', 'indexes'):
+            with self.lock:
+                pending = self._stage(name)['status'] != DONE
+            if pending:
+                self.skip(name)
+
+    def replica(self):
+        """ Waits for the replica to bootstrap, when there is one """
+        if Promotion.replica is None:
+            self.skip('replica')
+            return
+        with self.stage('replica'):
+            if not Promotion.replica.wait_until_ready(REPLICA_READY_TIMEOUT):
+                raise TimeoutError('The replica is not ready after {}s'
+                                   .format(REPLICA_READY_TIMEOUT))
+
+    def pricing(self):
+        """ Builds the product index used to price carts """
+        with self.stage('pricing'):
+            Promotion.pricing_index()
+
+    def active(self):
+        """ Builds the set of active promotions """
+        with self.stage('active'):
+            Promotion.active_set()
+
+    def run(self):
+        """ Runs the stages that are not done yet, until they all are or stop() is called """
+        with self.lock:
+            self.started_at = time.monotonic()
+        for step in (self.connect, self.replica, self.pricing, self.active):
+            while not self._stopped.is_set():
+                try:
+                    step()
+                    break
+                except Exception as error:    # pylint: disable=broad-except
+                    self.logger.warning('Warm-up failed, trying again in %ss: %s',
+                                        WARM_UP_RETRY_DELAY, error)
+                    self._stopped.wait(WARM_UP_RETRY_DELAY)
+        with self.lock:
+            self.seconds = time.monotonic() - self.started_at
+        if self.is_ready():
+            self.logger.info('Warm-up done in %.3fs', self.seconds)
+        return self
+
+    def start(self):
+        """ Runs the stages in a background thread """
+        self.thread = threading.Thread(target=self.run, name='warm-up', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops retrying the failed stages """
+        self._stopped.set()
+
+
+# the warm-up of this process
+warm_up = None
+warm_up_lock = threading.Lock()
+
+
+def start(dbname='promotions'):
+    """ Starts the warm-up of this process unless it has one already """
+    global warm_up    # pylint: disable=global-statement
+    with warm_up_lock:
+        if warm_up is None:
+            warm_up = WarmUp(dbname).start()
+        return warm_up
+
+
+def after_fork():
+    """ Forgets the warm-up of the parent process, its thread did not survive the fork """
+    global warm_up, warm_up_lock    # pylint: disable=global-statement
+    warm_up = None
+    warm_up_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=after_fork)
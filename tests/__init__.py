@@ -1 +1,17 @@
 #Copyright 2019, 2019 Promotions@Devops. All rights reserved
+"""
+Tests of the Promotion service
+
+With COUCHDB_STANDIN=true the tests run against the in-process CouchDB
+stand-in of tests/couchdb_standin.py instead of the server at
+CLOUDANT_HOST, adding COUCHDB_LATENCY seconds to every request. It is
+started here so that the service reads its address on import.
+"""
+import os
+
+STANDIN = None
+if os.environ.get('COUCHDB_STANDIN', 'False').lower() == 'true':
+    from tests.couchdb_standin import CouchDBStandin
+    STANDIN = CouchDBStandin(latency=float(os.environ.get('COUCHDB_LATENCY', '0'))).start()
+    os.environ['CLOUDANT_HOST'] = STANDIN.host
+    os.environ['CLOUDANT_PORT'] = str(STANDIN.port)
@@ -0,0 +1,768 @@
+"""
+CouchDB Stand-in Server
+
+A lightweight, in-process server that speaks the subset of the CouchDB
+HTTP API used by the Promotion service: databases, documents, _all_docs,
+_find, _bulk_docs, _changes and _index. It can add latency to every call
+and inject 429 Too Many Requests responses so that tests and load tests
+see realistic network semantics without a real CouchDB.
+
+Run it stand-alone with:
+  python -m tests.couchdb_standin --port 5984 --latency 0.002
+"""
+import argparse
+import base64
+import bisect
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+MISSING = object()
+
+
+class CouchError(Exception):
+    """ Used to abort a stand-in request with a CouchDB style error """
+
+    def __init__(self, status, error, reason):
+        super(CouchError, self).__init__(reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+######################################################################
+#  M A N G O   S E L E C T O R S
+######################################################################
+def _field(doc, path):
+    """ Returns the value of a dotted field path or MISSING """
+    value = doc
+    for part in path.split('.'):
+        if not isinstance(value, dict) or part not in value:
+            return MISSING
+        value = value[part]
+    return value
+
+
+def _collate(value):
+    """ Sort key that follows the CouchDB collation order of JSON types """
+    if value is None or value is MISSING:
+        return (0,)
+    if value is False or value is True:
+        return (1, value)
+    if isinstance(value, (int, float)):
+        return (2, value)
+    if isinstance(value, str):
+        return (3, value)
+    if isinstance(value, list):
+        return (4, [_collate(item) for item in value])
+    return (5, sorted((key, _collate(item)) for key, item in value.items()))
+
+
+def _match_operator(value, operator, argument):
+    """ Evaluates a single Mango operator against a value """
+    if operator == '$exists':
+        return (value is not MISSING) == argument
+    if operator in ('$and', '$or', '$nor', '$not'):
+        raise CouchError(400, 'invalid_operator', 'misplaced ' + operator)
+    if operator == '$in':
+        if isinstance(value, list):
+            return any(item in argument for item in value)
+        return value is not MISSING and value in argument
+    if operator == '$nin':
+        return value is not MISSING and value not in argument
+    if operator == '$all':
+        return isinstance(value, list) and all(item in value for item in argument)
+    if operator == '$elemMatch':
+        return isinstance(value, list) and \
+            any(_match_value(item, argument) for item in value)
+    if operator == '$size':
+        return isinstance(value, list) and len(value) == argument
+    if value is MISSING:
+        return False
+    if operator == '$eq':
+        return value == argument
+    if operator == '$ne':
+        return value != argument
+    key, other = _collate(value), _collate(argument)
+    if operator == '$gt':
+        return key > other
+    if operator == '$gte':
+        return key >= other
+    if operator == '$lt':
+        return key < other
+    if operator == '$lte':
+        return key <= other
+    raise CouchError(400, 'invalid_operator', 'unknown operator ' + operator)
+
+
+def _match_value(value, condition):
+    """ Matches a value against an operator object or a literal """
+    if isinstance(condition, dict) and \
+            any(key.startswith('$') for key in condition):
+        for operator, argument in condition.items():
+            if operator == '$not':
+                if _match_value(value, argument):
+                    return False
+            elif not _match_operator(value, operator, argument):
+                return False
+        return True
+    if isinstance(condition, dict):
+        return isinstance(value, dict) and matches(value, condition)
+    return value is not MISSING and value == condition
+
+
+def matches(doc, selector):
+    """ Returns True when a document satisfies a Mango selector """
+    for key, condition in selector.items():
+        if key == '$and':
+            if not all(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$nor':
+            if any(matches(doc, sub) for sub in condition):
+                return False
+        elif key == '$not':
+            if matches(doc, condition):
+                return False
+        elif not _match_value(_field(doc, key), condition):
+            return False
+    return True
+
+
+def id_range_start(selector):
+    """ Returns the first id and whether it is included of an _id range selector """
+    condition = selector.get('_id')
+    if not isinstance(condition, dict):
+        return None, True
+    if isinstance(condition.get('$gte'), str):
+        return condition['$gte'], True
+    if isinstance(condition.get('$gt'), str):
+        return condition['$gt'], False
+    return None, True
+
+
+def project(doc, fields):
+    """ Returns only the requested top level fields of a document """
+    if not fields:
+        return doc
+    result = {}
+    for name in fields:
+        value = _field(doc, name)
+        if value is not MISSING:
+            result[name] = value
+    return result
+
+
+######################################################################
+#  D A T A B A S E
+######################################################################
+class Database():
+    """ An in-memory CouchDB database with a sequence numbered change log """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = {}          # id -> latest document body (with _rev)
+        self.deleted = {}       # id -> rev of the tombstone
+        self.changes = {}       # id -> seq of its last change, ordered by seq
+        self.seq = 0
+        self.instance = uuid.uuid4().hex[:8]
+        self.changed = threading.Condition()
+
+    # ------------------------------------------------------------------
+    def seq_token(self, seq=None):
+        """ Formats an opaque update sequence like CouchDB 2+ does """
+        return '{}-{}'.format(self.seq if seq is None else seq, self.instance)
+
+    def parse_seq(self, since):
+        """ Parses a since= token back into an integer sequence """
+        if since in (None, '', '0', 0):
+            return 0
+        if since == 'now':
+            return self.seq
+        text = str(since)
+        number, _, instance = text.partition('-')
+        if instance and instance != self.instance:
+            return 0
+        try:
+            return int(number)
+        except ValueError:
+            raise CouchError(400, 'bad_request', 'Malformed sequence supplied')
+
+    def info(self):
+        """ Returns the database metadata document """
+        return {
+            'db_name': self.name,
+            'doc_count': len(self.docs),
+            'doc_del_count': len(self.deleted),
+            'update_seq': self.seq_token(),
+            'instance_start_time': '0',
+        }
+
+    # ------------------------------------------------------------------
+    def write(self, doc, rev=None):
+        """ Creates, updates or deletes a document, checking revisions """
+        doc = dict(doc)
+        doc_id = doc.get('_id') or uuid.uuid4().hex
+        rev = doc.get('_rev', rev)
+        current = self.docs.get(doc_id)
+        if current is not None and current['_rev'] != rev:
+            raise CouchError(409, 'conflict', 'Document update conflict.')
+        if current is None and doc_id in self.deleted and rev and \
+                rev != self.deleted[doc_id]:
+            raise CouchError(409, 'conflict', 'Document update conflict.')
+        if current is None and rev and doc_id not in self.deleted:
+            raise CouchError(409, 'conflict', 'Document update conflict.')
+        if doc.get('_deleted') and current is None:
+            raise CouchError(404, 'not_found', 'deleted')
+        previous = current['_rev'] if current else self.deleted.get(doc_id)
+        generation = int(previous.split('-')[0]) + 1 if previous else 1
+        body = {k: v for k, v in doc.items() if k not in ('_id', '_rev')}
+        digest = hashlib.md5(json.dumps(body, sort_keys=True).encode('utf8'))
+        new_rev = '{}-{}'.format(generation, digest.hexdigest())
+        self.seq += 1
+        # only the last change of a document is in the feed, moved to its end
+        self.changes.pop(doc_id, None)
+        self.changes[doc_id] = self.seq
+        if doc.get('_deleted'):
+            self.docs.pop(doc_id, None)
+            self.deleted[doc_id] = new_rev
+        else:
+            self.deleted.pop(doc_id, None)
+            body['_id'] = doc_id
+            body['_rev'] = new_rev
+            self.docs[doc_id] = body
+        with self.changed:
+            self.changed.notify_all()
+        return doc_id, new_rev
+
+    def sorted_ids(self):
+        """ Returns all document ids in _all_docs (raw) order """
+        return sorted(self.docs)
+
+
+class StandinState():
+    """ Holds the databases and fault injection settings of a stand-in """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.lock = threading.RLock()
+        self.databases = {}
+        self.latency = latency
+        self.error_rate = error_rate
+        self.pending_429 = 0
+        self.requests = 0
+        self.responses_429 = 0
+
+    def fail_next(self, count=1):
+        """ Makes the next `count` requests answer 429 Too Many Requests """
+        with self.lock:
+            self.pending_429 += count
+
+    def should_throttle(self):
+        """ Decides whether the current request gets a 429 """
+        with self.lock:
+            self.requests += 1
+            if self.pending_429 > 0:
+                self.pending_429 -= 1
+                self.responses_429 += 1
+                return True
+            if self.error_rate and random.random() < self.error_rate:
+                self.responses_429 += 1
+                return True
+        return False
+
+
+######################################################################
+#  R E Q U E S T   H A N D L E R
+######################################################################
+class StandinHandler(BaseHTTPRequestHandler):
+    """ Translates CouchDB HTTP requests into operations on the state """
+    protocol_version = 'HTTP/1.1'
+    # the headers and the body are separate writes, which Nagle's algorithm
+    # would hold back until the client acknowledges the first one
+    disable_nagle_algorithm = True
+    server_version = 'CouchDB/3.1.1 (Stand-in)'
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        """ Keep the stand-in quiet """
+
+    @property
+    def state(self):
+        """ The shared stand-in state """
+        return self.server.state
+
+    def do_GET(self):   # pylint: disable=invalid-name
+        """ Handles GET requests """
+        self._dispatch('GET')
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """ Handles HEAD requests """
+        self._dispatch('HEAD')
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        """ Handles POST requests """
+        self._dispatch('POST')
+
+    def do_PUT(self):   # pylint: disable=invalid-name
+        """ Handles PUT requests """
+        self._dispatch('PUT')
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        """ Handles DELETE requests """
+        self._dispatch('DELETE')
+
+    # ------------------------------------------------------------------
+    def _dispatch(self, method):
+        """ Routes a request to the matching handler method """
+        url = urlsplit(self.path)
+        self.query = dict(parse_qsl(url.query, keep_blank_values=True))
+        length = int(self.headers.get('Content-Length') or 0)
+        self.raw_body = self.rfile.read(length) if length else b''
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if self.state.should_throttle():
+            self._send(429, {'error': 'too_many_requests',
+                             'reason': 'You have exceeded your request rate'})
+            return
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        if len(parts) >= 3 and parts[1] in ('_design', '_local'):
+            parts = [parts[0], parts[1] + '/' + parts[2]] + parts[3:]
+        try:
+            with self.state.lock:
+                status, body, headers = self._route(method, parts)
+        except CouchError as error:
+            status, body, headers = error.status, \
+                {'error': error.error, 'reason': error.reason}, {}
+        if status == 'longpoll':
+            status, body, headers = self._longpoll(*body)
+        self._send(status, body, headers, head=method == 'HEAD')
+
+    def _send(self, status, body, headers=None, head=False):
+        """ Writes a JSON response """
+        data = b'' if body is None else json.dumps(body).encode('utf8') + b'\n'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('Cache-Control', 'must-revalidate')
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def _json_body(self):
+        """ Parses the request body as JSON """
+        content_type = self.headers.get('Content-Type', '')
+        if content_type.startswith('application/x-www-form-urlencoded'):
+            return dict(parse_qsl(self.raw_body.decode('utf8')))
+        try:
+            return json.loads(self.raw_body.decode('utf8') or 'null')
+        except ValueError:
+            raise CouchError(400, 'bad_request', 'invalid UTF-8 JSON')
+
+    def _param(self, name, default=None):
+        """ Returns a JSON encoded query string parameter """
+        if name not in self.query:
+            return default
+        try:
+            return json.loads(self.query[name])
+        except ValueError:
+            return self.query[name]
+
+    def _database(self, name):
+        """ Looks up a database or raises 404 """
+        database = self.state.databases.get(name)
+        if database is None:
+            raise CouchError(404, 'not_found', 'Database does not exist.')
+        return database
+
+    # ------------------------------------------------------------------
+    def _route(self, method, parts):
+        """ Maps a request path onto the CouchDB API """
+        if not parts:
+            return 200, {'couchdb': 'Welcome', 'version': '3.1.1',
+                         'vendor': {'name': 'stand-in'}}, {}
+        if parts[0] == '_session':
+            return 200, {'ok': True, 'name': 'admin', 'roles': ['_admin'],
+                         'userCtx': {'name': 'admin', 'roles': ['_admin']}}, \
+                {'Set-Cookie': 'AuthSession=standin; Version=1; Path=/; HttpOnly'}
+        if parts[0] == '_all_dbs':
+            return 200, sorted(self.state.databases), {}
+        if parts[0] == '_up':
+            return 200, {'status': 'ok'}, {}
+        if len(parts) == 1:
+            return self._database_request(method, parts[0])
+        database = self._database(parts[0])
+        handler = {
+            '_all_docs': self._all_docs,
+            '_find': self._find,
+            '_explain': self._find,
+            '_bulk_docs': self._bulk_docs,
+            '_changes': self._changes,
+            '_index': self._index,
+            '_ensure_full_commit': lambda db, m, p: (201, {'ok': True}, {}),
+        }.get(parts[1])
+        if handler:
+            return handler(database, method, parts[2:])
+        return self._document(database, method, parts[1])
+
+    def _database_request(self, method, name):
+        """ Creates, inspects or deletes a database """
+        if method in ('GET', 'HEAD'):
+            return 200, self._database(name).info(), {}
+        if method == 'PUT':
+            if name in self.state.databases:
+                raise CouchError(412, 'file_exists', 'The database could not '
+                                 'be created, the file already exists.')
+            self.state.databases[name] = Database(name)
+            return 201, {'ok': True}, {}
+        if method == 'DELETE':
+            self._database(name)
+            del self.state.databases[name]
+            return 200, {'ok': True}, {}
+        if method == 'POST':
+            database = self._database(name)
+            doc_id, rev = database.write(self._json_body())
+            return 201, {'ok': True, 'id': doc_id, 'rev': rev}, \
+                {'ETag': '"{}"'.format(rev)}
+        raise CouchError(405, 'method_not_allowed', 'Only GET,HEAD,PUT,DELETE,POST allowed')
+
+    def _document(self, database, method, doc_id):
+        """ Reads, writes or deletes a single document """
+        if method in ('GET', 'HEAD'):
+            doc = database.docs.get(doc_id)
+            if doc is None:
+                reason = 'deleted' if doc_id in database.deleted else 'missing'
+                raise CouchError(404, 'not_found', reason)
+            etag = '"{}"'.format(doc['_rev'])
+            if self.headers.get('If-None-Match') == etag:
+                return 304, None, {'ETag': etag}
+            return 200, doc, {'ETag': etag}
+        rev = self.query.get('rev') or \
+            (self.headers.get('If-Match') or '').strip('"') or None
+        if method == 'PUT':
+            doc = self._json_body()
+            doc['_id'] = doc_id
+            doc_id, new_rev = database.write(doc, rev)
+            return 201, {'ok': True, 'id': doc_id, 'rev': new_rev}, \
+                {'ETag': '"{}"'.format(new_rev)}
+        if method == 'DELETE':
+            if doc_id not in database.docs:
+                raise CouchError(404, 'not_found', 'missing')
+            doc_id, new_rev = database.write({'_id': doc_id, '_deleted': True}, rev)
+            return 200, {'ok': True, 'id': doc_id, 'rev': new_rev}, \
+                {'ETag': '"{}"'.format(new_rev)}
+        raise CouchError(405, 'method_not_allowed', 'Only GET,HEAD,PUT,DELETE allowed')
+
+    # ------------------------------------------------------------------
+    def _all_docs(self, database, method, _):
+        """ Implements the _all_docs primary index """
+        options = dict((k, self._param(k)) for k in self.query)
+        if method == 'POST':
+            options.update(self._json_body() or {})
+        keys = options.get('keys')
+        descending = bool(options.get('descending'))
+        include_docs = bool(options.get('include_docs'))
+        if keys is not None:
+            ids = list(keys)
+        else:
+            ids = database.sorted_ids()
+            if descending:
+                ids.reverse()
+            start = options.get('startkey', options.get('start_key'))
+            end = options.get('endkey', options.get('end_key'))
+            if 'key' in options:
+                start = end = options['key']
+            inclusive_end = options.get('inclusive_end', True)
+            if start is not None:
+                ids = [i for i in ids if (i <= start if descending else i >= start)]
+            if end is not None:
+                if inclusive_end:
+                    ids = [i for i in ids if (i >= end if descending else i <= end)]
+                else:
+                    ids = [i for i in ids if (i > end if descending else i < end)]
+        total = len(database.docs)
+        skip = int(options.get('skip') or 0)
+        ids = ids[skip:]
+        if options.get('limit') is not None:
+            ids = ids[:int(options['limit'])]
+        rows = []
+        for doc_id in ids:
+            doc = database.docs.get(doc_id)
+            if doc is None:
+                if keys is not None:
+                    rows.append({'key': doc_id, 'error': 'not_found'})
+                continue
+            row = {'id': doc_id, 'key': doc_id, 'value': {'rev': doc['_rev']}}
+            if include_docs:
+                row['doc'] = doc
+            rows.append(row)
+        return 200, {'total_rows': total, 'offset': skip, 'rows': rows,
+                     'update_seq': database.seq_token()}, {}
+
+    def _find(self, database, method, _):
+        """ Implements Mango _find queries with bookmarks """
+        if method != 'POST':
+            raise CouchError(405, 'method_not_allowed', 'Only POST allowed')
+        query = self._json_body() or {}
+        selector = query.get('selector')
+        if not isinstance(selector, dict):
+            raise CouchError(400, 'bad_request', 'selector is required')
+        limit = int(query.get('limit', 25))
+        skip = int(query.get('skip') or 0)
+        sort = query.get('sort') or []
+        offset = skip
+        bookmark = query.get('bookmark')
+        if bookmark and bookmark != 'nil':
+            try:
+                offset = int(base64.urlsafe_b64decode(bookmark.encode('ascii')))
+            except (ValueError, TypeError):
+                raise CouchError(400, 'invalid_bookmark', 'Invalid bookmark value')
+        # like the primary index, a range of _id sorted on _id reads only that range
+        by_id = all(spec in ('_id', {'_id': 'asc'}) for spec in sort)
+        ids = database.sorted_ids()
+        start, included = id_range_start(selector)
+        if by_id and start is not None:
+            ids = ids[(bisect.bisect_left if included else bisect.bisect_right)(ids, start):]
+        docs = []
+        for doc_id in ids:
+            doc = database.docs[doc_id]
+            if not doc_id.startswith('_design/') and matches(doc, selector):
+                docs.append(doc)
+                if by_id and len(docs) >= offset + limit:
+                    break
+        for spec in reversed(sort if not by_id else []):
+            if isinstance(spec, dict):
+                (name, direction), = spec.items()
+            else:
+                name, direction = spec, 'asc'
+            docs.sort(key=lambda d, n=name: _collate(_field(d, n)),
+                      reverse=direction == 'desc')
+        page = docs[offset:offset + limit]
+        next_offset = offset + len(page)
+        result = {
+            'docs': [project(doc, query.get('fields')) for doc in page],
+            'bookmark': base64.urlsafe_b64encode(
+                str(next_offset).encode('ascii')).decode('ascii'),
+        }
+        use_index = query.get('use_index')
+        if use_index and not self._index_exists(database, use_index):
+            result['warning'] = '_design/{} was not used because it does ' \
+                'not contain a valid index for this query.'.format(use_index)
+        if method == 'POST' and self.path.split('?')[0].endswith('_explain'):
+            return 200, {'dbname': database.name, 'selector': selector,
+                         'index': {'ddoc': None}}, {}
+        return 200, result, {}
+
+    @staticmethod
+    def _index_exists(database, use_index):
+        """ Checks a use_index hint against the declared indexes """
+        if isinstance(use_index, list):
+            use_index = '/'.join(use_index)
+        parts = use_index.split('/')
+        if parts[0] == '_design':
+            parts = parts[1:]
+        doc = database.docs.get('_design/' + parts[0])
+        if doc is None or doc.get('language') != 'query':
+            return False
+        return len(parts) == 1 or parts[1] in doc.get('views', {})
+
+    def _bulk_docs(self, database, method, _):
+        """ Implements _bulk_docs with per document results """
+        if method != 'POST':
+            raise CouchError(405, 'method_not_allowed', 'Only POST allowed')
+        body = self._json_body() or {}
+        results = []
+        for doc in body.get('docs', []):
+            try:
+                doc_id, rev = database.write(doc)
+                results.append({'ok': True, 'id': doc_id, 'rev': rev})
+            except CouchError as error:
+                results.append({'id': doc.get('_id'), 'error': error.error,
+                                'reason': error.reason})
+        return 201, results, {}
+
+    def _changes(self, database, method, _):
+        """ Implements the normal and longpoll _changes feed """
+        options = dict((k, self._param(k)) for k in self.query)
+        if method == 'POST':
+            options.update(self._json_body() or {})
+        since = database.parse_seq(self.query.get('since'))
+        if options.get('feed') == 'longpoll' and since >= database.seq:
+            timeout = float(options.get('timeout') or 60000) / 1000.0
+            return 'longpoll', (database, since, options, timeout), {}
+        return 200, self._changes_result(database, since, options), {}
+
+    def _longpoll(self, database, since, options, timeout):
+        """ Waits (outside the state lock) until a change arrives """
+        deadline = time.time() + timeout
+        with database.changed:
+            while database.seq <= since and time.time() < deadline:
+                database.changed.wait(max(0.0, deadline - time.time()))
+        with self.state.lock:
+            return 200, self._changes_result(database, since, options), {}
+
+    @staticmethod
+    def _changes_result(database, since, options):
+        """ Builds a _changes response for everything after `since` """
+        include_docs = bool(options.get('include_docs'))
+        limit = options.get('limit')
+        results = []
+        last = since
+        pending = 0
+        for doc_id, seq in database.changes.items():
+            if seq <= since:
+                continue
+            if limit is not None and len(results) >= int(limit):
+                pending += 1
+                continue
+            doc = database.docs.get(doc_id)
+            if doc is not None:
+                row = {'seq': database.seq_token(seq), 'id': doc_id,
+                       'changes': [{'rev': doc['_rev']}]}
+                if include_docs:
+                    row['doc'] = doc
+            else:
+                rev = database.deleted[doc_id]
+                row = {'seq': database.seq_token(seq), 'id': doc_id,
+                       'changes': [{'rev': rev}], 'deleted': True}
+                if include_docs:
+                    row['doc'] = {'_id': doc_id, '_rev': rev, '_deleted': True}
+            results.append(row)
+            last = seq
+        return {'results': results, 'last_seq': database.seq_token(last),
+                'pending': pending}
+
+    def _index(self, database, method, parts):
+        """ Lists, creates and deletes Mango JSON indexes """
+        if method == 'GET':
+            indexes = [{'ddoc': None, 'name': '_all_docs', 'type': 'special',
+                        'def': {'fields': [{'_id': 'asc'}]}}]
+            for doc_id in database.sorted_ids():
+                doc = database.docs[doc_id]
+                if not doc_id.startswith('_design/') or doc.get('language') != 'query':
+                    continue
+                for name, view in doc.get('views', {}).items():
+                    indexes.append({'ddoc': doc_id, 'name': name, 'type': 'json',
+                                    'def': view['options']['def']})
+            return 200, {'total_rows': len(indexes), 'indexes': indexes}, {}
+        if method == 'POST':
+            body = self._json_body() or {}
+            index = body.get('index') or {}
+            fields = index.get('fields')
+            if not fields:
+                raise CouchError(400, 'missing_required_key', 'Missing required key: fields')
+            fields = [f if isinstance(f, dict) else {f: 'asc'} for f in fields]
+            name = body.get('name') or hashlib.sha1(
+                json.dumps(fields, sort_keys=True).encode('utf8')).hexdigest()
+            ddoc = body.get('ddoc') or name
+            ddoc_id = ddoc if ddoc.startswith('_design/') else '_design/' + ddoc
+            doc = dict(database.docs.get(ddoc_id) or
+                       {'_id': ddoc_id, 'language': 'query', 'views': {}})
+            views = dict(doc.get('views', {}))
+            definition = {'fields': fields}
+            if name in views and views[name]['options']['def'] == definition:
+                return 200, {'result': 'exists', 'id': ddoc_id, 'name': name}, {}
+            views[name] = {'map': {'fields': dict(
+                (k, v) for f in fields for k, v in f.items())},
+                           'reduce': '_count', 'options': {'def': definition}}
+            doc['views'] = views
+            database.write(doc)
+            return 200, {'result': 'created', 'id': ddoc_id, 'name': name}, {}
+        if method == 'DELETE' and len(parts) >= 3:
+            ddoc_id = parts[0] if parts[0].startswith('_design/') \
+                else '_design/' + parts[0]
+            doc = database.docs.get(ddoc_id)
+            if doc is None or parts[-1] not in doc.get('views', {}):
+                raise CouchError(404, 'not_found', 'Index not found')
+            doc = dict(doc)
+            doc['views'] = dict((k, v) for k, v in doc['views'].items()
+                                if k != parts[-1])
+            database.write(doc)
+            return 200, {'ok': True}, {}
+        raise CouchError(405, 'method_not_allowed', 'Only GET,POST,DELETE allowed')
+
+
+######################################################################
+#  S E R V E R
+######################################################################
+class CouchDBStandin():
+    """
+    Runs a stand-in CouchDB server on a background thread
+
+    Usage:
+        with CouchDBStandin(port=5984, latency=0.001) as standin:
+            ...
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0):
+        self.state = StandinState(latency=latency, error_rate=error_rate)
+        self.httpd = ThreadingHTTPServer((host, port), StandinHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.state = self.state
+        self.thread = None
+
+    @property
+    def host(self):
+        """ The host the stand-in listens on """
+        return self.httpd.server_address[0]
+
+    @property
+    def port(self):
+        """ The port the stand-in listens on """
+        return self.httpd.server_address[1]
+
+    @property
+    def url(self):
+        """ The base URL of the stand-in """
+        return 'http://{}:{}/'.format(self.host, self.port)
+
+    def start(self):
+        """ Starts serving requests on a daemon thread """
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       name='couchdb-standin', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stops the server """
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def fail_next(self, count=1):
+        """ Injects 429 responses for the next `count` requests """
+        self.state.fail_next(count)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main(argv=None):
+    """ Runs the stand-in from the command line """
+    parser = argparse.ArgumentParser(description='CouchDB stand-in server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5984)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds of latency added to every request')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='fraction of requests answered with 429')
+    args = parser.parse_args(argv)
+    standin = CouchDBStandin(args.host, args.port, args.latency, args.error_rate)
+    print('CouchDB stand-in listening on {}'.format(standin.url))
+    try:
+        standin.httpd.serve_forever()
+    except KeyboardInterrupt:
+        standin.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -11,6 +11,14 @@ from factory.fuzzy import FuzzyChoice
 from service.models import Promotion
 
 
+def promotion_document(code='SAVE', products=(), start_date=0, expiry_date=1000, **fields):
+    """ Returns a promotion document, with any other `fields` given, like its _id """
+    document = {'code': code, 'percentage': 80, 'products': list(products),
+                'start_date': start_date, 'expiry_date': expiry_date}
+    document.update(fields)
+    return document
+
+
 class PromotionFactory(factory.Factory):
     """ Creates fake promotions that you don't have to feed """
     class Meta:
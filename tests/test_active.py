@@ -0,0 +1,72 @@
+"""
+Test cases for the Active Set
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import time
+from unittest import TestCase
+from service.active import ActiveSet
+from .promotion_factory import promotion_document
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestActiveSet(TestCase):
+    """ Test cases for ActiveSet """
+
+    def setUp(self):
+        """ Runs before each test """
+        now = int(time.time())
+        self.active = ActiveSet().load([
+            promotion_document(start_date=now - 100, expiry_date=now + 100, _id='current'),
+            promotion_document(start_date=now + 1000, expiry_date=now + 2000, _id='future'),
+            promotion_document(start_date=now - 200, expiry_date=now - 100, _id='expired'),
+        ])
+
+    def tearDown(self):
+        """ Runs after each test """
+        self.active.stop()
+
+    def test_load(self):
+        """ Compute the active set and drop expired promotions """
+        self.assertEqual([doc['_id'] for doc in self.active.current()], ['current'])
+        self.assertNotIn('expired', self.active.documents)
+        self.assertLessEqual(self.active.next_refresh, time.time() + 101)
+
+    def test_at(self):
+        """ Answer for other times from the promotions not expired yet """
+        now = int(time.time())
+        self.assertEqual([doc['_id'] for doc in self.active.at(now + 1500)], ['future'])
+        self.assertEqual(self.active.at(now + 5000), [])
+        self.assertIsNone(self.active.at(now - 150))
+
+    def test_apply_changes(self):
+        """ Keep the set current as promotions change """
+        now = int(time.time())
+        self.active.apply(promotion_document(start_date=now - 10, expiry_date=now + 10,
+                                             _id='future'))
+        self.assertEqual(len(self.active), 2)
+        self.active.apply({'_id': 'current', '_rev': '2-x', '_deleted': True})
+        self.assertEqual([doc['_id'] for doc in self.active.current()], ['future'])
+        self.active.apply(promotion_document(start_date=now - 200, expiry_date=now - 100,
+                                             _id='expired'))
+        self.assertNotIn('expired', self.active.documents)
+
+    def test_refresh_at_boundaries(self):
+        """ A timer refreshes the set when a promotion starts and expires """
+        now = int(time.time())
+        self.active.apply(promotion_document(start_date=now + 1, expiry_date=now + 2, _id='soon'))
+        self.assertEqual(len(self.active), 1)
+        self.assertLessEqual(self.active.next_refresh, now + 1)
+        deadline = time.time() + 4
+        while 'soon' not in self.active.active and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertIn('soon', self.active.active)
+        while 'soon' in self.active.documents and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertNotIn('soon', self.active.active)
+        self.assertNotIn('soon', self.active.documents)
@@ -0,0 +1,221 @@
+"""
+Test cases for the Async Models and the ASGI application
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import asyncio
+import json
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+import aiohttp
+from service import asgi
+from service.aio import AsyncPromotionStore
+from service.models import Promotion, DataValidationError, DatabaseConnectionError, \
+    STORAGE_BACKEND
+from .promotion_factory import PromotionFactory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+@skipIf(STORAGE_BACKEND != 'cloudant', 'needs CouchDB')
+class AsyncTestCase(TestCase):
+    """ Runs each test with a store opened on a new event loop """
+
+    def setUp(self):
+        """ Runs before each test """
+        Promotion.init_db("test")
+        Promotion.remove_all()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.store = self.run_async(AsyncPromotionStore('test').open())
+
+    def tearDown(self):
+        """ Runs after each test """
+        self.run_async(self.store.close())
+        self.loop.close()
+
+    def run_async(self, coroutine):
+        """ Runs a coroutine on the event loop of the test """
+        return self.loop.run_until_complete(coroutine)
+
+
+class TestAsyncPromotionStore(AsyncTestCase):
+    """ Test cases for AsyncPromotionStore """
+
+    def test_create_and_find(self):
+        """ Create a Promotion and find it by id and code """
+        promotion = PromotionFactory(code='SAVE15')
+        self.run_async(self.store.create(promotion))
+        self.assertIsNotNone(promotion.id)
+        self.assertTrue(promotion.rev.startswith('1-'))
+
+        found = self.run_async(self.store.find(promotion.id))
+        self.assertEqual(found.serialize(), promotion.serialize())
+        self.assertIsNone(self.run_async(self.store.find('not-there')))
+        found = self.run_async(self.store.find_by_code('SAVE15'))
+        self.assertEqual([p.id for p in found], [promotion.id])
+        # the sync model sees it too
+        self.assertEqual(Promotion.find(promotion.id).code, 'SAVE15')
+
+    def test_pricing_index_loaded_once(self):
+        """ Concurrent requests share the load of the product index """
+        PromotionFactory(products=['p1']).save()
+        with patch.object(self.store, 'all', wraps=self.store.all) as all_mock:
+            indexes = self.run_async(asyncio.gather(
+                *[self.store.pricing_index() for _ in range(5)]))
+            self.assertEqual(all_mock.call_count, 1)
+            self.assertTrue(all(index is indexes[0] for index in indexes))
+            self.assertEqual(len(indexes[0]), 1)
+
+            # a stale index is served while a new one loads
+            with patch('service.aio.PRODUCT_INDEX_TTL', -1):
+                self.assertIs(self.run_async(self.store.pricing_index()), indexes[0])
+                self.run_async(self.store.index_load)
+            self.assertEqual(all_mock.call_count, 2)
+            self.assertIsNot(self.store.product_index, indexes[0])
+
+    def test_create_conflicting(self):
+        """ Overlapping Promotions with the same code are rejected """
+        self.run_async(self.store.create(PromotionFactory(code='SAVE15')))
+        promotion = PromotionFactory(code='SAVE15')
+        self.assertRaises(DataValidationError, self.run_async, self.store.create(promotion))
+        self.assertIsNone(promotion.id)
+
+    def test_create_many(self):
+        """ Create Promotions in bulk """
+        promotions = [PromotionFactory(code='SAVE15'), PromotionFactory(code='SAVE15'),
+                      PromotionFactory(code='SAVE20'), PromotionFactory(code=None)]
+        results = self.run_async(self.store.create_many(promotions, chunk_size=1))
+        self.assertEqual([result['ok'] for result in results], [True, False, True, False])
+        self.assertEqual(len(self.run_async(self.store.all())), 2)
+
+    def test_create_many_racing_a_writer(self):
+        """ A bulk promotion overlapping one saved meanwhile is rolled back """
+        promotions = [PromotionFactory(code='SAVE15', start_date=1000, expiry_date=2000),
+                      PromotionFactory(code='SAVE15', start_date=3000, expiry_date=4000)]
+        accept_batch = Promotion.accept_batch
+
+        def racing_writer(valid, existing, results):
+            self.assertTrue(self.store.code_locks['SAVE15'].locked())
+            Promotion.storage.create(PromotionFactory(
+                code='SAVE15', start_date=3500, expiry_date=3600).serialize())
+            return accept_batch(valid, existing, results)
+
+        with patch('service.models.Promotion.accept_batch', side_effect=racing_writer):
+            results = self.run_async(self.store.create_many(promotions))
+        self.assertEqual([result['ok'] for result in results], [True, False])
+        self.assertIsNone(promotions[1].id)
+        found = self.run_async(self.store.find_by_code('SAVE15'))
+        self.assertEqual(sorted(p.start_date for p in found), [1000, 3500])
+
+    def test_find_many_concurrently(self):
+        """ Many finds wait on the database at the same time """
+        promotions = PromotionFactory.batch_create(5)
+
+        async def find_all():
+            return await asyncio.gather(*(self.store.find(p.id) for p in promotions * 20))
+        found = self.run_async(find_all())
+        self.assertEqual(len(found), 100)
+        self.assertEqual({p.id for p in found}, {p.id for p in promotions})
+
+    def test_find_errors(self):
+        """ Errors of CouchDB are not read as promotions """
+        async def unauthorized(*_args, **_kwargs):
+            return 401, {'error': 'unauthorized', 'reason': 'Name or password is incorrect.'}
+        with patch.object(self.store, '_request', unauthorized):
+            for coroutine in (self.store.find('some-id'), self.store.find_by_code('SAVE15'),
+                              self.store.all(), self.store.create_indexes()):
+                self.assertRaises(DatabaseConnectionError, self.run_async, coroutine)
+
+    def test_all_in_pages(self):
+        """ Read all Promotions a page at a time """
+        promotions = PromotionFactory.batch_create(5)
+        with patch('service.aio.PAGE_SIZE', 2):
+            found = self.run_async(self.store.all())
+            by_code = self.run_async(self.store.find_by_code(promotions[0].code))
+        self.assertEqual(sorted(p.id for p in found), sorted(p.id for p in promotions))
+        self.assertEqual(len(by_code), len([p for p in promotions
+                                            if p.code == promotions[0].code]))
+
+
+class TestAsgiApplication(AsyncTestCase):
+    """ Test cases for the ASGI application """
+
+    def setUp(self):
+        """ Runs before each test """
+        super(TestAsgiApplication, self).setUp()
+        patcher = patch('service.asgi.store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, method, path, body=None, query='',
+                content_type='application/json'):
+        """ Sends a request to the application and returns its status and JSON """
+        scope = {'type': 'http', 'method': method, 'path': path,
+                 'query_string': query.encode('latin-1'),
+                 'headers': [(b'content-type', content_type.encode('latin-1'))]}
+        messages = [{'type': 'http.request', 'more_body': False,
+                     'body': json.dumps(body).encode('utf8') if body is not None else b''}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+        self.run_async(asgi.app(scope, receive, send))
+        return sent[0]['status'], json.loads(sent[1]['body'].decode('utf8'))
+
+    def test_read_promotions(self):
+        """ Read Promotions """
+        promotion = PromotionFactory(code='SAVE15')
+        promotion.save()
+        status, data = self.request('GET', '/promotions/{}'.format(promotion.id))
+        self.assertEqual(status, 200)
+        self.assertEqual(data, promotion.serialize())
+        status, data = self.request('GET', '/promotions', query='promotion-code=SAVE15')
+        self.assertEqual([p['id'] for p in data], [promotion.id])
+        status, data = self.request('GET', '/promotions')
+        self.assertEqual(len(data), 1)
+        status, _ = self.request('GET', '/promotions/not-there')
+        self.assertEqual(status, 404)
+        status, _ = self.request('DELETE', '/promotions/{}'.format(promotion.id))
+        self.assertEqual(status, 405)
+
+    def test_database_unavailable(self):
+        """ Database connection errors and timeouts are answered with 503 """
+        for error in (aiohttp.ClientConnectionError('refused'), asyncio.TimeoutError(),
+                      DatabaseConnectionError('down')):
+            with patch.object(self.store, 'find', side_effect=error):
+                status, data = self.request('GET', '/promotions/some-id')
+            self.assertEqual(status, 503)
+            self.assertTrue(data['message'])
+
+    def test_apply_promotions(self):
+        """ Apply a Promotion and the best Promotions to products """
+        now = int(time.time())
+        promotion = Promotion(code='SAVE20', percentage=80, products=['p1'],
+                              start_date=now - 1000, expiry_date=now + 1000)
+        promotion.save()
+        cart = {'products': [{'product_id': 'p1', 'price': 100},
+                             {'product_id': 'p2', 'price': 10}]}
+
+        status, data = self.request('POST', '/promotions/{}/apply'.format(promotion.id), cart)
+        self.assertEqual(status, 200)
+        self.assertEqual([p['price'] for p in data['products']], [80.0, 10.0])
+
+        status, data = self.request('POST', '/promotions/apply', cart)
+        self.assertEqual(status, 200)
+        self.assertEqual(data['products'][0], {'product_id': 'p1', 'price': 80.0,
+                                               'promotion_id': promotion.id})
+        self.assertIsNone(data['products'][1]['promotion_id'])
+
+        status, _ = self.request('POST', '/promotions/apply', {'products': {}})
+        self.assertEqual(status, 400)
+        status, _ = self.request('POST', '/promotions/apply', cart, content_type='text/xml')
+        self.assertEqual(status, 415)
@@ -0,0 +1,71 @@
+"""
+Test cases for the LRU Cache
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+from service.cache import LRUCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestLRUCache(TestCase):
+    """ Test cases for LRUCache """
+
+    def test_get_and_put(self):
+        """ Cache values and count hits and misses """
+        cache = LRUCache(size=2, ttl=60)
+        self.assertIsNone(cache.get('a'))
+        cache.put('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_evicts_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        cache = LRUCache(size=2, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    @patch('service.cache.time.monotonic')
+    def test_stale_entries(self, monotonic_mock):
+        """ Entries go stale after the TTL and can be revalidated """
+        monotonic_mock.return_value = 100.0
+        cache = LRUCache(size=2, ttl=5)
+        cache.put('a', 1)
+        monotonic_mock.return_value = 106.0
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get_stale('a'), 1)
+        cache.touch('a')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats()['revalidations'], 1)
+
+    def test_invalidate_and_clear(self):
+        """ Remove one or all entries """
+        cache = LRUCache(size=4, ttl=60)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.invalidate('a')
+        self.assertIsNone(cache.get_stale('a'))
+        self.assertEqual(cache.get('b'), 2)
+        cache.clear()
+        self.assertIsNone(cache.get_stale('b'))
+
+    def test_disabled_cache(self):
+        """ A cache of size 0 stores nothing """
+        cache = LRUCache(size=0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
@@ -0,0 +1,126 @@
+"""
+Test cases for the Compression Middleware
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import gzip
+import json
+import zlib
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from flask_api import status    # HTTP Status Codes
+from service import app
+from service.compression import brotli
+from service.models import Promotion
+from .promotion_factory import PromotionFactory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestCompressionMiddleware(TestCase):
+    """ Test cases for CompressionMiddleware """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.app = app.test_client()
+        Promotion.init_db("test")
+        Promotion.remove_all()
+
+    def test_compress_list(self):
+        """ Large responses are compressed for the clients that accept it """
+        PromotionFactory.batch_create(20)
+        resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        body = resp.get_data()
+        self.assertEqual(int(resp.headers['Content-Length']), len(body))
+        self.assertEqual(len(json.loads(gzip.decompress(body).decode('utf8'))), 20)
+
+        resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(len(resp.get_json()), 20)
+
+    def test_compressed_etags(self):
+        """ Compressed responses have their own strong ETag, accepted when revalidating """
+        promotion = PromotionFactory.batch_create(20)[0]
+        identity = self.app.get('/promotions').headers['ETag']
+        resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['ETag'], identity[:-1] + '-gzip"')
+
+        resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip',
+                                                    'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers['ETag'], identity[:-1] + '-gzip"')
+        resp = self.app.get('/promotions', headers={'If-None-Match': identity})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        rev = Promotion.find(promotion.id).rev
+        resp = self.app.put('/promotions/{}'.format(promotion.id),
+                            json=promotion.serialize(),
+                            headers={'If-Match': '"{}-gzip"'.format(rev)})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    @skipIf(brotli is None, 'needs brotli')
+    def test_compress_brotli(self):
+        """ Brotli is preferred when it is installed """
+        PromotionFactory.batch_create(20)
+        resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(len(json.loads(brotli.decompress(resp.get_data()))), 20)
+
+    def test_small_responses_are_not_compressed(self):
+        """ Responses below COMPRESS_MIN_SIZE are sent as they are """
+        resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', resp.headers)
+        self.assertEqual(resp.get_json(), [])
+        with patch('service.compression.COMPRESS_MIN_SIZE', 0):
+            resp = self.app.get('/promotions', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(json.loads(gzip.decompress(resp.get_data())), [])
+
+    @patch('service.compression.COMPRESS_FLUSH_SIZE', 100)
+    def test_compress_stream(self):
+        """ Streamed responses are compressed as they stream """
+        PromotionFactory.batch_create(10)
+        resp = self.app.get('/promotions', headers={'Accept': 'application/x-ndjson',
+                                                    'Accept-Encoding': 'gzip'})
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        chunks = list(resp.response)
+        self.assertGreater(len(chunks), 2)
+        # every flushed chunk can be read without waiting for the next
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertTrue(decompressor.decompress(chunks[0] + chunks[1]).endswith(b'\n'))
+        lines = gzip.decompress(b''.join(chunks)).decode('utf8').splitlines()
+        self.assertEqual(len(lines), 10)
+
+    def test_compressed_request_body(self):
+        """ Carts can be posted compressed to the apply endpoint """
+        promotion = PromotionFactory(products=['p1'], percentage=50)
+        promotion.save()
+        url = '/promotions/{}/apply'.format(promotion.id)
+        cart = json.dumps({'products': [{'product_id': 'p1', 'price': 10},
+                                        {'product_id': 'p2', 'price': 20}]})
+        resp = self.app.post(url, data=gzip.compress(cart.encode('utf8')),
+                             content_type='application/json',
+                             headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([product['price'] for product in resp.get_json()['products']],
+                         [5.0, 20.0])
+
+        resp = self.app.post(url, data=b'not gzip', content_type='application/json',
+                             headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post(url, data=cart, content_type='application/json',
+                             headers={'Content-Encoding': 'compress'})
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        with patch('service.compression.COMPRESS_MAX_BODY', 10):
+            resp = self.app.post(url, data=gzip.compress(cart.encode('utf8')),
+                                 content_type='application/json',
+                                 headers={'Content-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertIn('too large', resp.get_json()['message'])
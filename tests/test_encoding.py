@@ -0,0 +1,57 @@
+"""
+Test cases for the compiled serializers
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import json
+from unittest import TestCase
+from flask_restplus import marshal
+from service import app
+from service.encoding import compile_model, output_json
+from service.models import Promotion
+from service.service import promotion_model, product_list_model, \
+    priced_product_list_model, bulk_result_model
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestEncoding(TestCase):
+    """ Test cases for compile_model and output_json """
+
+    def assert_same(self, model, data):
+        """ The compiled serializer gives what flask-restplus marshals """
+        expected = json.loads(json.dumps(marshal(data, model)))
+        self.assertEqual(compile_model(model)(data), expected)
+
+    def test_promotion_model(self):
+        """ Promotions are serialized from dicts and from objects """
+        promotion = Promotion(code='SAVE15', products=['p1', 'p2'], percentage='80',
+                              start_date=0, expiry_date=1000)
+        promotion.id = 'abc'
+        self.assert_same(promotion_model, promotion.serialize())
+        self.assert_same(promotion_model, promotion)
+        self.assert_same(promotion_model, {'code': 15, 'extra': 'dropped'})
+        self.assertEqual(list(compile_model(promotion_model)(promotion)),
+                         list(promotion_model))
+
+    def test_nested_models(self):
+        """ Lists of nested models convert every item """
+        self.assert_same(product_list_model, {'products': [
+            {'product_id': 'p1', 'price': 10}, {'product_id': 2, 'price': '2.5'},
+            {'product_id': 'p3'}]})
+        self.assert_same(product_list_model, {})
+        self.assert_same(priced_product_list_model, {'products': [
+            {'product_id': 'p1', 'price': 8.0, 'promotion_id': 'abc'}]})
+        self.assert_same(bulk_result_model, {'index': 0, 'id': None, 'ok': 1, 'error': None})
+
+    def test_output_json(self):
+        """ Responses are compact JSON, indented in debug mode """
+        with app.test_request_context():
+            response = output_json({'a': [1, 2]}, 201, {'X-Test': 'yes'})
+            self.assertEqual(response.get_data(), b'{"a":[1,2]}\n')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(response.headers['X-Test'], 'yes')
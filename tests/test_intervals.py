@@ -0,0 +1,88 @@
+"""
+Test cases for the Interval Indexes
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+from unittest import TestCase
+from service.intervals import IntervalIndex, CodeIntervals, CodeLocks
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestIntervalIndex(TestCase):
+    """ Test cases for IntervalIndex """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.index = IntervalIndex()
+        for number in range(100):
+            start = number * 1000
+            self.index.add('p{}'.format(number), start, start + 500)
+
+    def test_overlapping(self):
+        """ Find windows overlapping a range """
+        self.assertEqual(self.index.overlapping(5200, 5300), 'p5')
+        self.assertEqual(self.index.overlapping(5400, 6100), 'p6')
+        self.assertEqual(self.index.overlapping(4900, 5100), 'p5')
+        self.assertEqual(self.index.overlapping(-100, 0), 'p0')
+        self.assertEqual(self.index.overlapping(99500, 99600), 'p99')
+        self.assertIsNone(self.index.overlapping(5501, 5999))
+        self.assertIsNone(self.index.overlapping(100000, 200000))
+
+    def test_containing_range(self):
+        """ A range containing a whole window overlaps it """
+        self.assertEqual(self.index.overlapping(4800, 6600), 'p6')
+        self.assertIsNotNone(self.index.overlapping(-10**9, 10**9))
+
+    def test_exclude_own_window(self):
+        """ Ignore the window of the promotion being updated """
+        self.assertIsNone(self.index.overlapping(5000, 5600, exclude='p5'))
+        self.assertEqual(self.index.overlapping(5000, 6000, exclude='p5'), 'p6')
+
+    def test_long_window(self):
+        """ Find a long window that started well before the range """
+        self.index.add('long', 10, 50000)
+        self.assertEqual(self.index.overlapping(40600, 40700), 'long')
+
+    def test_move_and_remove(self):
+        """ Move and remove windows """
+        self.index.add('p5', 300000, 300100)
+        self.assertIsNone(self.index.overlapping(5000, 5500))
+        self.assertEqual(self.index.overlapping(300050, 300060), 'p5')
+        self.index.remove('p5')
+        self.index.remove('unknown')
+        self.assertIsNone(self.index.overlapping(300050, 300060))
+        self.assertEqual(len(self.index), 99)
+
+
+class TestCodeIntervals(TestCase):
+    """ Test cases for CodeIntervals """
+
+    def test_apply_changes(self):
+        """ Keep windows per code as documents change """
+        intervals = CodeIntervals()
+        doc = {'_id': 'a', 'code': 'SAVE15', 'start_date': 10, 'expiry_date': 20}
+        intervals.apply(None, doc)
+        self.assertEqual(intervals.overlapping('SAVE15', 15, 16), 'a')
+        self.assertIsNone(intervals.overlapping('SAVE20', 15, 16))
+
+        moved = dict(doc, code='SAVE20')
+        intervals.apply(doc, moved)
+        self.assertIsNone(intervals.overlapping('SAVE15', 15, 16))
+        self.assertEqual(intervals.overlapping('SAVE20', 15, 16), 'a')
+
+        intervals.apply(moved, None)
+        self.assertIsNone(intervals.overlapping('SAVE20', 15, 16))
+
+        intervals.apply(None, {'_id': 'b', 'code': 'SAVE15'})
+        self.assertIsNone(intervals.overlapping('SAVE15', 0, 100))
+
+    def test_code_locks(self):
+        """ The same code always gets the same lock """
+        locks = CodeLocks()
+        self.assertIs(locks('SAVE15'), locks('SAVE15'))
+        self.assertIsNot(locks('SAVE15'), locks('SAVE20'))
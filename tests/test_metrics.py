@@ -0,0 +1,89 @@
+"""
+Test cases for the Metrics
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+from unittest import TestCase
+from unittest.mock import MagicMock
+from service import metrics
+from service.metrics import Counter, Gauge, Histogram, Registry
+from service.pool import PooledAdapter
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestMetrics(TestCase):
+    """ Test cases for the metrics """
+
+    def test_counter_and_gauge(self):
+        """ Render counters and gauges with their labels """
+        registry = Registry()
+        counter = registry.register(Counter('calls_total', 'Calls', ('operation',)))
+        gauge = registry.register(Gauge('in_flight', 'In flight'))
+        counter.inc('find')
+        counter.inc('find')
+        counter.inc('say "hi"')
+        gauge.inc()
+        gauge.inc()
+        gauge.dec()
+        self.assertEqual(counter.get('find'), 2)
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP calls_total Calls',
+            '# TYPE calls_total counter',
+            'calls_total{operation="find"} 2',
+            'calls_total{operation="say \\"hi\\""} 1',
+            '# HELP in_flight In flight',
+            '# TYPE in_flight gauge',
+            'in_flight 1',
+        ]) + '\n')
+
+    def test_histogram(self):
+        """ Values are counted in cumulative buckets """
+        histogram = Histogram('latency_seconds', 'Latency', ('endpoint',), buckets=(0.1, 1.0))
+        histogram.observe(0.05, 'index')
+        histogram.observe(0.1, 'index')
+        histogram.observe(0.5, 'index')
+        histogram.observe(3.0, 'index')
+        with histogram.time('stats'):
+            pass
+        self.assertEqual(histogram.count('index'), 4)
+        self.assertEqual(histogram.count('stats'), 1)
+        lines = histogram.render().split('\n')
+        self.assertIn('latency_seconds_bucket{endpoint="index",le="0.1"} 2', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="index",le="1.0"} 3', lines)
+        self.assertIn('latency_seconds_bucket{endpoint="index",le="+Inf"} 4', lines)
+        self.assertIn('latency_seconds_count{endpoint="index"} 4', lines)
+        self.assertIn('latency_seconds_sum{endpoint="index"} 3.65', lines)
+
+    def test_db_call(self):
+        """ Storage calls are timed and their errors counted """
+        class Storage():
+            """ A storage that fails on demand """
+            name = 'test'
+
+            @metrics.db_call('save')
+            def put(self, fail):
+                """ Writes a document """
+                if fail:
+                    raise ValueError('conflict')
+                return 'ok'
+        storage = Storage()
+        self.assertEqual(storage.put(False), 'ok')
+        self.assertRaises(ValueError, storage.put, True)
+        self.assertEqual(Storage.put.__doc__.strip(), 'Writes a document')
+        self.assertEqual(metrics.DB_CALL_SECONDS.count('test', 'save'), 2)
+        self.assertEqual(metrics.DB_ERRORS.get('test', 'save'), 1)
+
+    def test_429_retries_are_counted(self):
+        """ The pooled adapter counts the 429 responses it replays """
+        adapter = PooledAdapter(retries=3, initialBackoff=0)
+        retry = adapter.max_retries
+        self.assertEqual(retry.status_forcelist, [429])
+        before = metrics.DB_RETRIES_429.get()
+        retry = retry.increment('GET', '/test', response=MagicMock(status=429))
+        retry.increment('GET', '/test', response=MagicMock(status=429))
+        self.assertEqual(metrics.DB_RETRIES_429.get(), before + 2)
@@ -0,0 +1,67 @@
+"""
+Test cases for the Pooled Adapter
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import threading
+import time
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from service.models import Promotion, STORAGE_BACKEND
+from service.pool import PooledAdapter
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestPooledAdapter(TestCase):
+    """ Test cases for PooledAdapter """
+
+    def test_pool_options(self):
+        """ The pool is created with the configured size and socket options """
+        adapter = PooledAdapter(pool_maxsize=3, pool_block=True, keepalive=30)
+        pool = adapter.poolmanager.connection_from_url('http://localhost:5984/')
+        self.assertEqual(pool.pool.maxsize, 3)
+        self.assertTrue(pool.block)
+        self.assertIn(30, [option[2] for option in
+                           adapter.poolmanager.connection_pool_kw['socket_options']])
+        self.assertEqual(adapter.stats()['size'], 3)
+
+    def test_count_waits(self):
+        """ Requests beyond the size of the pool are counted as waits """
+        adapter = PooledAdapter(pool_maxsize=1, pool_block=True)
+
+        def slow_send(*args, **kwargs):
+            time.sleep(0.1)
+
+        with patch('cloudant.adapters.Replay429Adapter.send', side_effect=slow_send):
+            threads = [threading.Thread(target=adapter.send, args=(None,))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            time.sleep(0.05)
+            self.assertEqual(adapter.stats()['in_use'], 3)
+            for thread in threads:
+                thread.join()
+        stats = adapter.stats()
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['max_in_use'], 3)
+        self.assertEqual(stats['waits'], 2)
+        self.assertEqual(stats['requests'], 3)
+
+    @skipIf(STORAGE_BACKEND != 'cloudant', 'needs CouchDB')
+    def test_client_uses_adapter(self):
+        """ init_db shares one pooled adapter and sets timeouts """
+        with patch('service.storage.DB_POOL_SIZE', 4), \
+                patch('service.storage.DB_READ_TIMEOUT', 7.0):
+            Promotion.init_db('test')
+        self.assertEqual(Promotion.storage.adapter.stats()['size'], 4)
+        self.assertEqual(Promotion.storage.client.r_session._timeout[1], 7.0)
+        Promotion.find('not-there')
+        stats = Promotion.storage.adapter.stats()
+        self.assertGreater(stats['requests'], 0)
+        self.assertGreaterEqual(stats['idle'], 1)
+        Promotion.init_db('test')
@@ -0,0 +1,59 @@
+"""
+Test cases for the Product Index
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+from unittest import TestCase
+from service.pricing import ProductIndex
+from .promotion_factory import promotion_document
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestProductIndex(TestCase):
+    """ Test cases for ProductIndex """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.index = ProductIndex()
+        self.index.apply(promotion_document(products=['p1', 'p2'], _id='a', percentage=80))
+        self.index.apply(promotion_document(products=['p2', 'p3'], _id='b', percentage=60))
+        self.index.apply(promotion_document(products=['p1'], start_date=2000, expiry_date=3000,
+                                            _id='c', percentage=10))
+
+    def test_best_promotion(self):
+        """ Find the best active promotion of a product """
+        self.assertEqual(self.index.best('p1', 500), (80, 'a'))
+        self.assertEqual(self.index.best('p2', 500), (60, 'b'))
+        self.assertEqual(self.index.best('p1', 2500), (10, 'c'))
+        self.assertIsNone(self.index.best('p3', 1500))
+        self.assertIsNone(self.index.best('p4', 500))
+
+    def test_price_cart(self):
+        """ Price every line of a cart """
+        lines = [{'product_id': 'p1', 'price': 100.0},
+                 {'product_id': 'p2', 'price': 10.0},
+                 {'product_id': 'p4', 'price': 5.0}]
+        self.index.price(lines, now=500)
+        self.assertEqual(lines, [
+            {'product_id': 'p1', 'price': 80.0, 'promotion_id': 'a'},
+            {'product_id': 'p2', 'price': 6.0, 'promotion_id': 'b'},
+            {'product_id': 'p4', 'price': 5.0, 'promotion_id': None},
+        ])
+
+    def test_apply_changes(self):
+        """ Keep the index current as promotions change """
+        self.index.apply(promotion_document(products=['p3'], _id='b', percentage=90))
+        self.assertEqual(self.index.best('p2', 500), (80, 'a'))
+        self.assertEqual(self.index.best('p3', 500), (90, 'b'))
+        self.index.apply({'_id': 'a', '_rev': '2-x', '_deleted': True})
+        self.assertIsNone(self.index.best('p2', 500))
+        self.assertNotIn('p2', self.index.products)
+        self.index.apply({'_id': 'd', 'code': 'SAVE'})
+        self.assertEqual(len(self.index), 2)
+        self.index.clear()
+        self.assertIsNone(self.index.best('p3', 500))
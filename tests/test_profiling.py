@@ -0,0 +1,70 @@
+"""
+Test cases for the Profiler Middleware
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import pstats
+import shutil
+import tempfile
+from unittest import TestCase
+from unittest.mock import patch
+from flask_api import status    # HTTP Status Codes
+from service import app
+from service.models import Promotion
+from .promotion_factory import PromotionFactory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+@patch('service.profiling.PROFILE_SECRET', 's3cret')
+class TestProfilerMiddleware(TestCase):
+    """ Test cases for ProfilerMiddleware """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.app = app.test_client()
+        Promotion.init_db("test")
+        Promotion.remove_all()
+        self.promotion = PromotionFactory()
+        self.promotion.save()
+        self.url = '/promotions/{}'.format(self.promotion.id)
+
+    def test_report(self):
+        """ A request with the secret gets the profile report """
+        resp = self.app.get(self.url, headers={'X-Profile': 's3cret'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['X-Profile-Status'], '200 OK')
+        report = resp.get_data(as_text=True)
+        self.assertTrue(report.startswith('GET {} -> 200 OK in'.format(self.url)))
+        self.assertIn('function calls', report)
+        self.assertIn('find_document', report)
+
+        resp = self.app.get('/promotions/not-there?profile=s3cret')
+        self.assertEqual(resp.headers['X-Profile-Status'], '404 NOT FOUND')
+
+    def test_stored(self):
+        """ With PROFILE_DIR the profile is stored and the response kept """
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with patch('service.profiling.PROFILE_DIR', directory):
+            resp = self.app.get(self.url, headers={'X-Profile': 's3cret'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['id'], self.promotion.id)
+        stats = pstats.Stats(os.path.join(directory, resp.headers['X-Profile-File']))
+        self.assertTrue(any(function[2] == 'from_document' for function in stats.stats))
+
+    def test_not_asked(self):
+        """ Requests without the right secret are not profiled """
+        for headers, query in (({}, ''), ({'X-Profile': 'guess'}, ''), ({}, '?profile=guess')):
+            resp = self.app.get(self.url + query, headers=headers)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertNotIn('X-Profile-Status', resp.headers)
+            self.assertEqual(resp.get_json()['id'], self.promotion.id)
+        with patch('service.profiling.PROFILE_SECRET', None):
+            resp = self.app.get(self.url, headers={'X-Profile': 's3cret'})
+        self.assertNotIn('X-Profile-Status', resp.headers)
@@ -5,12 +5,17 @@ Test cases can be run with:
   coverage report -m
 """
 
-from unittest import TestCase
+import threading
+import time
+from unittest import TestCase, skipIf
 from unittest.mock import patch
 from requests import ConnectionError
 import json
 from service import app
-from service.models import Promotion, DataValidationError, DatabaseConnectionError
+from service.models import Promotion, DataValidationError, \
+    DatabaseConnectionError, STORAGE_BACKEND
+from service.pricing import ProductIndex
+from service.storage import INDEXES, DataConflictError
 from .promotion_factory import PromotionFactory
 
 ######################################################################
@@ -45,6 +50,133 @@ class TestPromotion(TestCase):
             for promotion in promotions:
                 self.assertEqual(promotion.code, code)
 
+    def test_find_by_product(self):
+        """ Find Promotions by product """
+        PromotionFactory(code='SAVE15', products=['p1', 'p2']).save()
+        PromotionFactory(code='SAVE20', products=['p2']).save()
+        self.assertEqual([p.code for p in Promotion.find_by_product('p1')], ['SAVE15'])
+        self.assertEqual(sorted(p.code for p in Promotion.find_by_product('p2')),
+                         ['SAVE15', 'SAVE20'])
+        self.assertEqual(Promotion.find_by_product('p3'), [])
+
+    @skipIf(STORAGE_BACKEND != 'cloudant', 'needs CouchDB')
+    def test_indexes_created_once(self):
+        """ Indexes are declared by init_db only when missing """
+        Promotion.init_db("test")
+        indexes = Promotion.storage.database.get_query_indexes(raw_result=True)['indexes']
+        names = [index['name'] for index in indexes]
+        for name in ('code-idx', 'code-dates-idx', 'code-expiry-idx'):
+            self.assertEqual(names.count(name), 1)
+
+    def test_remove_all_in_bulk(self):
+        """ Remove all Promotions with _bulk_docs """
+        PromotionFactory.batch_create(5)
+        with patch('service.models.BULK_CHUNK_SIZE', 2):
+            result = Promotion.remove_all(strategy='bulk')
+        self.assertEqual(result['removed'], 5)
+        self.assertEqual(result['strategy'], 'bulk')
+        self.assertGreaterEqual(result['seconds'], 0)
+        self.assertEqual(Promotion.all(), [])
+        if STORAGE_BACKEND == 'cloudant':
+            self.assertEqual(len(Promotion.storage.database.list_design_documents()), 1)
+
+    def test_remove_all_by_recreating(self):
+        """ Remove all Promotions by recreating the database """
+        promotion = PromotionFactory()
+        promotion.save()
+        PromotionFactory.batch_create(2, code='SAVE99')
+        result = Promotion.remove_all(strategy='recreate')
+        self.assertEqual(result['removed'], 3)
+        self.assertEqual(Promotion.all(), [])
+        self.assertIsNone(Promotion.find(promotion.id))
+        if STORAGE_BACKEND == 'cloudant':
+            names = [index['name'] for index in
+                     Promotion.storage.database.get_query_indexes(raw_result=True)['indexes']]
+            for name in INDEXES:
+                self.assertIn(name, names)
+        PromotionFactory(code='SAVE99').save()
+        self.assertEqual(len(Promotion.find_by_code('SAVE99')), 1)
+        self.assertRaises(DataValidationError, Promotion.remove_all, 'truncate')
+
+    def test_connect_once_per_process(self):
+        """ Concurrent threads connect a forked process only once """
+        storage = Promotion.storage
+        Promotion.after_fork()
+        self.assertIsNone(Promotion.storage)
+
+        def slow_init(dbname, stage=None):
+            time.sleep(0.1)
+            Promotion.storage = storage
+        with patch('service.models.Promotion._init_db', side_effect=slow_init) as init_mock:
+            threads = [threading.Thread(target=Promotion.ensure_db, args=('test',))
+                       for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(init_mock.call_count, 1)
+        self.assertIs(Promotion.storage, storage)
+
+    def test_find_by_uses_index(self):
+        """ Finders pass a use_index hint for covered selectors """
+        self.assertEqual(Promotion.index_for({'code': 'SAVE15'}),
+                         '_design/promotions/code-idx')
+        self.assertEqual(Promotion.index_for({'code': 'SAVE15', 'start_date': 1,
+                                              'expiry_date': 2}),
+                         '_design/promotions/code-dates-idx')
+        self.assertEqual(Promotion.index_for({'code': 'SAVE15', 'expiry_date': 1}),
+                         '_design/promotions/code-expiry-idx')
+        self.assertIsNone(Promotion.index_for({'percentage': 10}))
+
+        promotion = PromotionFactory(code="SAVE15")
+        promotion.save()
+        found = Promotion.find_overlapping("SAVE15", promotion.expiry_date,
+                                           promotion.expiry_date + 10)
+        self.assertEqual([p.id for p in found], [promotion.id])
+        found = Promotion.find_overlapping("SAVE15", promotion.expiry_date + 1,
+                                           promotion.expiry_date + 10)
+        self.assertEqual(found, [])
+
+    def test_find_overlapping_reads_a_bounded_page(self):
+        """ Overlaps are found in the first windows ending after the range starts """
+        for start in range(0, 10000, 1000):
+            Promotion.storage.create(PromotionFactory(
+                code="SAVE15", start_date=start, expiry_date=start + 999).serialize())
+        with patch.object(Promotion.storage, 'find', wraps=Promotion.storage.find) as find_mock:
+            found = Promotion.find_overlapping("SAVE15", 4500, 5200)
+        self.assertEqual(find_mock.call_args[1]['limit'], 2)
+        self.assertEqual([p.start_date for p in found], [4000, 5000])
+        self.assertEqual(Promotion.find_overlapping("SAVE15", 10000, 10500), [])
+        self.assertEqual(Promotion.find_overlapping("SAVE20", 0, 10000), [])
+
+    def test_page_promotions(self):
+        """ Page through all Promotions and through a code """
+        PromotionFactory.batch_create(5, code="SAVE15")
+        PromotionFactory.batch_create(3, code="SAVE20")
+        seen = []
+        promotions, next_key = Promotion.page(3)
+        while True:
+            self.assertLessEqual(len(promotions), 3)
+            seen.extend(p.id for p in promotions)
+            if next_key is None:
+                break
+            promotions, next_key = Promotion.page(3, next_key)
+        self.assertEqual(len(seen), 8)
+        self.assertEqual(seen, sorted(seen))
+
+        promotions, next_key = Promotion.page(4, code="SAVE15")
+        self.assertEqual(len(promotions), 4)
+        self.assertIsNotNone(next_key)
+        rest, next_key = Promotion.page(4, next_key, code="SAVE15")
+        self.assertEqual(len(rest), 1)
+        self.assertIsNone(next_key)
+        self.assertEqual(len({p.id for p in promotions + rest}), 5)
+
+        # a query the database cannot run is not reported as a bad page key
+        with self.assertRaises(ValueError) as context:
+            Promotion.page(4, next_key, code={'$unknown': 'SAVE15'})
+        self.assertNotIn('page key', str(context.exception))
+
     def test_find(self):
         """ Find a Promotion by ID """
         PromotionFactory(code="SAVE30").save()
@@ -57,6 +189,32 @@ class TestPromotion(TestCase):
         self.assertEqual(promotion.code, save50.code)
         self.assertEqual(promotion.percentage, save50.percentage)
 
+    def test_find_uses_cache(self):
+        """ Find a Promotion through the cache """
+        promotion = PromotionFactory(code="SAVE30")
+        promotion.save()
+        stats = Promotion.cache.stats()
+        Promotion.find(promotion.id)
+        Promotion.find(promotion.id)
+        self.assertEqual(Promotion.cache.stats()['hits'], stats['hits'] + 1)
+
+        # stale entries are revalidated with their _rev
+        Promotion.cache.ttl = -1
+        Promotion.cache.put(promotion.id, Promotion.cache.get_stale(promotion.id))
+        try:
+            self.assertEqual(Promotion.find(promotion.id).code, "SAVE30")
+        finally:
+            Promotion.cache.ttl = 5
+        self.assertEqual(Promotion.cache.stats()['revalidations'],
+                         stats['revalidations'] + 1)
+
+        # local updates and deletes invalidate the cache
+        promotion.percentage = 55
+        promotion.save()
+        self.assertEqual(Promotion.find(promotion.id).percentage, 55)
+        promotion.delete()
+        self.assertIsNone(Promotion.find(promotion.id))
+
     def test_add_a_promotion(self):
         """ Create a promotion """
         promotion = PromotionFactory(code="SAVE50")
@@ -65,6 +223,115 @@ class TestPromotion(TestCase):
         self.assertEqual(len(promotions), 1)
         self.assertEqual(promotions[0].code, "SAVE50")
     
+    def test_create_many_promotions(self):
+        """ Create promotions in bulk """
+        existing = PromotionFactory(code="SAVE10")
+        existing.save()
+        valid = PromotionFactory(code="SAVE50")
+        clashing = PromotionFactory(code="SAVE50")
+        overlapping = PromotionFactory(code="SAVE10")
+        invalid = PromotionFactory(code="SAVE60", percentage=140)
+        later = PromotionFactory(code="SAVE50")
+        later.start_date = valid.expiry_date + 100
+        later.expiry_date = later.start_date + 1000
+
+        results = Promotion.create_many(
+            [valid, clashing, overlapping, invalid, later], chunk_size=1)
+        self.assertEqual([r['ok'] for r in results], [True, False, False, False, True])
+        self.assertEqual(results[0]['id'], valid.id)
+        self.assertEqual(results[4]['id'], later.id)
+        self.assertIn('conflicts with promotion 0 of the batch', results[1]['error'])
+        self.assertIn(existing.id, results[2]['error'])
+        self.assertIn('Percentage', results[3]['error'])
+        self.assertEqual(len(Promotion.all()), 3)
+        self.assertEqual(len(Promotion.find_by_code("SAVE50")), 2)
+
+    def test_create_many_racing_a_writer(self):
+        """ A bulk promotion overlapping one saved meanwhile is rolled back """
+        first = PromotionFactory(code="SAVE50", start_date=1000, expiry_date=2000)
+        second = PromotionFactory(code="SAVE50", start_date=3000, expiry_date=4000)
+        accept_batch = Promotion.accept_batch
+
+        def racing_writer(valid, existing, results):
+            # saved by another process once the batch was checked
+            self.assertTrue(Promotion.code_locks("SAVE50").locked())
+            racing = PromotionFactory(code="SAVE50", start_date=3500, expiry_date=3600)
+            Promotion.storage.create(racing.serialize())
+            return accept_batch(valid, existing, results)
+
+        with patch('service.models.Promotion.accept_batch', side_effect=racing_writer):
+            results = Promotion.create_many([first, second])
+        self.assertEqual([r['ok'] for r in results], [True, False])
+        self.assertIn('conflicts with promotion(', results[1]['error'])
+        self.assertIsNone(second.id)
+        self.assertEqual(sorted(p.start_date for p in Promotion.find_by_code("SAVE50")),
+                         [1000, 3500])
+
+    def test_containing_promotion_conflicts(self):
+        """ A promotion containing another one with the same code conflicts """
+        promotion = PromotionFactory(code="SAVE15", start_date=1000, expiry_date=2000)
+        promotion.save()
+        outer = PromotionFactory(code="SAVE15", start_date=500, expiry_date=3000)
+        self.assertRaises(DataValidationError, outer.save)
+        after = PromotionFactory(code="SAVE15", start_date=2001, expiry_date=3000)
+        after.save()
+        self.assertIsNotNone(after.id)
+
+    def test_concurrent_conflicting_writes(self):
+        """ A write racing with an overlapping one is rolled back """
+        promotion = PromotionFactory(code="SAVE15", start_date=1000, expiry_date=2000)
+        promotion.save()
+
+        # the second writer validated before the first one saved
+        racing = PromotionFactory(code="SAVE15", start_date=1500, expiry_date=2500)
+        with patch('service.models.Promotion.validate'):
+            self.assertRaises(DataValidationError, racing.save)
+        self.assertIsNone(racing.id)
+        self.assertEqual([p.id for p in Promotion.find_by_code("SAVE15")], [promotion.id])
+
+        later = PromotionFactory(code="SAVE15", start_date=3000, expiry_date=4000)
+        later.save()
+        later.start_date = 1900
+        with patch('service.models.Promotion.validate'):
+            self.assertRaises(DataValidationError, later.save)
+        self.assertEqual(Promotion.find(later.id).start_date, 3000)
+
+    def test_one_overlap_query_per_write(self):
+        """ Writes look for overlaps in the database once, after writing """
+        promotion = PromotionFactory(code="SAVE15", start_date=1000, expiry_date=2000)
+        with patch('service.models.Promotion.find_overlapping',
+                   wraps=Promotion.find_overlapping) as find_mock:
+            promotion.save()
+            self.assertEqual(find_mock.call_count, 1)
+            promotion.percentage = 50
+            promotion.save()
+            self.assertEqual(find_mock.call_count, 2)
+        self.assertEqual(Promotion.find(promotion.id).percentage, 50)
+
+    def test_rollback_restores_the_replaced_document(self):
+        """ An update rolled back restores the revision it replaced, not a cached copy """
+        promotion = PromotionFactory(code="SAVE15", start_date=1000, expiry_date=2000,
+                                     percentage=10)
+        promotion.save()
+        PromotionFactory(code="SAVE15", start_date=3000, expiry_date=4000).save()
+        cached = Promotion.find_document(promotion.id)
+
+        # changed by another process while this one has it cached
+        Promotion.storage.put(dict(cached, percentage=20))
+        current = Promotion.find(promotion.id, fresh=True)
+        Promotion.cache.put(promotion.id, cached)
+        current.start_date = 3500
+        self.assertRaises(DataValidationError, current.save)
+        restored = Promotion.find(promotion.id, fresh=True)
+        self.assertEqual((restored.percentage, restored.start_date), (20, 1000))
+
+        # without a _rev the current revision is replaced, not the cached one
+        Promotion.cache.put(promotion.id, cached)
+        current.rev = None
+        current.start_date = 1500
+        current.save()
+        self.assertEqual(Promotion.find(promotion.id, fresh=True).start_date, 1500)
+
     def test_update_promotion(self):
         """ Update a promotion """
         promotion = PromotionFactory()
@@ -76,6 +343,27 @@ class TestPromotion(TestCase):
         promotion.save()
         self.assertEqual(len(Promotion.find_by_code(promotion.code)), 1)
 
+    def test_update_with_stale_revision(self):
+        """ Updating a promotion changed since it was read is a conflict """
+        promotion = PromotionFactory()
+        promotion.save()
+        first_rev = promotion.rev
+        self.assertTrue(first_rev.startswith('1-'))
+
+        other = Promotion.find(promotion.id)
+        self.assertEqual(other.rev, first_rev)
+        other.percentage = 60
+        other.save()
+        self.assertTrue(other.rev.startswith('2-'))
+
+        promotion.percentage = 70
+        self.assertRaises(DataConflictError, promotion.save)
+        self.assertEqual(Promotion.find(promotion.id).percentage, 60)
+
+        # deleting is not conditional
+        promotion.delete()
+        self.assertIsNone(Promotion.find(promotion.id))
+
     def test_promotion_deserialize(self):
         """ Test Promotion deserialization"""
         promotion = PromotionFactory()
@@ -96,6 +384,96 @@ class TestPromotion(TestCase):
         self.assertEqual(promotion.start_date,
                          promotion_deserialized.start_date)
 
+    def test_promotion_from_document(self):
+        """ Promotions are built from their documents into slots """
+        promotion = PromotionFactory(products=['p1', 'p2'])
+        promotion.save()
+        document = Promotion.find_document(promotion.id)
+        found = Promotion.from_document(document)
+        self.assertEqual(found.serialize(), promotion.serialize())
+        self.assertEqual(found.rev, document['_rev'])
+        self.assertEqual(found.products, ('p1', 'p2'))
+        self.assertEqual(found.serialize()['products'], ['p1', 'p2'])
+        self.assertFalse(hasattr(found, '__dict__'))
+        self.assertRaises(DataValidationError, Promotion().deserialize,
+                          dict(promotion.serialize(), products='p1'))
+
+    def test_promotion_fields(self):
+        """ Only the requested fields of the Promotions are read """
+        PromotionFactory(code='SAVE15', products=['p1']).save()
+        PromotionFactory(code='SAVE20').save()
+        promotions = Promotion.find_by_code('SAVE15', fields=('code', 'products'))
+        self.assertEqual(len(promotions), 1)
+        self.assertEqual(promotions[0].code, 'SAVE15')
+        self.assertEqual(promotions[0].products, ('p1',))
+        self.assertIsNotNone(promotions[0].id)
+        self.assertIsNone(promotions[0].percentage)
+        promotions = Promotion.all(fields=('id',))
+        self.assertEqual(len(promotions), 2)
+        self.assertTrue(all(promotion.code is None for promotion in promotions))
+        promotions, _ = Promotion.page(1, fields=('code',))
+        self.assertIsNone(promotions[0].expiry_date)
+        self.assertEqual(Promotion.document_fields(('id', 'code')), ['_id', '_rev', 'code'])
+        self.assertIsNone(Promotion.document_fields(None))
+
+    def test_pricing_index_refreshed_in_background(self):
+        """ A stale product index is served while a new one loads """
+        PromotionFactory(products=['p1']).save()
+        index = Promotion.pricing_index()
+        self.assertEqual(len(index), 1)
+        # written by another process
+        Promotion.storage.create(PromotionFactory(products=['p2']).serialize())
+        loading = threading.Event()
+
+        def load():
+            # keeps loading until the stale index was served
+            loading.wait(10)
+            return Promotion.load_product_index()
+
+        with patch('service.models.PRODUCT_INDEX_TTL', -1):
+            thread = Promotion.refresh_index('product_index', load)
+            self.assertIsNone(Promotion.refresh_index('product_index',
+                                                      Promotion.load_product_index))
+            self.assertIs(Promotion.pricing_index(), index)
+            loading.set()
+            thread.join(10)
+        self.assertIsNot(Promotion.product_index, index)
+        self.assertEqual(len(Promotion.product_index), 2)
+
+    def test_active_set_refreshed_in_background(self):
+        """ A stale active set is served while a new one loads """
+        now = int(time.time())
+        PromotionFactory(start_date=now - 100, expiry_date=now + 100).save()
+        active = Promotion.active_set()
+        self.assertEqual(len(active), 1)
+        Promotion.storage.create(PromotionFactory(start_date=now - 100,
+                                                  expiry_date=now + 100).serialize())
+        with patch('service.models.ACTIVE_SET_TTL', -1):
+            thread = Promotion.refresh_index('active_promotions', Promotion.load_active_set)
+            self.assertIs(Promotion.active_set(), active)
+            thread.join(10)
+        self.assertIsNot(Promotion.active_promotions, active)
+        self.assertEqual(len(Promotion.active_promotions), 2)
+
+    def test_writes_while_an_index_loads(self):
+        """ Writes made while an index loads are applied to it """
+        Promotion.pricing_index()
+        written = PromotionFactory(products=['p1'])
+
+        def load():
+            written.save()
+            return ProductIndex()
+        index = Promotion.build_index('product_index', load)
+        self.assertIs(Promotion.product_index, index)
+        self.assertEqual(list(index.entries), [written.id])
+
+        # an index reset while it loads is dropped
+        def load_and_reset():
+            Promotion.product_index = None
+            return ProductIndex()
+        self.assertIsNone(Promotion.build_index('product_index', load_and_reset))
+        self.assertEqual(Promotion.index_builds, [])
+
     def test_promotion_deserialize_exceptions(self):
         """ Test Promotion deserialization exceptions"""
         promotion = PromotionFactory()
@@ -197,6 +575,7 @@ class TestPromotion(TestCase):
         except KeyError:
             self.assertRaises(KeyError)
 
+    @skipIf(STORAGE_BACKEND != 'cloudant', 'needs CouchDB')
     @patch('cloudant.client.Cloudant.__init__')
     def test_connection_error(self, bad_mock):
         """ Test Connection error handler """
@@ -0,0 +1,207 @@
+"""
+Test cases for the Promotion Replica
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+from unittest import TestCase, skipIf
+from unittest.mock import patch
+from service import app
+from service.models import Promotion, DataValidationError, STORAGE_BACKEND
+from service.replica import Replica
+from .promotion_factory import PromotionFactory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+@skipIf(STORAGE_BACKEND != 'cloudant', 'needs CouchDB')
+class TestReplica(TestCase):
+    """ Test cases for Replica """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all test cases """
+        app.debug = False
+
+    def setUp(self):
+        """ Runs before each test """
+        Promotion.init_db("test")
+        Promotion.remove_all()
+        self.replica = Replica(Promotion.storage.database, batch_size=100)
+
+    def tearDown(self):
+        """ Runs after each test """
+        Promotion.replica = None
+
+    def catch_up(self):
+        """ Syncs the replica until it has no pending changes """
+        self.replica.sync()
+        while self.replica.pending:
+            self.replica.sync()
+
+    def test_bootstrap_in_batches(self):
+        """ Bootstrap from the changes feed in batches """
+        self.replica.batch_size = 2
+        self.replica.seq = Promotion.storage.database.metadata()['update_seq']
+        PromotionFactory.batch_create(5, code='SAVE15')
+        self.assertFalse(self.replica.is_current())
+        self.replica.sync()
+        self.assertFalse(self.replica.is_current())
+        self.assertEqual(len(self.replica.all()), 2)
+        self.catch_up()
+        self.assertTrue(self.replica.is_current())
+        self.assertEqual(len(self.replica.all()), 5)
+        self.assertEqual(len(self.replica.find_by_code('SAVE15')), 5)
+        status = self.replica.status()
+        self.assertEqual(status['pending'], 0)
+        self.assertEqual(status['documents'], 5)
+        self.assertIsNotNone(status['lag_seconds'])
+
+    def test_follow_changes(self):
+        """ Follow updates and deletes from the changes feed """
+        self.catch_up()
+        promotion = PromotionFactory(code='SAVE20')
+        promotion.save()
+        self.catch_up()
+        self.assertEqual(self.replica.get(promotion.id)['code'], 'SAVE20')
+        promotion.code = 'SAVE25'
+        promotion.save()
+        self.catch_up()
+        self.assertEqual(self.replica.find_by_code('SAVE20'), [])
+        self.assertEqual(len(self.replica.find_by_code('SAVE25')), 1)
+        promotion.delete()
+        self.catch_up()
+        self.assertIsNone(self.replica.get(promotion.id))
+
+    def test_ignore_older_revisions(self):
+        """ An older revision from the feed does not overwrite a newer one """
+        self.replica.apply({'_id': 'a', '_rev': '2-b', 'code': 'NEW'})
+        self.replica.apply({'_id': 'a', '_rev': '1-a', 'code': 'OLD'})
+        self.assertEqual(self.replica.get('a')['code'], 'NEW')
+        self.replica.apply({'_id': 'a', '_rev': '3-c', '_deleted': True})
+        self.replica.apply({'_id': 'a', '_rev': '2-b', 'code': 'NEW'})
+        self.assertIsNone(self.replica.get('a'))
+
+    def test_lagging_replica_is_not_current(self):
+        """ A replica too far behind is not used """
+        self.catch_up()
+        self.replica.max_lag = -1
+        self.assertFalse(self.replica.is_current())
+
+    def test_hung_longpoll_is_not_current(self):
+        """ A long-poll past its timeout does not keep the replica current """
+        self.catch_up()
+        self.replica.poll_timeout = 1
+        self.replica.waiting = True
+        self.assertEqual(self.replica.lag(), 0.0)
+        with patch('service.replica.time.monotonic',
+                   return_value=self.replica.synced_at + 60):
+            self.assertGreaterEqual(self.replica.lag(), 60)
+            self.assertFalse(self.replica.is_current())
+
+    def test_promotion_reads_from_replica(self):
+        """ Promotion finders answer from a current replica """
+        promotion = PromotionFactory(code='SAVE30')
+        promotion.save()
+        self.catch_up()
+        Promotion.replica = self.replica
+        with patch('service.models.Promotion._fetch_document') as fetch_mock, \
+                patch('service.models.Promotion.find_by') as find_by_mock:
+            self.assertEqual(Promotion.find(promotion.id).code, 'SAVE30')
+            self.assertEqual(len(Promotion.find_by_code('SAVE30')), 1)
+            self.assertEqual(len(Promotion.all()), 1)
+            fetch_mock.assert_not_called()
+            find_by_mock.assert_not_called()
+
+        # local writes can be read back right away
+        other = PromotionFactory(code='SAVE40')
+        other.save()
+        self.assertEqual(Promotion.find(other.id).code, 'SAVE40')
+        other.delete()
+        self.assertIsNone(Promotion.find(other.id))
+
+    def test_validate_with_interval_index(self):
+        """ validate() checks overlaps against the replica interval index """
+        promotion = PromotionFactory(code='SAVE30', start_date=1000, expiry_date=2000)
+        promotion.save()
+        self.catch_up()
+        Promotion.replica = self.replica
+        with patch('service.models.Promotion.find_overlapping') as find_mock:
+            PromotionFactory(code='SAVE30', start_date=2001, expiry_date=3000).validate()
+            PromotionFactory(code='SAVE35', start_date=1000, expiry_date=2000).validate()
+            promotion.validate()
+            overlapping = PromotionFactory(code='SAVE30', start_date=1999, expiry_date=3000)
+            self.assertRaises(DataValidationError, overlapping.validate)
+            find_mock.assert_not_called()
+
+    def test_writes_checked_with_interval_index(self):
+        """ Writes look for overlaps in the current replica instead of CouchDB """
+        PromotionFactory(code='SAVE30', start_date=1000, expiry_date=2000).save()
+        self.catch_up()
+        Promotion.replica = self.replica
+        promotion = PromotionFactory(code='SAVE30', start_date=2001, expiry_date=3000)
+        with patch('service.models.Promotion.find_overlapping') as find_mock:
+            promotion.save()
+            promotion.start_date = 1999
+            with patch('service.models.Promotion.validate'):
+                self.assertRaises(DataValidationError, promotion.save)
+            find_mock.assert_not_called()
+        self.assertEqual(Promotion.find(promotion.id).start_date, 2001)
+
+    def test_rolled_back_create_leaves_its_tombstone(self):
+        """ A create rolled back replicates the tombstone CouchDB made """
+        PromotionFactory(code='SAVE30', start_date=1000, expiry_date=2000).save()
+        self.catch_up()
+        Promotion.replica = self.replica
+        deletes = []
+        delete = Promotion.storage.delete
+
+        def record_delete(document_id, rev):
+            deletes.append((document_id, delete(document_id, rev)))
+            return deletes[-1][1]
+
+        racing = PromotionFactory(code='SAVE30', start_date=1500, expiry_date=2500)
+        with patch('service.models.Promotion.validate'), \
+                patch.object(Promotion.storage, 'delete', side_effect=record_delete):
+            self.assertRaises(DataValidationError, racing.save)
+        (document_id, rev), = deletes
+        self.assertEqual(self.replica.tombstones[document_id], rev)
+        self.assertIsNone(self.replica.get(document_id))
+
+    def test_collection_etag_from_replica(self):
+        """ The list ETag comes from the current replica without asking CouchDB """
+        PromotionFactory(code='SAVE30').save()
+        self.catch_up()
+        Promotion.replica = self.replica
+        client = app.test_client()
+        with patch('service.models.Promotion.update_seq') as seq_mock:
+            etag = client.get('/promotions').headers['ETag']
+            resp = client.get('/promotions', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 304)
+            # a local write shows before the feed moves the checkpoint
+            PromotionFactory(code='SAVE35').save()
+            resp = client.get('/promotions', headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(len(resp.get_json()), 2)
+            seq_mock.assert_not_called()
+
+    def test_fall_back_while_bootstrapping(self):
+        """ Promotion finders query CouchDB while the replica bootstraps """
+        promotion = PromotionFactory(code='SAVE30')
+        promotion.save()
+        Promotion.replica = self.replica
+        self.assertEqual(Promotion.find(promotion.id).code, 'SAVE30')
+        self.assertEqual(len(Promotion.find_by_code('SAVE30')), 1)
+
+    def test_background_replication(self):
+        """ Replicate on a background thread """
+        PromotionFactory.batch_create(3, code='SAVE50')
+        replica = Replica(Promotion.storage.database, poll_timeout=1).start()
+        try:
+            self.assertTrue(replica.wait_until_ready(5))
+            self.assertEqual(len(replica.all()), 3)
+        finally:
+            replica.stop()
@@ -8,13 +8,16 @@ Test cases can be run with the following:
 
 import time
 import unittest
+from unittest import skipIf
 import json
 import logging
 from unittest.mock import patch
 from flask_api import status    # HTTP Status Codes
 
+from service import encoding
 from service.service import app, initialize_logging
-from service.models import Promotion
+from service.models import Promotion, STORAGE_BACKEND
+from service.warmup import WarmUp
 from .promotion_factory import PromotionFactory
 
 ######################################################################
@@ -44,6 +47,95 @@ class TestPromotionServer(unittest.TestCase):
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
         data = resp.get_json()
         self.assertEqual(len(data), count)
+        self.assertEqual(list(data[0]), ['id', 'code', 'percentage', 'products',
+                                         'start_date', 'expiry_date'])
+
+        # a field mask is still applied
+        resp = self.app.get('/promotions', headers={'X-Fields': 'id,code'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([set(promotion) for promotion in resp.get_json()],
+                         [{'id', 'code'}] * count)
+
+    def test_list_promotions_in_pages(self):
+        """ Get all Promotions one page at a time """
+        PromotionFactory.batch_create(5, code='SAVE15')
+        ids = []
+        url = '/promotions?limit=2'
+        pages = 0
+        while url:
+            resp = self.app.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            data = resp.get_json()
+            self.assertLessEqual(len(data), 2)
+            ids.extend(item['id'] for item in data)
+            pages += 1
+            link = resp.headers.get('Link')
+            url = link[1:link.index('>')] if link else None
+        self.assertEqual(pages, 3)
+        self.assertEqual(len(set(ids)), 5)
+
+        resp = self.app.get('/promotions?limit=4&promotion-code=SAVE15')
+        self.assertEqual(len(resp.get_json()), 4)
+        self.assertIn('promotion-code=SAVE15', resp.headers['Link'])
+
+        resp = self.app.get('/promotions?limit=2&cursor=not-a-cursor')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_promotions_with_fields(self):
+        """ Get only some fields of the Promotions """
+        PromotionFactory.batch_create(3, code='SAVE15')
+        PromotionFactory.batch_create(2, code='SAVE20')
+        resp = self.app.get('/promotions?fields=code,id')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 5)
+        self.assertEqual([list(promotion) for promotion in data], [['id', 'code']] * 5)
+
+        resp = self.app.get('/promotions?promotion-code=SAVE20&fields=percentage')
+        self.assertEqual([list(promotion) for promotion in resp.get_json()],
+                         [['percentage']] * 2)
+
+        resp = self.app.get('/promotions?limit=2&fields=products')
+        self.assertEqual([set(promotion) for promotion in resp.get_json()], [{'products'}] * 2)
+        self.assertIn('fields=products', resp.headers['Link'])
+
+        resp = self.app.get('/promotions?fields=id', headers={'Accept': 'application/x-ndjson'})
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual([set(json.loads(line)) for line in lines], [{'id'}] * 5)
+
+        # the same fields in any order and repeated are one projection
+        with patch('service.encoding.compile_model', wraps=encoding.compile_model) as compile_mock:
+            for fields in ('id', 'id,id', 'code,id', 'id,code,id', 'code , id'):
+                resp = self.app.get('/promotions?fields={}'.format(fields))
+                self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertLessEqual(compile_mock.call_count, 2)
+        self.assertEqual(list(resp.get_json()[0]), ['id', 'code'])
+
+        for fields in ('id,rev', '_id', ','):
+            resp = self.app.get('/promotions?fields={}'.format(fields))
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_promotions_as_ndjson(self):
+        """ Stream all Promotions as newline delimited JSON """
+        PromotionFactory.batch_create(4, code='SAVE15')
+        PromotionFactory.batch_create(2, code='SAVE20')
+        resp = self.app.get('/promotions',
+                            headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(set(json.loads(lines[0])),
+                         {'id', 'code', 'percentage', 'products',
+                          'start_date', 'expiry_date'})
+        self.assertNotIn('": ', lines[0])
+
+        resp = self.app.get('/promotions?promotion-code=SAVE20',
+                            headers={'Accept': 'application/x-ndjson'})
+        codes = [json.loads(line)['code']
+                 for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual(codes, ['SAVE20', 'SAVE20'])
 
     def test_get_promotions_by_code(self):
         """ Get a list of all Promotions having a given code """
@@ -110,6 +202,37 @@ class TestPromotionServer(unittest.TestCase):
                          promotion.start_date, "Start date does not match")
         self.assertTrue(set(promotion.products) == set(new_prom['products']))
     
+    def test_bulk_create_promotions(self):
+        """ Add many promotions in one request """
+        promotions = PromotionFactory.create_batch(3, code='SAVE_BULK')
+        for offset, promotion in enumerate(promotions):
+            promotion.start_date += offset * 10**7
+            promotion.expiry_date += offset * 10**7
+        data = [promotion.serialize() for promotion in promotions]
+        for item in data:
+            del item['id']
+        resp = self.app.post('/promotions/bulk', json=data,
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        results = resp.get_json()
+        self.assertEqual([r['index'] for r in results], [0, 1, 2])
+        self.assertTrue(all(r['ok'] for r in results))
+        self.assertEqual(len(Promotion.find_by_code('SAVE_BULK')), 3)
+
+        # one bad record does not fail the others
+        bad = dict(data[0], code='SAVE_OTHER', percentage='abc')
+        good = dict(data[0], code='SAVE_OTHER')
+        resp = self.app.post('/promotions/bulk', json=[data[1], bad, good],
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_207_MULTI_STATUS)
+        results = resp.get_json()
+        self.assertEqual([r['ok'] for r in results], [False, False, True])
+        self.assertIsNotNone(results[2]['id'])
+
+        resp = self.app.post('/promotions/bulk', json={'code': 'SAVE'},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_create_a_promotion_with_bad_data(self):
         """ Create a promotion with bad data"""
 
@@ -184,6 +307,118 @@ class TestPromotionServer(unittest.TestCase):
         for product in resp_data['products']:
             self.assertEqual(product['price'], ground_truth[product['product_id']])
     
+    def test_get_promotion_not_modified(self):
+        """ Get a Promotion with If-None-Match """
+        test_promotion = PromotionFactory()
+        test_promotion.save()
+        resp = self.app.get('/promotions/{}'.format(test_promotion.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers['ETag']
+        self.assertTrue(etag.startswith('"1-'))
+
+        resp = self.app.get('/promotions/{}'.format(test_promotion.id),
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.data, b'')
+        self.assertEqual(resp.headers['ETag'], etag)
+
+        test_promotion.percentage = 50
+        test_promotion.save()
+        resp = self.app.get('/promotions/{}'.format(test_promotion.id),
+                            headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        self.assertEqual(resp.get_json()['percentage'], 50)
+
+    def test_list_promotions_not_modified(self):
+        """ List Promotions with If-None-Match """
+        PromotionFactory.batch_create(3)
+        resp = self.app.get('/promotions')
+        etag = resp.headers['ETag']
+        resp = self.app.get('/promotions', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # the ETag depends on the query
+        resp = self.app.get('/promotions?limit=2', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        PromotionFactory(code='SAVE99').save()
+        resp = self.app.get('/promotions', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 4)
+
+        resp = self.app.get('/promotions?active=true')
+        self.assertNotIn('ETag', resp.headers)
+
+    def test_list_active_promotions(self):
+        """ List the Promotions active now or at a given time """
+        now = int(time.time())
+        current = Promotion(code='SAVE20', percentage=80, products=['p1'],
+                            start_date=now - 1000, expiry_date=now + 1000)
+        current.save()
+        future = Promotion(code='SAVE40', percentage=60, products=['p2'],
+                           start_date=now + 2000, expiry_date=now + 3000)
+        future.save()
+        Promotion(code='SAVE40', percentage=60, products=['p2'],
+                  start_date=now - 3000, expiry_date=now - 2000).save()
+
+        resp = self.app.get('/promotions?active=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([p['id'] for p in resp.get_json()], [current.id])
+
+        resp = self.app.get('/promotions?at={}'.format(now + 2500))
+        self.assertEqual([p['id'] for p in resp.get_json()], [future.id])
+        resp = self.app.get('/promotions?at={}&promotion-code=SAVE20'.format(now + 2500))
+        self.assertEqual(resp.get_json(), [])
+        resp = self.app.get('/promotions?at={}'.format(now - 2500))
+        self.assertEqual(len(resp.get_json()), 1)
+
+        # writes are applied to the active set
+        future.start_date = now - 500
+        future.save()
+        resp = self.app.get('/promotions?active=true&promotion-code=SAVE40')
+        self.assertEqual([p['id'] for p in resp.get_json()], [future.id])
+
+        resp = self.app.get('/promotions?active=maybe')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_apply_best_promotions_on_cart(self):
+        """ Apply the best active promotion to each product of a cart """
+        now = int(time.time())
+        Promotion(code='SAVE20', percentage=80, products=['p1', 'p2'],
+                  start_date=now - 1000, expiry_date=now + 1000).save()
+        best = Promotion(code='SAVE40', percentage=60, products=['p2'],
+                         start_date=now - 1000, expiry_date=now + 1000)
+        best.save()
+        Promotion(code='SAVE90', percentage=10, products=['p1', 'p2'],
+                  start_date=now + 1000, expiry_date=now + 2000).save()
+
+        request_data = {'products': [{'product_id': 'p1', 'price': 100},
+                                     {'product_id': 'p2', 'price': 10},
+                                     {'product_id': 'p3', 'price': 1.5}]}
+        resp = self.app.post('/promotions/apply', json=request_data,
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        products = resp.get_json()['products']
+        self.assertEqual([p['price'] for p in products], [80.0, 6.0, 1.5])
+        self.assertEqual(products[1]['promotion_id'], best.id)
+        self.assertIsNone(products[2]['promotion_id'])
+
+        # later writes are applied to the index
+        best.delete()
+        resp = self.app.post('/promotions/apply', json=request_data,
+                             content_type='application/json')
+        self.assertEqual(resp.get_json()['products'][1]['price'], 8.0)
+
+        resp = self.app.post('/promotions/apply',
+                             json={'products': [{'product_id': 'p1', 'price': 'abc'}]},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/promotions/apply', json={'products': {}},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
     def test_apply_a_inactive_promotion_on_products(self):
         """ Apply a inactive promotion on a set of products together with their prices """
         # Set up fake data
@@ -228,6 +463,33 @@ class TestPromotionServer(unittest.TestCase):
         self.assertEqual(updated_promotion['code'], 'SAVENEW')
         self.assertEqual(updated_promotion['id'], new_promotion['id'])
 
+    def test_update_a_promotion_if_match(self):
+        """ Update a promotion only if its ETag matches """
+        test_promotion = PromotionFactory()
+        test_promotion.save()
+        url = '/promotions/{}'.format(test_promotion.id)
+        resp = self.app.get(url)
+        etag = resp.headers['ETag']
+        data = resp.get_json()
+
+        data['percentage'] = 50
+        resp = self.app.put(url, json=data, headers={'If-Match': etag},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        new_etag = resp.headers['ETag']
+        self.assertNotEqual(new_etag, etag)
+
+        data['percentage'] = 60
+        resp = self.app.put(url, json=data, headers={'If-Match': etag},
+                            content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(Promotion.find(test_promotion.id).percentage, 50)
+
+        # without If-Match the last writer wins
+        resp = self.app.put(url, json=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.app.get(url).get_json()['percentage'], 60)
+
     def test_update_a_nonexist_promotion(self):
         """ Update a promotion, given a nonexist promotion id """
         fake_test_promotion_id = '666f6f2d6261722d71757578'
@@ -327,6 +589,7 @@ class TestPromotionServer(unittest.TestCase):
         resp = self.app.get('/promotions')
         self.assertEqual(resp.status_code, status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+    @skipIf(STORAGE_BACKEND != 'cloudant', 'needs CouchDB')
     def test_db_connection(self):
         """ Test DB connection """
         Promotion.disconnect()
@@ -349,9 +612,57 @@ class TestPromotionServer(unittest.TestCase):
         )), content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
 
+    def test_service_stats(self):
+        """ Get the cache counters """
+        resp = self.app.get('/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertIn('hits', data['cache'])
+        self.assertIn('misses', data['cache'])
+
+    def test_readiness(self):
+        """ Ready only once every warm-up stage is done """
+        with patch('service.warmup.warm_up', WarmUp('test')) as warm_up:
+            resp = self.app.get('/ready')
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+            self.assertFalse(resp.get_json()['ready'])
+            warm_up.run()
+            resp = self.app.get('/ready')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertTrue(data['ready'])
+        self.assertEqual([stage['name'] for stage in data['stages']],
+                         ['connect', 'indexes', 'replica', 'pricing', 'active'])
+        for stage in data['stages']:
+            self.assertIn(stage['status'], ('done', 'skipped'))
+            self.assertGreaterEqual(stage['seconds'], 0)
+
+    def test_metrics(self):
+        """ Get the request and database metrics """
+        promotion = PromotionFactory()
+        promotion.save()
+        self.app.get('/promotions')
+        self.app.get('/promotions/{}'.format(promotion.id))
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = resp.get_data(as_text=True).split('\n')
+        for endpoint in ('promotion_collection', 'promotion_resource'):
+            self.assertTrue(any(line.startswith(
+                'promotion_http_request_duration_seconds_count{{endpoint="{}",method="GET"}}'
+                .format(endpoint)) for line in lines))
+        self.assertTrue(any(line.startswith(
+            'promotion_db_call_duration_seconds_count{{backend="{}",operation="create_document"}}'
+            .format(STORAGE_BACKEND)) for line in lines))
+        self.assertIn('promotion_http_requests_in_flight 1', lines)
+        self.assertIn('# TYPE promotion_db_429_retries_total counter', lines)
+
     def test_promotion_reset(self):
+        PromotionFactory.batch_create(2, code='SAVE99')
         resp = self.app.delete('/promotions/reset')
         self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.headers['X-Removed-Count'], '2')
+        self.assertIn('X-Reset-Duration', resp.headers)
 
     def test_get_index(self):
         resp = self.app.get('/')
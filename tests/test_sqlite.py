@@ -0,0 +1,120 @@
+"""
+Test cases for the SQLite Storage
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from service.sqlite import SQLiteStorage
+from service.storage import DataConflictError, InvalidBookmarkError
+from .promotion_factory import promotion_document
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestSQLiteStorage(TestCase):
+    """ Test cases for SQLiteStorage """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.directory = tempfile.mkdtemp()
+        self.storage = SQLiteStorage(os.path.join(self.directory, 'test.sqlite3'))
+        self.storage.open('test')
+        self.storage.create_indexes()
+
+    def tearDown(self):
+        """ Runs after each test """
+        self.storage.close()
+        shutil.rmtree(self.directory)
+
+    def test_revisions(self):
+        """ Every write needs the current revision """
+        document_id, rev = self.storage.create(promotion_document('SAVE15', ['p1']))
+        self.assertTrue(rev.startswith('1-'))
+        document = self.storage.get(document_id)
+        self.assertEqual(document['_rev'], rev)
+        self.assertIs(self.storage.get(document_id, document), document)
+
+        new_rev = self.storage.put(dict(document, code='SAVE20'))
+        self.assertTrue(new_rev.startswith('2-'))
+        self.assertEqual(self.storage.get(document_id, document)['code'], 'SAVE20')
+        self.assertRaises(DataConflictError, self.storage.put, document)
+
+        self.assertIsNone(self.storage.delete(document_id, rev))
+        self.assertTrue(self.storage.delete(document_id, new_rev).startswith('3-'))
+        self.assertIsNone(self.storage.get(document_id))
+
+    def test_selectors(self):
+        """ Mango selectors are run as SQL """
+        self.storage.bulk_docs([promotion_document('SAVE15', ['p1', 'p2'], 0, 100),
+                                promotion_document('SAVE15', ['p3'], 200, 300),
+                                promotion_document('SAVE20', ['p2'], 50, 250)])
+        find = self.storage.find
+        self.assertEqual(len(find({'code': 'SAVE15'})), 2)
+        self.assertEqual(len(find({'code': {'$in': ['SAVE15', 'SAVE20']}})), 3)
+        self.assertEqual(len(find({'code': 'SAVE15', 'start_date': {'$lte': 250},
+                                   'expiry_date': {'$gte': 150}})), 1)
+        self.assertEqual(len(find({'start_date': {'$exists': True},
+                                   'expiry_date': {'$gt': 100}})), 2)
+        self.assertEqual(len(find({'products': {'$elemMatch': {'$eq': 'p2'}}})), 2)
+        self.assertEqual(len(find({'code': 'SAVE20',
+                                   'products': {'$elemMatch': {'$in': ['p1', 'p3']}}})), 0)
+        self.assertRaises(ValueError, find, {'percentage': {'$regex': '8'}})
+        self.assertRaises(ValueError, find, {'products': 'p1'})
+
+    def test_pages(self):
+        """ Pages of a selector and of all documents """
+        self.storage.bulk_docs([promotion_document('SAVE15', ['p1']) for _ in range(5)])
+        docs, bookmark = self.storage.find({'code': 'SAVE15'}, 2)
+        seen = [doc['_id'] for doc in docs]
+        while bookmark is not None:
+            docs, bookmark = self.storage.find({'code': 'SAVE15'}, 2, bookmark)
+            seen.extend(doc['_id'] for doc in docs)
+        self.assertEqual(seen, sorted(seen))
+        self.assertEqual(len(set(seen)), 5)
+        self.assertEqual([doc['_id'] for doc in self.storage.all_docs(3, seen[2])], seen[2:5])
+        self.assertRaises(InvalidBookmarkError, self.storage.find, {'code': 'SAVE15'}, 2, 12)
+        with self.assertRaises(ValueError) as context:
+            self.storage.find({'percentage': {'$regex': '8'}}, 2, seen[0])
+        self.assertNotIsInstance(context.exception, InvalidBookmarkError)
+
+    def test_fields(self):
+        """ Reads return only the requested fields """
+        self.storage.bulk_docs([promotion_document('SAVE15', ['p1']),
+                                promotion_document('SAVE20', ['p2'])])
+        docs = self.storage.find({'code': 'SAVE15'}, fields=['_id', '_rev', 'code'])
+        self.assertEqual([set(doc) for doc in docs], [{'_id', '_rev', 'code'}])
+        self.assertEqual(docs[0]['code'], 'SAVE15')
+        docs = self.storage.all_docs(5, fields=['_id', '_rev', 'products'])
+        self.assertEqual(sorted(doc['products'] for doc in docs), [['p1'], ['p2']])
+        self.assertEqual([set(doc) for doc in docs], [{'_id', '_rev', 'products'}] * 2)
+
+    def test_indexes_are_used(self):
+        """ The finders are served by the indexes and the join table """
+        plan = ' '.join(self.storage.explain({'code': 'SAVE15', 'start_date': {'$lte': 1}}))
+        self.assertIn('code_dates_idx', plan)
+        plan = ' '.join(self.storage.explain({'code': 'SAVE15', 'expiry_date': {'$gte': 1}}))
+        self.assertIn('code_expiry_idx', plan)
+        plan = ' '.join(self.storage.explain({'expiry_date': {'$gte': 1}}))
+        self.assertIn('dates_idx', plan)
+        plan = ' '.join(self.storage.explain({'products': {'$elemMatch': {'$eq': 'p1'}}}))
+        self.assertIn('promotion_products', plan)
+
+    def test_update_seq_and_remove_all(self):
+        """ Every write changes update_seq and remove_all empties both tables """
+        seq = self.storage.update_seq()
+        document_id, _ = self.storage.create(promotion_document('SAVE15', ['p1']))
+        self.assertGreater(self.storage.update_seq(), seq)
+        self.storage.create(promotion_document('SAVE20', ['p1']))
+        self.assertEqual(self.storage.remove_all('bulk', 100), 2)
+        self.assertEqual(self.storage.find({'products': {'$elemMatch': {'$eq': 'p1'}}}), [])
+        self.storage.create(promotion_document('SAVE15', ['p1']))
+        self.assertEqual(self.storage.remove_all('recreate', 100), 1)
+        self.assertIsNone(self.storage.get(document_id))
+        self.assertEqual(self.storage.all_docs(10), [])
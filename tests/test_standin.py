@@ -0,0 +1,88 @@
+"""
+Test cases for the CouchDB Stand-in
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+import time
+from unittest import TestCase
+from unittest.mock import patch
+from service import storage
+from service.metrics import DB_RETRIES_429
+from service.storage import CloudantStorage, DataConflictError
+from tests.couchdb_standin import CouchDBStandin
+from tests.promotion_factory import promotion_document
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestCouchDBStandin(TestCase):
+    """ Test cases for CouchDBStandin """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.standin = CouchDBStandin().start()
+        with patch.object(storage, 'CLOUDANT_HOST', self.standin.host), \
+                patch.object(storage, 'CLOUDANT_PORT', self.standin.port):
+            self.storage = CloudantStorage().open('test')
+        self.storage.create_indexes()
+
+    def tearDown(self):
+        """ Runs after each test """
+        self.storage.close()
+        self.standin.stop()
+
+    def test_documents(self):
+        """ The Cloudant storage reads and writes the stand-in """
+        document_id, rev = self.storage.create(promotion_document('SAVE15', ['p1', 'p2']))
+        document = self.storage.get(document_id)
+        self.assertEqual(document['_rev'], rev)
+        self.assertIs(self.storage.get(document_id, document), document)
+        self.storage.put(dict(document, code='SAVE20'))
+        self.assertRaises(DataConflictError, self.storage.put, document)
+        self.storage.bulk_docs([promotion_document('SAVE15', ['p3']),
+                                promotion_document('SAVE20', ['p2'])])
+        self.assertEqual(len(self.storage.find({'code': 'SAVE20'})), 2)
+        self.assertEqual(len(self.storage.find(
+            {'products': {'$elemMatch': {'$eq': 'p2'}}})), 2)
+        docs, bookmark = self.storage.find({'code': 'SAVE20'}, 1)
+        self.assertEqual(len(docs), 1)
+        docs, _ = self.storage.find({'code': 'SAVE20'}, 1, bookmark)
+        self.assertEqual(len(docs), 1)
+        self.assertEqual(self.storage.remove_all('bulk', 100), 3)
+
+    def test_changes(self):
+        """ The changes feed lists the last change of each document once """
+        since = self.storage.update_seq()
+        document_id, _ = self.storage.create(promotion_document('SAVE15', ['p1']))
+        self.storage.create(promotion_document('SAVE20', ['p2']))
+        document = self.storage.get(document_id)
+        self.storage.put(dict(document, code='SAVE20'))
+        url = self.storage.database.database_url + '/_changes'
+        session = self.storage.database.r_session
+        feed = session.get(url, params={'since': since}).json()
+        self.assertEqual(len(feed['results']), 2)
+        self.assertEqual(feed['pending'], 0)
+        page = session.get(url, params={'since': since, 'limit': 1}).json()
+        self.assertEqual(len(page['results']), 1)
+        self.assertEqual(page['pending'], 1)
+        self.assertEqual(feed['results'][1]['id'], document_id)
+
+    def test_too_many_requests(self):
+        """ Injected 429 responses are replayed by the adapter """
+        retries = DB_RETRIES_429.get()
+        self.standin.fail_next(2)
+        document_id, _ = self.storage.create(promotion_document('SAVE15', ['p1']))
+        self.assertIsNotNone(self.storage.get(document_id))
+        self.assertEqual(DB_RETRIES_429.get(), retries + 2)
+        self.assertEqual(self.standin.state.responses_429, 2)
+
+    def test_latency(self):
+        """ Every request waits for the latency of the stand-in """
+        self.standin.state.latency = 0.05
+        started = time.perf_counter()
+        self.storage.update_seq()
+        self.assertGreaterEqual(time.perf_counter() - started, 0.05)
@@ -0,0 +1,85 @@
+"""
+Test cases for the Warm Up
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+
+from unittest import TestCase
+from unittest.mock import patch
+from service.models import Promotion, DatabaseConnectionError
+from service.warmup import WarmUp
+from .promotion_factory import PromotionFactory
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+
+
+class TestWarmUp(TestCase):
+    """ Test cases for WarmUp """
+
+    def setUp(self):
+        """ Runs before each test """
+        Promotion.init_db("test")
+        Promotion.remove_all()
+
+    def stages(self, warm_up):
+        """ Returns the status of each stage by name """
+        return {stage['name']: stage['status'] for stage in warm_up.status()['stages']}
+
+    def test_warm_up(self):
+        """ Connect and build the in-process indexes before any request """
+        promotion = PromotionFactory()
+        promotion.save()
+        Promotion.after_fork()
+        warm_up = WarmUp('test')
+        self.assertFalse(warm_up.is_ready())
+        warm_up.run()
+        self.assertTrue(warm_up.is_ready())
+        self.assertEqual(self.stages(warm_up), {'connect': 'done', 'indexes': 'done',
+                                                'replica': 'skipped', 'pricing': 'done',
+                                                'active': 'done'})
+        self.assertIsNotNone(Promotion.storage)
+        self.assertIsNotNone(Promotion.product_index)
+        self.assertIn(promotion.id, {p.id for p in Promotion.find_active()})
+        self.assertGreaterEqual(warm_up.status()['seconds'], 0)
+
+    def test_already_connected(self):
+        """ The stages a request already went through are skipped """
+        warm_up = WarmUp('test').run()
+        self.assertEqual(self.stages(warm_up)['connect'], 'skipped')
+        self.assertTrue(warm_up.is_ready())
+
+    def test_retry_failed_stage(self):
+        """ A failed stage is tried again until it succeeds """
+        Promotion.after_fork()
+        warm_up = WarmUp('test')
+        init_db = Promotion._init_db
+        attempts = []
+
+        def flaky_init(dbname, stage):
+            attempts.append(dbname)
+            if len(attempts) == 1:
+                with stage('connect'):
+                    raise DatabaseConnectionError('Cloudant service could not be reached')
+            init_db(dbname, stage=stage)
+        with patch('service.models.Promotion._init_db', side_effect=flaky_init), \
+                patch('service.warmup.WARM_UP_RETRY_DELAY', 0.01):
+            warm_up.run()
+        self.assertEqual(len(attempts), 2)
+        self.assertTrue(warm_up.is_ready())
+        self.assertIsNone(warm_up.status()['stages'][0]['error'])
+
+    def test_stop(self):
+        """ A stopped warm-up gives up on its failed stage """
+        warm_up = WarmUp('test')
+
+        def shut_down():
+            warm_up.stop()
+            raise DatabaseConnectionError('down')
+        with patch('service.models.Promotion.pricing_index', side_effect=shut_down):
+            warm_up.run()
+        self.assertFalse(warm_up.is_ready())
+        self.assertEqual(self.stages(warm_up)['pricing'], 'failed')
+        self.assertEqual(warm_up.status()['stages'][3]['error'], 'down')